@@ -0,0 +1,51 @@
+#Compares loading a year of 1m bars from the SQLite and Parquet cache backends.
+#Run with: python -m stonks.benchmarks.cache_backends
+import numpy as np
+import pandas as pd
+
+import os
+import tempfile
+from time import perf_counter
+
+from ..market_data.cache import SQLiteBarStore
+from ..market_data.parquet_cache import ParquetBarStore
+
+def generate_bars(days=252, barSize='1m', start='2022-01-03'):
+    sessions = pd.bdate_range(start, periods=days, tz='US/Eastern')
+    barsPerDay = 16*60
+    offsets = pd.to_timedelta(np.arange(barsPerDay) + 4*60, unit='m')
+    index = pd.DatetimeIndex((sessions.values[:, None] + offsets.values[None, :]).ravel()).tz_localize('UTC').tz_convert('US/Eastern')
+    close = 100 + np.cumsum(np.random.normal(0, 0.05, len(index)))
+    return pd.DataFrame({'open': close + np.random.normal(0, 0.02, len(index)),
+                            'high': close + 0.05,
+                            'low': close - 0.05,
+                            'close': close,
+                            'volume': np.random.randint(100, 10000, len(index)).astype(float)},
+                        index=index)
+
+def time_call(func, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        t1 = perf_counter()
+        result = func()
+        timings.append(perf_counter() - t1)
+    return min(timings), result
+
+def main():
+    bars = generate_bars()
+    startTime, endTime = bars.index[0], bars.index[-1]
+    print(f'{len(bars)} bars, {startTime} - {endTime}')
+    with tempfile.TemporaryDirectory() as folder:
+        stores = [SQLiteBarStore(os.path.join(folder, 'cache.sqlite')),
+                    ParquetBarStore(os.path.join(folder, 'bars'))]
+        for store in stores:
+            t1 = perf_counter()
+            store.writeBars('BENCH', '1m', bars)
+            writeTime = perf_counter() - t1
+            readTime, result = time_call(lambda: store.readBars('BENCH', '1m', startTime, endTime))
+            dayTime, _ = time_call(lambda: store.readBars('BENCH', '1m', endTime - pd.Timedelta('1d'), endTime))
+            assert len(result) == len(bars)
+            print(f'{store.name:>8}: write {writeTime:8.3f}s | read 1y {readTime*1000:9.1f}ms | read 1d {dayTime*1000:7.1f}ms')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+#Compares file size and read latency of plain and compressed SQLite caches for a year of 1m bars.
+#Run with: python -m stonks.benchmarks.cache_compression
+import numpy as np
+import pandas as pd
+import sqlalchemy as sqla
+
+import os
+import tempfile
+from time import perf_counter
+
+from ..market_data.cache import SQLiteBarStore
+from ..market_data.compressed_cache import CompressedSQLiteBarStore
+from .cache_backends import generate_bars, time_call
+
+def file_size(store, path):
+    with store._db.connect() as connection:
+        connection.execute(sqla.text('PRAGMA wal_checkpoint(TRUNCATE)'))
+        connection.execute(sqla.text('VACUUM'))
+    return os.path.getsize(path)
+
+def main():
+    bars = generate_bars()
+    #real prices sit on a tick grid, the generated ones don't
+    bars[["open", "high", "low", "close"]] = bars[["open", "high", "low", "close"]].round(2)
+    startTime, endTime = bars.index[0], bars.index[-1]
+    print(f'{len(bars)} bars, {startTime} - {endTime}')
+    with tempfile.TemporaryDirectory() as folder:
+        for storeClass in [SQLiteBarStore, CompressedSQLiteBarStore]:
+            path = os.path.join(folder, f'{storeClass.name}.sqlite')
+            store = storeClass(path)
+            t1 = perf_counter()
+            store.writeBulk([('BENCH', '1m', bars)], [], backfill=True)
+            writeTime = perf_counter() - t1
+            size = file_size(store, path)
+            readTime, result = time_call(lambda: store.readBars('BENCH', '1m', startTime, endTime))
+            dayTime, _ = time_call(lambda: store.readBars('BENCH', '1m', endTime - pd.Timedelta('1d'), endTime))
+            assert len(result) == len(bars) and np.allclose(result.values, bars.values)
+            print(f'{store.name:>18}: {size/1024/1024:7.2f} MB ({size/len(bars):5.1f} B/bar) | write {writeTime:6.2f}s | '
+                    f'read 1y {readTime*1000:7.1f}ms | read 1d {dayTime*1000:6.1f}ms')
+            store._db.dispose()
+
+if __name__ == "__main__":
+    main()
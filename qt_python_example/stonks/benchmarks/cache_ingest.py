@@ -0,0 +1,48 @@
+#Measures rows/sec when backfilling 1M bars into the SQLite cache store.
+#Run with: python -m stonks.benchmarks.cache_ingest
+import pandas as pd
+from sqlalchemy.dialects.sqlite import insert
+
+import os
+import tempfile
+from time import perf_counter
+
+from ..market_data.cache import SQLiteBarStore, BAR_COLUMNS
+from .cache_backends import generate_bars
+
+SYMBOLS = 5
+DAYS = 209 #5 symbols * 209 days * 960 bars ~= 1M rows
+
+def per_slice(store, data):
+    #the pre-bulk addData behaviour: a multi-row insert().values() statement per 2000 row slice
+    with store._db.begin() as connection:
+        for symbol, barSize, bars in data:
+            symbolId = store._get_symbol_id(symbol, connection)
+            for start in range(0, bars.shape[0], 2000):
+                subset = bars.iloc[start:start + 2000].copy()
+                records = pd.DataFrame({'symbol_id': symbolId, 'bar_size': barSize, 'epoch_ns': subset.index.asi8}, index=subset.index)
+                records[BAR_COLUMNS] = subset[BAR_COLUMNS]
+                stmt = insert(store._barsTable).values(records.to_dict('records'))
+                stmt = stmt.on_conflict_do_update(index_elements=['symbol_id', 'bar_size', 'epoch_ns'],
+                                                    set_={column: stmt.excluded[column] for column in BAR_COLUMNS})
+                connection.execute(stmt)
+
+def bulk(store, data):
+    store.writeBulk(data, [], backfill=True)
+
+def main():
+    bars = generate_bars(days=DAYS)
+    data = [(f'SYM{i}', '1m', bars) for i in range(SYMBOLS)]
+    rows = SYMBOLS * len(bars)
+    print(f'{rows} rows')
+    for name, func in [('2000 row slices', per_slice), ('bulk', bulk)]:
+        with tempfile.TemporaryDirectory() as folder:
+            store = SQLiteBarStore(os.path.join(folder, 'cache.sqlite'))
+            t1 = perf_counter()
+            func(store, data)
+            elapsed = perf_counter() - t1
+            store._db.dispose()
+        print(f'{name:>16}: {elapsed:7.2f}s {rows/elapsed:12,.0f} rows/s')
+
+if __name__ == "__main__":
+    main()
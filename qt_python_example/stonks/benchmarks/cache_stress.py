@@ -0,0 +1,71 @@
+#Hammers the SQLite cache store with concurrent readers while writers queue bars through the cache writer thread.
+#Run with: python -m stonks.benchmarks.cache_stress [readers] [writers]
+import pandas as pd
+
+import os
+import sys
+import tempfile
+import threading
+from time import perf_counter
+
+from ..market_data.cache import SQLiteBarStore, CacheWriter
+from .cache_backends import generate_bars
+
+DURATION = 10
+DAYS = 20
+
+def reader(store, stop, counters, errors):
+    while not stop.is_set():
+        for symbol in ('SYM0', 'SYM1', 'SYM2'):
+            endTime = pd.Timestamp.now(tz='US/Eastern')
+            try:
+                store.readBars(symbol, '1m', endTime - pd.Timedelta(days=400), endTime)
+                counters['reads'] += 1
+            except Exception as e:
+                errors.append(str(e))
+
+def writer(cacheWriter, bars, index, stop, counters, errors):
+    symbol = f'SYM{index % 3}'
+    day = 0
+    dayBars = bars.groupby(bars.index.date)
+    days = [group for _, group in dayBars]
+    while not stop.is_set():
+        try:
+            cacheWriter.submit([(symbol, '1m', days[day % len(days)])], []).result()
+            counters['writes'] += 1
+            counters['rows'] += len(days[day % len(days)])
+        except Exception as e:
+            errors.append(str(e))
+        day += 1
+
+def main():
+    readers = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    writers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    bars = generate_bars(days=DAYS)
+    with tempfile.TemporaryDirectory() as folder:
+        store = SQLiteBarStore(os.path.join(folder, 'cache.sqlite'), poolSize=readers+1)
+        store.writeBars('SYM0', '1m', bars)
+        cacheWriter = CacheWriter(store)
+        stop = threading.Event()
+        counters = {'reads': 0, 'writes': 0, 'rows': 0}
+        errors = []
+        threads = [threading.Thread(target=reader, args=(store, stop, counters, errors)) for _ in range(readers)]
+        threads += [threading.Thread(target=writer, args=(cacheWriter, bars, i, stop, counters, errors)) for i in range(writers)]
+        t1 = perf_counter()
+        for thread in threads:
+            thread.start()
+        stop.wait(DURATION)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        cacheWriter.stop()
+        elapsed = perf_counter() - t1
+        store._db.dispose()
+    locked = sum('locked' in error for error in errors)
+    print(f'{readers} readers, {writers} writers, {elapsed:.1f}s')
+    print(f'reads : {counters["reads"]:8} {counters["reads"]/elapsed:10,.1f}/s')
+    print(f'writes: {counters["writes"]:8} {counters["writes"]/elapsed:10,.1f}/s ({counters["rows"]/elapsed:,.0f} rows/s, {cacheWriter.batches} transactions)')
+    print(f'errors: {len(errors)} ({locked} database is locked)')
+
+if __name__ == "__main__":
+    main()
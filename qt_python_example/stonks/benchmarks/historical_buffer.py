@@ -0,0 +1,60 @@
+#Compares collecting an IBKR historical data response bar by bar into a dataframe with .loc against the raw column buffer.
+#Run with: python -m stonks.benchmarks.historical_buffer [bars]
+import pandas as pd
+
+import sys
+from time import perf_counter
+
+from ibapi.common import BarData
+
+from ..market_data.ibkr import IBRequest, TIME_FORMAT
+from ..market_data.types import get_empty_bar_dataframe
+
+class FakeApi(object):
+    twsTimezone = 'US/Pacific'
+
+def generate_response(count):
+    times = pd.date_range('2022-01-03 04:00', periods=count, freq='T')
+    bars = []
+    for i, timestamp in enumerate(times):
+        bar = BarData()
+        bar.date = timestamp.strftime(TIME_FORMAT)
+        bar.open, bar.high, bar.low, bar.close = 100 + i * 0.01, 100.05 + i * 0.01, 99.95 + i * 0.01, 100 + i * 0.01
+        bar.volume = 1000 + i
+        bars.append(bar)
+    return bars
+
+def loc_buffer(bars, tz):
+    #what historicalData/addBarToBuffer used to do for every bar
+    buffer = get_empty_bar_dataframe()
+    for bar in bars:
+        timestamp = pd.Timestamp(bar.date, tz=tz)
+        buffer.loc[timestamp] = [bar.open, bar.high, bar.low, bar.close, bar.volume]
+    return buffer
+
+def column_buffer(bars):
+    request = IBRequest(0, None, IBRequest.HISTORICAL_BARS, FakeApi())
+    for bar in bars:
+        request.addBarToBuffer(bar)
+    return request.getBarsFromBuffer()
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    bars = generate_response(count)
+    print(f'{count} bars')
+
+    t1 = perf_counter()
+    after = column_buffer(bars)
+    columnTime = perf_counter() - t1
+    print(f'column buffer: {columnTime:8.3f}s ({columnTime / count * 1e6:6.2f}us/bar)')
+
+    t1 = perf_counter()
+    before = loc_buffer(bars, FakeApi.twsTimezone)
+    locTime = perf_counter() - t1
+    print(f'   .loc buffer: {locTime:8.3f}s ({locTime / count * 1e6:6.2f}us/bar)')
+
+    assert before.index.equals(after.index) and (before.values.astype(float) == after.values).all()
+    print(f'speedup: {locTime / columnTime:.0f}x')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#Replays a synthetic session of rate messages per second through ReplayAPIWrapper into the event bus and GUI thread
+#callbacks, first paced in real time, then as fast as possible.
+#Run with: python -m stonks.benchmarks.replay_load [rate] [seconds] [symbols]
+import sys
+import tempfile
+from time import perf_counter
+
+from PySide2.QtCore import QCoreApplication, QTimer
+
+from ..market_data.replay import ReplayAPIWrapper, generate_session
+
+def run(app, folder, symbols, speed, duration):
+    api = ReplayAPIWrapper(folder, speed)
+    delivered = {'ticks': 0, 'depth': 0, 'bars': 0, 'history': 0}
+    def tick_callback(symbol, time, price, size):
+        delivered['ticks'] += 1
+    def depth_callback(symbol, book):
+        book.bookData(0.05)
+        delivered['depth'] += 1
+    def bar_callback(symbol, bar, barSize):
+        delivered['bars'] += 1
+    def history_callback(symbol, barSize, bars, startTime, endTime):
+        delivered['history'] += len(bars)
+
+    api.connect()
+    for symbol in symbols:
+        api.requestTickData(symbol, tick_callback)
+        api.requestMarketDepth(symbol, depth_callback)
+        api.requestHistoricalBars(symbol, '1m', live=True, callback=history_callback, live_callback=bar_callback)
+
+    t1 = perf_counter()
+    def check():
+        if api.ibapi.finished.is_set() or perf_counter() - t1 > duration:
+            app.quit()
+    timer = QTimer()
+    timer.timeout.connect(check)
+    timer.start(10)
+    app.exec_()
+    elapsed = perf_counter() - t1
+    api.eventBus.drain()
+    stats = api.stats()
+    api.disconnect()
+    api.listeningThread.wait(1000)
+    return elapsed, stats, delivered
+
+def main():
+    rate = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    symbolCount = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    symbols = [f'SYN{i}' for i in range(symbolCount)]
+    app = QCoreApplication.instance() or QCoreApplication([])
+
+    with tempfile.TemporaryDirectory() as folder:
+        count = generate_session(folder, symbols, seconds, rate)
+        print(f'{count} messages over {seconds}s for {symbolCount} symbols')
+        for speed in (1.0, 0):
+            elapsed, stats, delivered = run(app, folder, symbols, speed, seconds * 2 + 5)
+            bus = stats['event_bus']
+            live = stats['ticks'] + stats['depth'] + stats['bars']
+            print(f'{"real time" if speed else "max speed"}: {live} messages in {elapsed:.2f}s ({live / elapsed:,.0f} msg/s), '
+                    f'max replay lag {stats["max_lag_ms"]:.1f}ms')
+            print(f'    event bus: {bus["posted"]} posted, {bus["delivered"]} delivered, {bus["coalesced"]} coalesced, '
+                    f'{bus["dropped"]} dropped, max latency {bus["max_latency_ms"]:.1f}ms')
+            print(f'    callbacks: {delivered}')
+
+if __name__ == "__main__":
+    main()
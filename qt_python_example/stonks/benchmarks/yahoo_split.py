@@ -0,0 +1,56 @@
+#Compares splitting a wide group_by='ticker' Yahoo download into per-symbol frames one column slice at a time against
+#the stacked reshape YahooAPIWrapper uses.
+#Run with: python -m stonks.benchmarks.yahoo_split [symbols] [days]
+import numpy as np
+import pandas as pd
+
+import sys
+from time import perf_counter
+
+from ..market_data.yahoo import YahooAPIWrapper
+
+def generate_download(symbolCount, days):
+    symbols = [f'S{i:04d}' for i in range(symbolCount)]
+    index = pd.date_range('2020-01-02', periods=days, freq='B', tz='America/New_York', name='Date')
+    columns = pd.MultiIndex.from_product([symbols, ['Open', 'High', 'Low', 'Close', 'Adj Close', 'Volume']], names=['Ticker', 'Price'])
+    bars = pd.DataFrame(np.random.rand(len(index), len(columns)) + 100, index=index, columns=columns)
+    #a tenth of the symbols listed halfway through
+    for symbol in symbols[::10]:
+        bars.loc[:index[days // 2], (symbol, slice(None))] = np.nan
+    return symbols, bars
+
+def column_split(bars, symbols, twsTimezone):
+    #what downloadHistoricalBars used to do for every symbol
+    result = {}
+    for symbol in symbols:
+        symbolBars = bars[symbol][['Open', 'High', 'Low', 'Close', 'Volume']].dropna(how='all')
+        symbolBars.columns = ["open", "high", "low", "close", "volume"]
+        symbolBars.index = symbolBars.index.tz_localize(None).normalize().tz_localize(twsTimezone)
+        if not symbolBars.empty:
+            result[symbol] = symbolBars
+    return result
+
+def main():
+    symbolCount = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 1250
+    symbols, bars = generate_download(symbolCount, days)
+    api = YahooAPIWrapper()
+    print(f'{symbolCount} symbols x {days} daily bars')
+
+    t1 = perf_counter()
+    after = api.splitDownload(bars, symbols, '1D')
+    stackTime = perf_counter() - t1
+    print(f'stacked: {stackTime:8.3f}s ({stackTime / symbolCount * 1e3:6.2f}ms/symbol)')
+
+    t1 = perf_counter()
+    before = column_split(bars, symbols, api.twsTimezone)
+    columnTime = perf_counter() - t1
+    print(f'columns: {columnTime:8.3f}s ({columnTime / symbolCount * 1e3:6.2f}ms/symbol)')
+
+    assert before.keys() == after.keys()
+    for symbol in symbols:
+        assert before[symbol].index.equals(after[symbol].index) and np.allclose(before[symbol].values, after[symbol].values)
+    print(f'speedup: {columnTime / stackTime:.1f}x')
+
+if __name__ == "__main__":
+    main()
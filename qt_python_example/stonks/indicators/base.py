@@ -1,6 +1,7 @@
 from PySide2.QtCore import Qt, QObject, Signal
 
 from ..market_data.types import get_empty_bar_dataframe
+from ..market_data.scheduler import PRIORITY_INDICATOR
 
 import logging
 log = logging.getLogger('Indicators')
@@ -72,7 +73,8 @@ class RelativeIndicator(BaseIndicator):
             return
         if not self._requestActive:
             self._requestActive = True
-            self._api.requestHistoricalBars(symbol, barSize, startTime, endTime, self.relativeDataCallback)
+            self._api.requestHistoricalBars(symbol, barSize, startTime, endTime, self.relativeDataCallback,
+                                            priority=PRIORITY_INDICATOR, owner=self)
         if live and not f'{symbol}_{dataType}' in self._activeSubscriptions:
             self._activeSubscriptions.append(f'{symbol}_{dataType}')
             self._api.subscribeToLiveBars(symbol, barSize, self.liveDataCallback)
@@ -110,6 +112,9 @@ class RelativeIndicator(BaseIndicator):
         self.addRelativeData(symbol, dataType, bar)
     
     def cancelSubscriptions(self):
+        if self._api and self._requestActive:
+            self._api.cancelHistoricalRequests(self)
+            self._requestActive = False
         for subscription in self._activeSubscriptions[:]:
             symbol = subscription.split('_')[0]
             barSize = subscription.split('_')[-1]
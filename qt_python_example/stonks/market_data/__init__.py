@@ -1,8 +1,17 @@
 from .ibkr import IBApiWrapper, IBRequest
 from .yahoo import YahooAPIWrapper
+from .replay import ReplayAPIWrapper, SessionRecorder, DEFAULT_RECORD_FOLDER
 
-from .base import BaseAPIWrapper, to_thread
-from .cache import MarketDataCache
+from .base import BaseAPIWrapper, CancellationToken, MarketDataExecutor, to_thread
+from .cache import MarketDataCache, get_chunk_labels, get_chunk_label
+from .planner import FetchPlan, plan_requests
+from .resample import can_resample, resample_bars, DERIVED_DATA_SOURCE
+from .prefetch import WatchlistPrefetcher
+from .ticks import TapeStore
+from .scheduler import HistoricalRequestScheduler, PRIORITY_INTERACTIVE
+from .flight import FlightBoard
+from .bulk import BulkHistoricalLoad
+import os
 import sys
 import inspect
 
@@ -12,6 +21,9 @@ from ..config import Config
 
 from PySide2.QtCore import Signal
 
+import logging
+log = logging.getLogger('Market Data')
+
 def available_apis():
     apis = []
     for varName in dir(sys.modules[__name__]):
@@ -35,59 +47,216 @@ class MarketData(object):
                             'ticks' : IBRequest.REALTIME_TICKS,
                             'marketDepth': IBRequest.REALTIME_LEVEL2}
     def __init__(self):
+        self.config = Config()
         self._cache = MarketDataCache()
-        self._precise_api = MarketDataAPI("IBKR")
-        self._precise_api.connect("127.0.0.1", 7497)
+        #recent ticks per symbol, filled by the tick data subscriptions
+        self.tape = TapeStore()
+        #"Replay" plays a recorded session back instead of connecting to TWS
+        self._precise_api = MarketDataAPI(self.config.get_property('market_data_provider', 'IBKR'))
+        self._precise_api.connect(self.config.get_property('ibkr_host', '127.0.0.1'), self.config.get_property('ibkr_port', 7497))
         self._bulk_api = MarketDataAPI("Yahoo Finance")
-        self.config = Config()
+        #every historical request to IBKR goes through here so bursts stay within its pacing limits
+        self.scheduler = HistoricalRequestScheduler(self._precise_api)
+        #concurrent loads of the same symbol, bar size and chunks share one fetch and one result
+        self._flights = FlightBoard(self.config.get_property('historical_flight_timeout', 900))
+        self.bulkLoads = []
+        self.recorder = None
         self.twsTimezone = self.config.get_property('twsTimezone', 'US/Pacific')
+        #trading offsets by (bar size, open, close)
+        self._offsets = {}
+        #intraday bar sizes that are multiples of this one are resampled locally instead of downloaded
+        self.baseBarSize = self.config.get_property('resample_base_bar_size', '1m')
 
         self.subscriptions = []
 
-    def historicalBarsCallback(self, callback, data_source, totalStartTime, totalEndTime):
+        if self.config.get_property('record_sessions', False):
+            self.startRecording()
+
+        self.prefetcher = WatchlistPrefetcher(self)
+        if self.config.get_property('prefetch_on_start', True) and self.config.get_property('watchlist', []):
+            self.prefetcher.start()
+
+    def historicalBarsCallback(self, plan, data_source, flight):
+        #caches each sub-request's bars as it arrives and lets the plan start the next one
         def wrapper(symbol, barSize, bars, startTime, endTime):
-            dataType = 'bars_'+barSize
-            self._cache.addData(symbol, dataType, bars, data_source)
-            cached_data = self._cache.getData(symbol, dataType, totalStartTime, totalEndTime)
-            callback(symbol, barSize, cached_data, totalStartTime, totalEndTime)
+            self._cache.addData(symbol, 'bars_'+barSize, bars, data_source)
+            self._flights.progress(flight)
+            plan.requestFinished()
         return wrapper
 
-    @to_thread
-    def requestHistoricalBars(self, symbol, barSize='1m', startTime=None, endTime=None, callback=None, error_callback=None):
+    def defaultRange(self, barSize, startTime=None, endTime=None):
+        #(trading offset, startTime, endTime) with the last 200 bars up to now filled in for missing bounds
         market_hours = get_market_hours(tz=self.twsTimezone)
-        offset = trading_offset_factory(barSize, start=market_hours[0], end=market_hours[-1])
+        key = (barSize, market_hours[0], market_hours[-1])
+        offset = self._offsets.get(key)
+        if offset is None:
+            #building one loads the NYSE holiday calendar (~0.4s), and bulk loads ask for the same one for every symbol
+            offset = self._offsets[key] = trading_offset_factory(barSize, start=market_hours[0], end=market_hours[-1])
 
         if endTime is None:
             endTime = offset.rollback(pd.Timestamp.now().round(freq='T').tz_localize(self.twsTimezone))
         if startTime is None:
             startTime = endTime - offset * 200
-        
+        return offset, startTime, endTime
+
+    @to_thread
+    def requestHistoricalBars(self, symbol, barSize='1m', startTime=None, endTime=None, callback=None, error_callback=None,
+                                priority=PRIORITY_INTERACTIVE, owner=None, token=None):
+        return self.loadHistoricalBars(symbol, barSize, startTime, endTime, callback, error_callback, priority, owner, token)
+
+    def loadHistoricalBars(self, symbol, barSize='1m', startTime=None, endTime=None, callback=None, error_callback=None,
+                                priority=PRIORITY_INTERACTIVE, owner=None, token=None):
+        #runs on the calling thread, returns the number of provider requests it had to make or is waiting on
+        #a cancelled token drops the load, and cancelling it later drops the provider requests made for it
+        if token is not None:
+            if token.cancelled:
+                return 0
+            if owner is None:
+                owner = token
+            cancelRequests = lambda: self.cancelHistoricalRequests(owner)
+            token.addCallback(cancelRequests)
+            callback = self._release_on_landing(token, cancelRequests, callback)
+        offset, startTime, endTime = self.defaultRange(barSize, startTime, endTime)
+        dataType = 'bars_'+barSize
+        key = (symbol, barSize, get_chunk_label(startTime, dataType).value, get_chunk_label(endTime, dataType).value)
+        flight, leader = self._flights.join(key, startTime, endTime, callback, error_callback, priority, owner)
+        if not leader:
+            #the callback comes from the leader's load, so callers waiting on it count at least one request
+            return max(1, flight.requestCount)
+        missingRanges = self._cache.getMissingRanges(symbol, dataType, startTime, endTime)
+
+        def deliver_to(waiters):
+            if not waiters:
+                return
+            #one read for every waiter, the ones that asked for less get a slice of the same frame
+            spanStart = min(waiter.startTime for waiter in waiters)
+            spanEnd = max(waiter.endTime for waiter in waiters)
+            bars = self._cache.getData(symbol, dataType, spanStart, spanEnd)
+            for waiter in waiters:
+                if waiter.callback is None:
+                    continue
+                waiterBars = bars
+                if waiter.startTime != spanStart or waiter.endTime != spanEnd:
+                    waiterBars = bars.iloc[bars.index.searchsorted(waiter.startTime):bars.index.searchsorted(waiter.endTime, side='right')]
+                waiter.callback(symbol, barSize, waiterBars, waiter.startTime, waiter.endTime)
+
+        def deliver():
+            deliver_to(self._flights.land(flight))
+
+        def flight_error(symbol, barSize, errorCode, errorMsg):
+            #the first failure lands the flight, every waiter gets the error and then whatever made it into the cache.
+            #Requests already sent still cache their bars, the ones not sent yet are dropped.
+            waiters = self._flights.land(flight)
+            for waiter in waiters:
+                if waiter.error_callback is not None:
+                    waiter.error_callback(symbol, barSize, errorCode, errorMsg)
+            deliver_to(waiters)
+
+        flight.onExpired = lambda: flight_error(symbol, barSize, -1, f'No progress for {self._flights.timeout}s')
+
+        if not missingRanges:
+            log.debug(f'{symbol} {barSize} served from the cache')
+            deliver()
+            return 0
+        requests = plan_requests(missingRanges, barSize)
+        if can_resample(barSize, self.baseBarSize):
+            baseMissingRanges = []
+            for missingStartTime, missingEndTime in missingRanges:
+                baseMissingRanges += self._cache.getMissingRanges(symbol, 'bars_'+self.baseBarSize, missingStartTime, missingEndTime - pd.Timedelta(1, unit='ns'))
+            baseRequests = plan_requests(baseMissingRanges, self.baseBarSize)
+            #long windows of large bars take far fewer requests downloaded directly, which matters under pacing
+            if len(baseRequests) <= len(requests):
+                #only the base bars are downloaded, the requested bar size is built from them once they're cached
+                def baseComplete(failed):
+                    self.deriveBars(symbol, barSize, missingRanges, offset.openTime())
+                    deliver()
+
+                return self.fetchMissingRanges(symbol, self.baseBarSize, baseRequests, baseComplete, flight_error, flight)
+        return self.fetchMissingRanges(symbol, barSize, requests, lambda failed: deliver(), flight_error, flight)
+
+    def _release_on_landing(self, token, cancelRequests, callback):
+        #the load is over once its callback fires, so a long lived token stops holding its cancel callback
+        def landed(*args):
+            token.removeCallback(cancelRequests)
+            if callback is not None:
+                callback(*args)
+        return landed
+
+    def fetchMissingRanges(self, symbol, barSize, requests, onComplete, error_callback, flight):
+        def fetch(plan, requestStart, requestEnd):
+            if flight.landed:
+                #every waiter cancelled
+                plan.cancel()
+                plan.requestFinished()
+                return
+            wrapped_callback = self.historicalBarsCallback(plan, self._precise_api.name, flight)
+            self.scheduler.submit(symbol, barSize, requestStart, requestEnd, wrapped_callback, plan.requestFailed, flight.priority, owner=flight)
+
+        log.debug(f'{symbol} {barSize} FETCHED WITH {len(requests)} REQUESTS')
+        flight.requestCount = len(requests)
+        plan = FetchPlan(requests, fetch, onComplete, error_callback, self.config.get_property('historical_max_concurrent_requests', 6))
+        plan.start()
+        return len(requests)
+
+    def deriveBars(self, symbol, barSize, ranges, openTime):
+        sessionOpen = openTime - openTime.normalize()
         dataType = 'bars_'+barSize
-        missingStartTime, missingEndTime = self._cache.getMissingRange(symbol, dataType, startTime, endTime)
-        print('MISSING START AND END', missingStartTime, missingEndTime)
-        if not missingStartTime is None:
-            wrapped_callback = self.historicalBarsCallback(callback, self._precise_api.name, startTime, endTime)
-            print('about to request')
-            self._precise_api.requestHistoricalBars(symbol, barSize, missingStartTime, missingEndTime, False, wrapped_callback, error_callback)
-        else:
-            print('NO REQUEST REQUIRED, GETTING DATA FROM CACHE')
-            bars = self._cache.getData(symbol, dataType, startTime, endTime)
-            if not callback is None:
-                callback(symbol, barSize, bars, startTime, endTime)
-
-    def requestBulkHistoricalBars(self, symbols, barSize='1m', startTime=None, endTime=None, callback=None, error_callback=None):
-        pass
+        dataItems = []
+        for rangeStart, rangeEnd in ranges:
+            baseBars = self._cache.getData(symbol, 'bars_'+self.baseBarSize, rangeStart, rangeEnd - pd.Timedelta(1, unit='ns'))
+            derived = resample_bars(baseBars, barSize, sessionOpen)
+            #written per day, so a session whose base bars failed to download isn't marked as cached
+            for _, dayBars in derived.groupby(get_chunk_labels(derived.index, dataType)):
+                dataItems.append((symbol, dataType, dayBars))
+        self._cache.addBulkData(dataItems, DERIVED_DATA_SOURCE, backfill=False)
+
+    def cancelHistoricalRequests(self, owner):
+        #drops queued and in flight provider requests made on behalf of owner that nobody else is waiting for
+        for flight in self._flights.cancelOwner(owner):
+            self.scheduler.cancelOwner(flight)
+        self.scheduler.cancelOwner(owner)
+
+    def requestBulkHistoricalBars(self, symbols, barSize='1m', startTime=None, endTime=None, callback=None, error_callback=None, complete_callback=None):
+        #returns right away, callback fires once per symbol as its bars become available
+        _, startTime, endTime = self.defaultRange(barSize, startTime, endTime)
+        self.bulkLoads = [load for load in self.bulkLoads if load.finished < load.total]
+        load = BulkHistoricalLoad(self, symbols, barSize, startTime, endTime, callback, error_callback, complete_callback)
+        self.bulkLoads.append(load)
+        return load.start()
 
     def subscribeToLiveBars(self, symbol, barSize='1m', callback=None, error_callback=None):
-        print('LIVE BAR SUBSCRIPTION', symbol, barSize)
+        log.debug(f'Live bar subscription {symbol} {barSize}')
         self._precise_api.requestHistoricalBars(symbol, barSize, live=True, live_callback=callback, error_callback=error_callback)
     
     def subscribeToTickData(self, symbol, callback):
-        self._precise_api.requestTickData(symbol, callback)
+        return self._precise_api.requestTickData(symbol, callback)
 
     def subscribeToMarketDepth(self, symbol, callback):
         self._precise_api.requestMarketDepth(symbol, callback)
 
+    def getRecentTicks(self, symbol, count=None):
+        return self.tape.latest(symbol, count)
+
+    def replayTicks(self, symbol, startTime, endTime, callback):
+        return self.tape.replay(symbol, startTime, endTime, callback)
+
+    def startRecording(self, folder=None):
+        #raw provider messages from now on are written to folder, in a new session folder by default, for replay
+        if folder is None:
+            folder = os.path.join(os.path.expandvars(self.config.get_property('record_folder', DEFAULT_RECORD_FOLDER)),
+                                    pd.Timestamp.now().strftime('%Y-%m-%d_%H%M%S'))
+        self.stopRecording()
+        self.recorder = SessionRecorder(folder)
+        self._precise_api.setRecorder(self.recorder)
+        return self.recorder
+
+    def stopRecording(self):
+        if self.recorder is None:
+            return
+        self._precise_api.setRecorder(None)
+        self.recorder.close()
+        self.recorder = None
+
     def isSubscriptionActive(self, symbol, subscriptionType, barSize=None, live=False):
         requestType = self.requestTypes[subscriptionType]
         return self._precise_api.hasRequest(symbol, requestType, barSize, live)
@@ -103,4 +272,11 @@ class MarketData(object):
         self._precise_api.cancelRequests(symbol, requestType)
     
     def disconnect(self):
+        self.prefetcher.stop()
+        for load in self.bulkLoads:
+            load.cancel()
+        self.scheduler.stop()
+        self._flights.stop()
+        self.stopRecording()
         self._precise_api.disconnect()
+        self.tape.close()
@@ -0,0 +1,203 @@
+#asyncio front end for MarketData, for headless scanners and backtests:
+#
+#   marketData = MarketData()           #on the Qt thread, it owns the IBKR connection
+#   async def main(md):
+#       bars = await md.bars('AAPL', '1m', timeout=30)
+#       async for symbol, bars in md.bulkBars(symbols, '1D'):
+#           ...
+#       async for tick in md.ticks('AAPL'):
+#           ...
+#   run_headless(main(AsyncMarketData(marketData)))
+import asyncio
+import concurrent.futures
+import threading
+
+import numpy as np
+
+from .base import CancellationToken
+from .scheduler import PRIORITY_INTERACTIVE, PRIORITY_SCANNER
+
+from PySide2.QtCore import QCoreApplication, QObject, Signal
+
+import logging
+log = logging.getLogger('Market Data')
+
+class MarketDataError(Exception):
+    def __init__(self, symbol, barSize, errors):
+        Exception.__init__(self, f'{symbol} {barSize}: {errors}')
+        self.symbol = symbol
+        self.barSize = barSize
+        self.errors = errors
+
+def _resolve(future, result=None, exception=None):
+    #loop thread only, the caller may have given up on the future already
+    if future.done():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+class AsyncMarketData(object):
+    #every method is a coroutine or async iterator on the caller's loop, MarketData's callbacks arrive on Qt and
+    #worker threads and are handed over with call_soon_threadsafe. Cancelling a task or hitting its timeout cancels
+    #the provider requests made for it.
+    def __init__(self, marketData):
+        self.marketData = marketData
+
+    async def bars(self, symbol, barSize='1m', startTime=None, endTime=None, timeout=None, priority=PRIORITY_INTERACTIVE):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        errors = []
+        #owns this call's provider requests, cancelling it drops the load if it's still queued and cancels only those
+        token = CancellationToken()
+
+        def callback(symbol, barSize, bars, startTime, endTime):
+            if errors and bars.empty:
+                loop.call_soon_threadsafe(_resolve, future, None, MarketDataError(symbol, barSize, errors))
+            else:
+                loop.call_soon_threadsafe(_resolve, future, bars)
+        def error_callback(symbol, barSize, errorCode, errorMsg):
+            errors.append((errorCode, errorMsg))
+
+        #keywords, to_thread only sees the lane and token when they're passed by name
+        self.marketData.requestHistoricalBars(symbol, barSize, startTime, endTime, callback, error_callback,
+                                                priority=priority, owner=token, token=token)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            token.cancel()
+            raise
+
+    async def barsMany(self, symbols, barSize='1m', startTime=None, endTime=None, timeout=None, priority=PRIORITY_SCANNER):
+        #{symbol: bars}, all or nothing: the first failure cancels the rest
+        tasks = {symbol: asyncio.ensure_future(self.bars(symbol, barSize, startTime, endTime, timeout=timeout, priority=priority)) for symbol in symbols}
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        return {symbol: task.result() for symbol, task in tasks.items()}
+
+    async def bulkBars(self, symbols, barSize='1D', startTime=None, endTime=None):
+        #async iterator of (symbol, bars) in completion order, through the bulk provider and cache
+        #(symbol, MarketDataError) is yielded for symbols that failed, breaking out of the loop cancels the load
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        total = len(set(symbol.upper() for symbol in symbols))
+
+        def callback(symbol, barSize, bars, startTime, endTime):
+            loop.call_soon_threadsafe(queue.put_nowait, (symbol, bars))
+        def error_callback(symbol, barSize, errorCode, errorMsg):
+            loop.call_soon_threadsafe(queue.put_nowait, (symbol, MarketDataError(symbol, barSize, [(errorCode, errorMsg)])))
+
+        load = self.marketData.requestBulkHistoricalBars(symbols, barSize, startTime, endTime, callback, error_callback)
+        received = set()
+        try:
+            while len(received) < total:
+                symbol, result = await queue.get()
+                #a failed precise fallback still delivers, the error comes first
+                if symbol in received:
+                    continue
+                received.add(symbol)
+                yield symbol, result
+        finally:
+            if len(received) < total:
+                load.cancel()
+
+    async def ticks(self, symbol):
+        #async iterator over every trade of symbol from now on, as (time_ns, price, size, exchange) records
+        #ticks are read from the tape, so the coalesced GUI callbacks only serve as wake ups. A consumer that falls
+        #more than the tape's capacity behind gets a MarketDataError rather than a stream with a gap in it
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        tape = self.marketData.tape
+        sequence = tape.buffer(symbol).count
+
+        def callback(symbol, time, price, size):
+            loop.call_soon_threadsafe(wakeup.set)
+
+        request = self.marketData.subscribeToTickData(symbol, callback)
+        try:
+            while True:
+                await wakeup.wait()
+                wakeup.clear()
+                ticks, newSequence = tape.since(symbol, sequence)
+                #copied, the ring may lap the view while the consumer is still iterating
+                ticks = np.array(ticks)
+                lost = newSequence - sequence - len(ticks)
+                sequence = newSequence
+                if lost > 0:
+                    raise MarketDataError(symbol, 'ticks', [(-1, f'{lost} ticks lost, the consumer fell behind the tape')])
+                for tick in ticks:
+                    yield tick
+        finally:
+            if request is not None:
+                request.cancel()
+
+    async def cached(self, symbol, barSize='1m', startTime=None, endTime=None):
+        #cache only read, never goes to a provider
+        _, startTime, endTime = self.marketData.defaultRange(barSize, startTime, endTime)
+        return await asyncio.to_thread(self.marketData._cache.getData, symbol, 'bars_'+barSize, startTime, endTime)
+
+class _QtRelay(QObject):
+    done = Signal(object, object)
+
+class AsyncBridge(object):
+    #an asyncio loop on its own thread next to the Qt event loop, create it on the Qt thread
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._relay = _QtRelay()
+        self._relay.done.connect(self._deliver)
+        self._thread = threading.Thread(target=self._run, name='AsyncMarketData', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        #concurrent.futures.Future of the coroutine, usable from any thread
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def submitToQt(self, coroutine, callback, error_callback=None):
+        #callback(result) or error_callback(exception) run on the Qt thread
+        future = self.submit(coroutine)
+        future.add_done_callback(lambda future: self._relay.done.emit(future, (callback, error_callback)))
+        return future
+
+    def _deliver(self, future, callbacks):
+        callback, error_callback = callbacks
+        try:
+            result = future.result()
+        except (Exception, concurrent.futures.CancelledError) as e:
+            if error_callback is not None:
+                error_callback(e)
+            else:
+                log.error(f'Async market data call failed: {e!r}')
+            return
+        callback(result)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(1)
+
+def run_headless(coroutine):
+    #runs the coroutine on the bridge loop while this (Qt) thread runs the event loop IBKR's callbacks need
+    app = QCoreApplication.instance() or QCoreApplication([])
+    bridge = AsyncBridge()
+    outcome = []
+    def finished(result):
+        outcome.append(result)
+        app.quit()
+    def failed(exception):
+        outcome.append(exception)
+        app.quit()
+    bridge.submitToQt(coroutine, finished, failed)
+    app.exec_()
+    bridge.stop()
+    if isinstance(outcome[0], BaseException):
+        raise outcome[0]
+    return outcome[0]
@@ -1,24 +1,168 @@
 from PySide2.QtCore import QThreadPool, QRunnable
 
+import concurrent.futures
+import threading
+from time import monotonic
+
+from ..config import Config
+from ..utils import singleton
+from .scheduler import PRIORITY_INTERACTIVE, PRIORITY_PREFETCH
+
+import logging
+log = logging.getLogger('Market Data')
+
 class BaseAPIWrapper(object):
+    #whether historical requests have to go through the scheduler's pacing limits
+    paced = False
     def __init__(self):
         pass
 
     def connect(self):
         pass
 
+class CancellationToken(object):
+    #shared by related pieces of work, cancelling it drops whatever hasn't started and runs the registered callbacks
+    def __init__(self):
+        self._cancelled = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def addCallback(self, callback):
+        #called right away if the token is already cancelled
+        with self._lock:
+            if not self._cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def removeCallback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def cancel(self):
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                log.exception('Cancellation callback failed')
+
+class ExecutorTask(QRunnable):
+    def __init__(self, executor, func, args, kwargs, token):
+        QRunnable.__init__(self)
+        self.setAutoDelete(False)
+        self.executor = executor
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.token = token
+        self.future = concurrent.futures.Future()
+        self.queuedAt = monotonic()
+        self.cancelCallback = lambda: executor._cancel(self)
+
+    def run(self):
+        self.executor._started(self)
+        if (self.token is not None and self.token.cancelled) or not self.future.set_running_or_notify_cancel():
+            self.future.cancel()
+            self.executor._finished(self, 0)
+            return
+        startTime = monotonic()
+        try:
+            self.future.set_result(self.func(*self.args, **self.kwargs))
+        except BaseException as e:
+            log.exception(f'{getattr(self.func, "__name__", self.func)} failed')
+            self.future.set_exception(e)
+        self.executor._finished(self, monotonic() - startTime)
+
+@singleton
+class MarketDataExecutor(object):
+    #bounded pool for market data work, kept apart from QThreadPool.globalInstance() so charts and indicators
+    #can't starve it. Lower priority values run first, tasks still queued when their token is cancelled never run.
+    def __init__(self):
+        self.config = Config()
+        self._pool = QThreadPool()
+        self._pool.setMaxThreadCount(self.config.get_property("market_data_threads", 4))
+        self._queued = set()
+        self._lock = threading.Lock()
+
+        self.submitted = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.maxQueueDepth = 0
+        self.maxWait = 0.0
+        self.avgWait = 0.0
+        self.avgRunTime = 0.0
+
+    def maxThreadCount(self):
+        return self._pool.maxThreadCount()
+
+    def submit(self, func, *args, priority=PRIORITY_INTERACTIVE, token=None, **kwargs):
+        #concurrent.futures.Future of func(*args, **kwargs)
+        return self.submitCall(func, args, kwargs, priority, token)
+
+    def submitCall(self, func, args, kwargs, priority=PRIORITY_INTERACTIVE, token=None):
+        task = ExecutorTask(self, func, args, kwargs, token)
+        with self._lock:
+            self._queued.add(task)
+            self.submitted += 1
+            self.maxQueueDepth = max(self.maxQueueDepth, len(self._queued))
+        if token is not None:
+            token.addCallback(task.cancelCallback)
+        #QThreadPool runs higher priorities first
+        self._pool.start(task, PRIORITY_PREFETCH - priority)
+        return task.future
+
+    def _cancel(self, task):
+        if self._pool.tryTake(task):
+            with self._lock:
+                self._queued.discard(task)
+                self.cancelled += 1
+            task.future.cancel()
+
+    def _started(self, task):
+        wait = monotonic() - task.queuedAt
+        with self._lock:
+            self._queued.discard(task)
+            self.maxWait = max(self.maxWait, wait)
+            self.avgWait = self.avgWait * 0.95 + wait * 0.05
+
+    def _finished(self, task, runTime):
+        if task.token is not None:
+            task.token.removeCallback(task.cancelCallback)
+        with self._lock:
+            if task.future.cancelled():
+                self.cancelled += 1
+            else:
+                self.completed += 1
+                self.avgRunTime = self.avgRunTime * 0.95 + runTime * 0.05
+
+    def stats(self):
+        with self._lock:
+            return {'queued': len(self._queued),
+                    'active': self._pool.activeThreadCount(),
+                    'submitted': self.submitted,
+                    'completed': self.completed,
+                    'cancelled': self.cancelled,
+                    'max_queue_depth': self.maxQueueDepth,
+                    'max_wait_ms': self.maxWait * 1000,
+                    'avg_wait_ms': self.avgWait * 1000,
+                    'avg_run_ms': self.avgRunTime * 1000}
+
+    def waitForDone(self, msecs=-1):
+        return self._pool.waitForDone(msecs)
+
 def to_thread(func):
+    #runs the call on the market data executor and returns its future, a priority or token keyword argument of the
+    #call decides its lane and lets it be cancelled while still queued
     def wrapper(*args, **kwargs):
-        class RunnableFunc(QRunnable):
-            def __init__(self, func, *args, **kwargs):
-                QRunnable.__init__(self)
-                self._func = func
-                self._args = args
-                self._kwargs = kwargs
-            
-            def run(self):
-                self._func(*self._args, **self._kwargs)
-
-        runnable = RunnableFunc(func, *args, **kwargs)
-        QThreadPool.globalInstance().start(runnable)
+        return MarketDataExecutor().submitCall(func, args, kwargs, kwargs.get('priority', PRIORITY_INTERACTIVE), kwargs.get('token'))
     return wrapper
@@ -0,0 +1,156 @@
+import threading
+
+from ..config import Config
+from .scheduler import PRIORITY_SCANNER
+
+from PySide2.QtCore import QRunnable, QThreadPool
+
+import logging
+log = logging.getLogger('Market Data')
+
+class BulkRunnable(QRunnable):
+    def __init__(self, func, *args):
+        QRunnable.__init__(self)
+        self._func = func
+        self._args = args
+
+    def run(self):
+        try:
+            self._func(*self._args)
+        except Exception:
+            log.exception('Bulk historical load task failed')
+
+class BulkHistoricalLoad(object):
+    #historical bars for many symbols: cached symbols are answered from the cache, the rest is downloaded from the bulk
+    #provider in batches on a bounded pool and written one batch per transaction. Bar sizes the bulk provider doesn't
+    #have, and symbols it returned nothing for, go through the paced precise provider one symbol at a time.
+    #callback(symbol, barSize, bars, startTime, endTime) fires per symbol as soon as its bars are cached.
+    def __init__(self, marketData, symbols, barSize, startTime, endTime, callback=None, error_callback=None, complete_callback=None):
+        self.marketData = marketData
+        self.symbols = list(dict.fromkeys(symbol.upper() for symbol in symbols))
+        self.barSize = barSize
+        self.dataType = 'bars_'+barSize
+        self.startTime = startTime
+        self.endTime = endTime
+        self.callback = callback
+        self.error_callback = error_callback
+        self.complete_callback = complete_callback
+
+        self.config = Config()
+        self.batchSize = self.config.get_property("bulk_batch_size", 100)
+        self.fallbackToPrecise = self.config.get_property("bulk_fallback_to_precise", True)
+        self._pool = QThreadPool()
+        self._pool.setMaxThreadCount(self.config.get_property("bulk_max_workers", 4))
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+
+        self.total = len(self.symbols)
+        self.cached = 0
+        self.downloaded = 0
+        self.precise = 0
+        self.failed = 0
+        self.batches = 0
+
+    def start(self):
+        self._pool.start(BulkRunnable(self._plan))
+        return self
+
+    def cancel(self):
+        self._cancelled.set()
+        self._pool.clear()
+        self.marketData.cancelHistoricalRequests(self)
+
+    def progress(self):
+        return {'total': self.total,
+                'cached': self.cached,
+                'downloaded': self.downloaded,
+                'precise': self.precise,
+                'failed': self.failed,
+                'batches': self.batches}
+
+    @property
+    def finished(self):
+        return self.cached + self.downloaded + self.precise + self.failed
+
+    def _plan(self):
+        cache = self.marketData._cache
+        missing = []
+        for symbol in self.symbols:
+            if self._cancelled.is_set():
+                return
+            missingStart, missingEnd = cache.getMissingRange(symbol, self.dataType, self.startTime, self.endTime)
+            if missingStart is None:
+                self._deliver(symbol, 'cached')
+            else:
+                missing.append((missingStart, missingEnd, symbol))
+        log.info(f'Bulk {self.barSize} load: {self.cached} of {self.total} symbols cached')
+        if not missing:
+            if not self.total and self.complete_callback is not None:
+                self.complete_callback(self.progress())
+            return
+
+        bulkApi = self.marketData._bulk_api
+        if not bulkApi.supportsBarSize(self.barSize):
+            for _, _, symbol in missing:
+                self._pool.start(BulkRunnable(self._fetch_precise, symbol))
+            return
+        #symbols with similar gaps share a batch, each batch downloads the union of its symbols' gaps
+        missing.sort()
+        for i in range(0, len(missing), self.batchSize):
+            batch = missing[i:i+self.batchSize]
+            batchStart = min(start for start, _, _ in batch)
+            batchEnd = max(end for _, end, _ in batch)
+            self._pool.start(BulkRunnable(self._fetch_batch, [symbol for _, _, symbol in batch], batchStart, batchEnd))
+
+    def _fetch_batch(self, symbols, startTime, endTime):
+        if self._cancelled.is_set():
+            return
+        bulkApi = self.marketData._bulk_api
+        try:
+            frames = bulkApi.downloadHistoricalBars(symbols, self.barSize, startTime, endTime)
+        except Exception:
+            log.exception(f'Bulk download of {len(symbols)} symbols failed')
+            frames = {}
+        self._count('batches')
+        bulkApi.cacheHistoricalBars(frames, self.barSize)
+        for symbol in symbols:
+            if symbol in frames:
+                self._deliver(symbol, 'downloaded')
+            elif self.fallbackToPrecise:
+                self._fetch_precise(symbol)
+            else:
+                self._fail(symbol, -1, f'{bulkApi.name} returned no bars')
+
+    def _fetch_precise(self, symbol):
+        if self._cancelled.is_set():
+            return
+        def callback(symbol, barSize, bars, startTime, endTime):
+            self._count('precise')
+            if self.callback is not None:
+                self.callback(symbol, barSize, bars, startTime, endTime)
+        def error_callback(symbol, barSize, errorCode, errorMsg):
+            #the load still lands and calls back after an error, only report it here
+            if self.error_callback is not None:
+                self.error_callback(symbol, barSize, errorCode, errorMsg)
+        self.marketData.loadHistoricalBars(symbol, self.barSize, self.startTime, self.endTime, callback, error_callback,
+                                            priority=PRIORITY_SCANNER, owner=self)
+
+    def _deliver(self, symbol, counter):
+        if self.callback is not None:
+            bars = self.marketData._cache.getData(symbol, self.dataType, self.startTime, self.endTime)
+            self.callback(symbol, self.barSize, bars, self.startTime, self.endTime)
+        self._count(counter)
+
+    def _fail(self, symbol, errorCode, errorMsg):
+        if self.error_callback is not None:
+            self.error_callback(symbol, self.barSize, errorCode, errorMsg)
+        self._count('failed')
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+            complete = counter != 'batches' and self.finished == self.total
+        if complete:
+            log.info(f'Bulk {self.barSize} load finished: {self.progress()}')
+            if self.complete_callback is not None:
+                self.complete_callback(self.progress())
@@ -1,173 +1,517 @@
 import pandas as pd
+import numpy as np
 
 from ..config import Config
 
 import os
+import re
+import queue
+import threading
+from concurrent.futures import Future
+from functools import cache
+from itertools import repeat
 from sqlalchemy.dialects.sqlite import insert
 import sqlalchemy as sqla
 
-from ..utils import singleton, timer_func
+from ..utils import singleton
 
 import pandas_market_calendars as mcal
 from pandas.tseries.offsets import YearBegin, CustomBusinessDay
 
 from .types import *
+from .memory_cache import BarMemoryCache
+from .coverage import ChunkCoverageIndex
+
+from PySide2.QtCore import QThreadPool
+
+import logging
+log = logging.getLogger('Market Data')
+
+DEFAULT_SQLITE_FILE = "%LOCALAPPDATA%\\StonX\\cache.sqlite"
+
+BAR_COLUMNS = ["open", "high", "low", "close", "volume"]
+BAR_RECORD_DTYPE = np.dtype([('epoch_ns', 'i8')] + [(column, 'f8') for column in BAR_COLUMNS])
+
+#bumped whenever the on-disk layout changes, stored in PRAGMA user_version
+SCHEMA_VERSION = 2
+
+UPSERT_BARS = ('INSERT INTO bars (symbol_id, bar_size, epoch_ns, open, high, low, close, volume) VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (symbol_id, bar_size, epoch_ns) DO UPDATE SET '
+                'open = excluded.open, high = excluded.high, low = excluded.low, close = excluded.close, volume = excluded.volume')
+UPSERT_CHUNKS = ('INSERT INTO chunks (symbol_id, bar_size, chunk_ns, data_source) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (symbol_id, bar_size, chunk_ns) DO UPDATE SET data_source = excluded.data_source')
+
+#matches the old per-symbol tables, e.g. 'SPY_bars_1m' and 'SPY_bars_1m_chunks'
+LEGACY_TABLE_PATTERN = re.compile(r'^(?P<symbol>.+)_(?P<dataType>bars_(?:{}))(?P<chunks>_chunks)?$'.format('|'.join(BAR_SIZES)))
+
+def bar_size_from_data_type(dataType):
+    if dataType.startswith('bars_'):
+        return dataType[len('bars_'):]
+    return dataType
+
+def get_chunk_labels(index, dataType):
+    #start of the day (intraday) or year (daily and above) chunk each timestamp belongs to, in US/Eastern
+    index = index.tz_convert('US/Eastern')
+    if is_intraday(dataType):
+        return index.floor(freq='D')
+    return index.tz_localize(None).to_period('Y').to_timestamp().tz_localize('US/Eastern')
+
+def get_chunk_label(timestamp, dataType):
+    #scalar get_chunk_labels, an order of magnitude cheaper than going through a DatetimeIndex
+    timestamp = timestamp.tz_convert('US/Eastern')
+    if is_intraday(dataType):
+        return timestamp.normalize()
+    return pd.Timestamp(year=timestamp.year, month=1, day=1, tz='US/Eastern')
+
+@cache
+def nyse_business_day():
+    #building the holiday list is slow, so the offset is shared by every chunk calculation
+    return CustomBusinessDay(calendar=mcal.get_calendar('NYSE'))
+
+@cache
+def chunk_calendar(intraday):
+    #epoch ns of every chunk that can exist, NYSE sessions for intraday bars and year starts for everything else
+    if intraday:
+        chunks = pd.date_range('1980-01-01', pd.Timestamp.now() + pd.DateOffset(years=5), freq=nyse_business_day())
+    else:
+        chunks = pd.date_range('1900-01-01', '2100-01-01', freq=YearBegin())
+    return chunks.tz_localize('US/Eastern').asi8
+
+def get_empty_utc_bar_dataframe():
+    dataframe = get_empty_bar_dataframe()
+    dataframe.index = pd.DatetimeIndex([], tz='UTC', name='date')
+    return dataframe
+
+class BaseBarStore(object):
+    name = ''
+    def writeBars(self, symbol, barSize, dataframe):
+        pass
+
+    def readBars(self, symbol, barSize, startTime, endTime):
+        return get_empty_utc_bar_dataframe()
+
+    def writeChunks(self, symbol, barSize, chunkDates, data_source):
+        pass
+
+    def readChunks(self, symbol, barSize, startTime, endTime):
+        return pd.DatetimeIndex([], tz='US/Eastern')
+
+    def writeBulk(self, bars, chunks, backfill=False):
+        for symbol, barSize, dataframe in bars:
+            self.writeBars(symbol, barSize, dataframe)
+        for symbol, barSize, chunkDates, data_source in chunks:
+            self.writeChunks(symbol, barSize, chunkDates, data_source)
+
+class SQLiteBarStore(BaseBarStore):
+    name = 'sqlite'
+    def __init__(self, sqlite_file, poolSize=8):
+        #one pooled connection per worker thread, WAL lets them all read while the writer commits.
+        #Threads beyond the pool (asyncio.to_thread, concurrent bulk loads) open an overflow connection instead of waiting
+        self._db = sqla.create_engine('sqlite:///{}'.format(sqlite_file),
+                                        poolclass=sqla.pool.QueuePool,
+                                        pool_size=poolSize,
+                                        max_overflow=-1,
+                                        pool_timeout=60,
+                                        connect_args={'check_same_thread': False, 'timeout': 30})
+        sqla.event.listen(self._db, 'connect', self._on_connect)
+
+        self._symbolIds = {}
+        self._metadata = sqla.MetaData()
+        self._symbolsTable = sqla.Table('symbols', self._metadata,
+                    sqla.Column('symbol_id', sqla.Integer, primary_key=True),
+                    sqla.Column('symbol', sqla.String, unique=True, nullable=False)
+                    )
+        #WITHOUT ROWID makes the primary key the clustered b-tree holding every column,
+        #so it doubles as a covering index for (symbol_id, bar_size, epoch_ns) range scans
+        self._barsTable = sqla.Table('bars', self._metadata,
+                    sqla.Column('symbol_id', sqla.Integer, primary_key=True, autoincrement=False),
+                    sqla.Column('bar_size', sqla.String, primary_key=True),
+                    sqla.Column('epoch_ns', sqla.BigInteger, primary_key=True, autoincrement=False),
+                    sqla.Column('open', sqla.Float),
+                    sqla.Column('high', sqla.Float),
+                    sqla.Column('low', sqla.Float),
+                    sqla.Column('close', sqla.Float),
+                    sqla.Column('volume', sqla.Float),
+                    sqlite_with_rowid=False
+                    )
+        #chunk_ns is the US/Eastern start of the day or year chunk as UTC epoch nanoseconds
+        self._chunksTable = sqla.Table('chunks', self._metadata,
+                    sqla.Column('symbol_id', sqla.Integer, primary_key=True, autoincrement=False),
+                    sqla.Column('bar_size', sqla.String, primary_key=True),
+                    sqla.Column('chunk_ns', sqla.BigInteger, primary_key=True, autoincrement=False),
+                    sqla.Column('data_source', sqla.String),
+                    sqlite_with_rowid=False
+                    )
+        self._migrate_schema()
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.execute('PRAGMA synchronous = NORMAL')
+        cursor.execute('PRAGMA busy_timeout = 30000')
+        cursor.close()
+
+    def writeBars(self, symbol, barSize, dataframe):
+        self.writeBulk([(symbol, barSize, dataframe)], [])
+
+    def writeBulk(self, bars, chunks, backfill=False):
+        with self._db.connect() as connection:
+            cursor = connection.connection.cursor()
+            if backfill:
+                #a backfill can always be downloaded again, so skip the fsync on commit
+                cursor.execute('PRAGMA synchronous = OFF')
+            created = {}
+            try:
+                with connection.begin():
+                    for symbol, barSize, dataframe in bars:
+                        symbolId = self._get_symbol_id(symbol, connection, created=created)
+                        self._save_bars(symbolId, barSize, dataframe, cursor)
+                    for symbol, barSize, chunkDates, data_source in chunks:
+                        symbolId = self._get_symbol_id(symbol, connection, created=created)
+                        cursor.executemany(UPSERT_CHUNKS, zip(repeat(symbolId), repeat(barSize), chunkDates.asi8.tolist(), repeat(data_source)))
+                #a rolled back insert never reaches the id cache
+                self._symbolIds.update(created)
+            finally:
+                if backfill:
+                    cursor.execute('PRAGMA synchronous = NORMAL')
+                cursor.close()
+
+    def readBars(self, symbol, barSize, startTime, endTime):
+        with self._db.connect() as connection:
+            symbolId = self._get_symbol_id(symbol, connection, create=False)
+            if symbolId is None:
+                return get_empty_utc_bar_dataframe()
+            #plain range on the primary key columns, so SQLite seeks straight to the first row
+            cursor = connection.connection.cursor()
+            rows = cursor.execute('SELECT epoch_ns, open, high, low, close, volume FROM bars '
+                                    'WHERE symbol_id = ? AND bar_size = ? AND epoch_ns BETWEEN ? AND ? '
+                                    'ORDER BY epoch_ns',
+                                    (symbolId, barSize, startTime.value, endTime.value)).fetchall()
+            cursor.close()
+        records = np.array(rows, dtype=BAR_RECORD_DTYPE)
+        dataframe = pd.DataFrame({column: records[column] for column in BAR_COLUMNS},
+                                    index=pd.to_datetime(records['epoch_ns'], unit='ns', utc=True))
+        dataframe.index.name = 'date'
+        return dataframe
+
+    def writeChunks(self, symbol, barSize, chunkDates, data_source):
+        self.writeBulk([], [(symbol, barSize, chunkDates, data_source)])
+
+    def readChunks(self, symbol, barSize, startTime, endTime):
+        with self._db.connect() as connection:
+            symbolId = self._get_symbol_id(symbol, connection, create=False)
+            if symbolId is None:
+                return pd.DatetimeIndex([], tz='US/Eastern')
+            chunkRange = get_chunk_labels(pd.DatetimeIndex([startTime, endTime]), 'bars_'+barSize)
+            cursor = connection.connection.cursor()
+            rows = cursor.execute('SELECT chunk_ns FROM chunks WHERE symbol_id = ? AND bar_size = ? AND chunk_ns BETWEEN ? AND ?',
+                                    (symbolId, barSize, int(chunkRange.asi8[0]), int(chunkRange.asi8[-1]))).fetchall()
+            cursor.close()
+        chunk_ns = np.array([row[0] for row in rows], dtype='i8')
+        return pd.to_datetime(chunk_ns, unit='ns', utc=True).tz_convert('US/Eastern')
+
+    def _get_symbol_id(self, symbol, connection, create=True, created=None):
+        #ids inserted by the caller's transaction go into created, the caller caches them once it commits
+        symbolId = self._symbolIds.get(symbol)
+        if symbolId is None and created is not None:
+            symbolId = created.get(symbol)
+        if symbolId is not None:
+            return symbolId
+        symbols = self._symbolsTable
+        symbolId = connection.execute(sqla.select(symbols.c.symbol_id).where(symbols.c.symbol == symbol)).scalar()
+        if symbolId is None:
+            if not create:
+                return None
+            symbolId = connection.execute(symbols.insert().values(symbol=symbol)).inserted_primary_key[0]
+            if created is not None:
+                created[symbol] = symbolId
+            return symbolId
+        self._symbolIds[symbol] = symbolId
+        return symbolId
+
+    def _save_bars(self, symbolId, barSize, data, cursor):
+        #one prepared statement run over plain python columns, rows arrive in primary key order
+        values = data[BAR_COLUMNS].astype(float)
+        cursor.executemany(UPSERT_BARS, zip(repeat(symbolId), repeat(barSize), data.index.tz_convert('UTC').asi8.tolist(),
+                                            *[values[column].tolist() for column in BAR_COLUMNS]))
+
+    def _migrate_schema(self):
+        with self._db.connect() as connection:
+            version = connection.execute(sqla.text('PRAGMA user_version')).scalar()
+        if version >= SCHEMA_VERSION:
+            self._metadata.create_all(self._db)
+            return
+        log.info(f'Migrating cache schema from version {version} to {SCHEMA_VERSION}')
+        inspector = sqla.inspect(self._db)
+        tableNames = inspector.get_table_names()
+        oldChunks = 'chunks' in tableNames and 'date' in [column['name'] for column in inspector.get_columns('chunks')]
+        with self._db.begin() as connection:
+            if oldChunks:
+                connection.execute(sqla.text('ALTER TABLE chunks RENAME TO chunks_v1'))
+            self._metadata.create_all(connection)
+            if oldChunks:
+                rows = connection.execute(sqla.text('SELECT symbol_id, bar_size, date, data_source FROM chunks_v1')).fetchall()
+                self._insert_text_chunks(connection, [row.symbol_id for row in rows], [row.bar_size for row in rows],
+                                            [row.date for row in rows], [row.data_source for row in rows])
+                connection.execute(sqla.text('DROP TABLE chunks_v1'))
+        self._migrate_legacy_tables(tableNames)
+        with self._db.begin() as connection:
+            connection.execute(sqla.text(f'PRAGMA user_version = {SCHEMA_VERSION}'))
+
+    def _insert_text_chunks(self, connection, symbolIds, barSizes, dates, data_sources):
+        #chunk dates used to be stored as naive US/Eastern date strings
+        if not dates:
+            return
+        chunk_ns = pd.to_datetime(pd.Series(dates)).dt.tz_localize('US/Eastern').dt.tz_convert('UTC').values.astype('i8')
+        chunk_stmt = insert(self._chunksTable).on_conflict_do_nothing()
+        connection.execute(chunk_stmt, [{'symbol_id': symbolId, 'bar_size': barSize, 'chunk_ns': int(ns), 'data_source': data_source}
+                                        for symbolId, barSize, ns, data_source in zip(symbolIds, barSizes, chunk_ns, data_sources)])
+
+    def _migrate_legacy_tables(self, tableNames):
+        legacyTables = []
+        for tableName in tableNames:
+            match = LEGACY_TABLE_PATTERN.match(tableName)
+            if match:
+                legacyTables.append((tableName, match.group('symbol'), match.group('dataType'), bool(match.group('chunks'))))
+        if not legacyTables:
+            return
+        log.info(f'Migrating {len(legacyTables)} legacy cache tables')
+        for tableName, symbol, dataType, isChunkTable in legacyTables:
+            created = {}
+            with self._db.begin() as connection:
+                symbolId = self._get_symbol_id(symbol, connection, created=created)
+                if isChunkTable:
+                    rows = connection.execute(sqla.text(f'SELECT date, data_source FROM "{tableName}"')).fetchall()
+                    self._insert_text_chunks(connection, [symbolId]*len(rows), [bar_size_from_data_type(dataType)]*len(rows),
+                                                [row.date for row in rows], [row.data_source for row in rows])
+                else:
+                    rows = connection.execute(sqla.text(f'SELECT date, open, high, low, close, volume FROM "{tableName}"')).fetchall()
+                    if rows:
+                        data = pd.DataFrame.from_records(rows, columns=['date']+BAR_COLUMNS, index='date')
+                        data.index = pd.to_datetime(data.index, utc=True)
+                        data = data[~data.index.isna()]
+                        #always into the plain bars table, subclass storage may not exist yet while the base class migrates
+                        SQLiteBarStore._save_bars(self, symbolId, bar_size_from_data_type(dataType), data, connection.connection.cursor())
+                connection.execute(sqla.text(f'DROP TABLE "{tableName}"'))
+            self._symbolIds.update(created)
+
+class CacheWriter(threading.Thread):
+    #the only thread writing to the store, writes queued while a transaction runs are merged into the next one
+    MAX_BATCH = 64
+    def __init__(self, store, onWritten=None):
+        threading.Thread.__init__(self, name='MarketDataCacheWriter', daemon=True)
+        self._store = store
+        self._onWritten = onWritten
+        self._queue = queue.Queue()
+        self.batches = 0
+        self.writes = 0
+        self.start()
+
+    def submit(self, bars, chunks, backfill=False, written=()):
+        future = Future()
+        self._queue.put((bars, chunks, backfill, written, future))
+        return future
+
+    def flush(self):
+        self.submit([], []).result()
+
+    def stop(self):
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.MAX_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = None in batch
+            batch = [write for write in batch if write is not None]
+            if batch:
+                try:
+                    self._write(batch)
+                    results = [(write, None) for write in batch]
+                except Exception:
+                    #don't let one bad frame fail everything it was batched with
+                    results = []
+                    for write in batch:
+                        try:
+                            self._write([write])
+                            results.append((write, None))
+                        except Exception as e:
+                            log.error(f'Cache write failed: {e}')
+                            results.append((write, e))
+                #futures are only resolved once everything in the batch is committed
+                for write, error in results:
+                    self._complete(write, error)
+            if stopping:
+                return
+
+    def _write(self, batch):
+        bars = [item for write in batch for item in write[0]]
+        chunks = [item for write in batch for item in write[1]]
+        if bars or chunks:
+            self._store.writeBulk(bars, chunks, all(write[2] for write in batch))
+        self.batches += 1
+        self.writes += len(batch)
+
+    def _complete(self, write, error):
+        future = write[-1]
+        if error is None and self._onWritten:
+            try:
+                self._onWritten(write[3])
+            except Exception as e:
+                #the bars are committed, a failed notification must not fail the write or stop the writer
+                log.error(f'Cache write notification failed: {e}')
+        if not future.done():
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
 
 @singleton
 class MarketDataCache(object):
-    SQLITE_FILE = "%LOCALAPPDATA%\\StonX\\cache.sqlite"
+    SQLITE_FILE = DEFAULT_SQLITE_FILE
+    PARQUET_FOLDER = "%LOCALAPPDATA%\\StonX\\bars"
     def __init__(self):
-        self._db = sqla.create_engine('sqlite:///{}'.format(os.path.expandvars(self.SQLITE_FILE)))
         self.config = Config()
         self.twsTimezone = self.config.get_property("timezone_tws", "US/Pacific")
 
-    @timer_func
-    def addData(self, symbol, dataType, dataframe, data_source):
-        with self._db.connect() as connection:
-            chunk_size = 2000
-            for start in range(0, dataframe.shape[0], chunk_size):
-                df_subset = dataframe.iloc[start:start + chunk_size]
-                self._save_sql(symbol, dataType, df_subset, connection)
-            chunks = self._get_chunks_for_range(dataframe.index[0], dataframe.index[-1], dataType)
-            self._add_chunks(symbol, dataType, chunks, data_source, connection)
-
-    @timer_func
-    def _add_chunks(self, symbol, dataType, chunkDates, data_source, connection):
-        chunk_db_name = f'{symbol}_{dataType}_chunks'
-        if not sqla.inspect(self._db).has_table(chunk_db_name):
-            self._create_table_chunks(symbol, dataType)
+        backend = self.config.get_property("cache_backend", SQLiteBarStore.name)
+        if backend == 'parquet':
+            from .parquet_cache import ParquetBarStore
+            self._store = ParquetBarStore(os.path.expandvars(self.PARQUET_FOLDER))
+        else:
+            #a connection for each thread of the pools that read the cache: Qt's global pool, the market data executor,
+            #a bulk load's workers, the prefetcher and the writer
+            poolSize = self.config.get_property("cache_pool_size", QThreadPool.globalInstance().maxThreadCount()
+                                                    + self.config.get_property("market_data_threads", 4)
+                                                    + self.config.get_property("bulk_max_workers", 4) + 2)
+            if self.config.get_property("cache_compression", False):
+                from .compressed_cache import CompressedSQLiteBarStore
+                self._store = CompressedSQLiteBarStore(os.path.expandvars(self.SQLITE_FILE), poolSize)
+            else:
+                self._store = SQLiteBarStore(os.path.expandvars(self.SQLITE_FILE), poolSize)
+
+        self._memory = BarMemoryCache(int(self.config.get_property("memory_cache_mb", 256) * 1024 * 1024))
+        self._coverage = ChunkCoverageIndex(lambda dataType: chunk_calendar(is_intraday(dataType)), self._load_coverage)
+        self._writer = CacheWriter(self._store, self._on_written)
+
+    def addData(self, symbol, dataType, dataframe, data_source, wait=True):
+        return self.addBulkData([(symbol, dataType, dataframe)], data_source, backfill=False, wait=wait)
+
+    def addBulkData(self, dataItems, data_source, backfill=True, wait=True):
+        #dataItems is an iterable of (symbol, dataType, dataframe), written in a single transaction by the writer thread.
+        #Returns the write's future, with wait=True it has already completed and reads will see the new bars.
+        bars = []
+        chunks = []
+        written = []
+        for symbol, dataType, dataframe in dataItems:
+            if dataframe is None or dataframe.empty:
+                continue
+            barSize = bar_size_from_data_type(dataType)
+            bars.append((symbol, barSize, dataframe))
+            chunkDates = self._completed_chunks(self._get_chunks_for_range(dataframe.index[0], dataframe.index[-1], dataType))
+            if not chunkDates.empty:
+                chunks.append((symbol, barSize, chunkDates, data_source))
+            written.append((symbol, dataType, get_chunk_labels(dataframe.index, dataType).unique().asi8, chunkDates.asi8))
+        future = self._writer.submit(bars, chunks, backfill, written)
+        if wait:
+            future.result()
+        return future
+
+    def flush(self):
+        self._writer.flush()
+
+    def _on_written(self, written):
+        for symbol, dataType, chunk_ns, completed_ns in written:
+            self._memory.invalidate(symbol, dataType, chunk_ns)
+            if len(completed_ns):
+                self._coverage.add(symbol, dataType, completed_ns)
+
+    def _load_coverage(self, symbol, dataType, calendar):
+        startTime = pd.Timestamp(calendar[0], tz='US/Eastern')
+        endTime = pd.Timestamp(calendar[-1], tz='US/Eastern')
+        return self._store.readChunks(symbol, bar_size_from_data_type(dataType), startTime, endTime).asi8
+
+    def _completed_chunks(self, chunkDates):
         chunkDates = chunkDates.tz_convert('US/Eastern')
 
         #don't mark today as cached
         now = pd.Timestamp.now(tz='US/Eastern')
-        chunkDates = chunkDates[now - chunkDates >= pd.Timedelta('1d')]
-        if chunkDates.empty:
-            return
-
-        metadata = sqla.MetaData()
-        chunk_table = sqla.Table(chunk_db_name, metadata, autoload_with=self._db)
-        chunk_stmt = insert(chunk_table).values([{'date': date, 'data_source': data_source} for date in chunkDates.tolist()])
-        chunk_stmt = chunk_stmt.on_conflict_do_update(
-            index_elements=['date'],
-            set_=dict(data_source=data_source)
-            )
-        connection.execute(chunk_stmt)
+        return chunkDates[now - chunkDates >= pd.Timedelta('1d')]
 
-    @timer_func
     def getData(self, symbol, dataType, startTime, endTime):
-        with self._db.connect() as connection:
-            db_name = f'{symbol}_{dataType}'
-            if not sqla.inspect(self._db).has_table(db_name):
-                self._create_table(symbol, dataType)
-                return None
-            startTime = startTime.tz_convert('UTC')
-            endTime = endTime.tz_convert('UTC')
-            dataframe = pd.read_sql(f"SELECT * FROM {db_name} WHERE datetime(date) BETWEEN '{startTime.strftime('%Y-%m-%d %X')}' AND '{endTime.strftime('%Y-%m-%d %X')}'",
-                                    connection.connection,
-                                    index_col='date',
-                                    parse_dates={'date': {'errors': 'ignore',
-                                                            'infer_datetime_format': True,
-                                                            'utc' : True
-                                                            }})
-            dataframe.index = dataframe.index.tz_convert(self.twsTimezone)
-            return dataframe
+        chunks = self._get_chunks_for_range(startTime, endTime, dataType)
+        if chunks.empty:
+            return self._read_store(symbol, dataType, startTime, endTime)
+
+        blocks = {}
+        missing = []
+        for chunk_ns in chunks.asi8:
+            block = self._memory.get((symbol, dataType, chunk_ns))
+            if block is None:
+                missing.append(chunk_ns)
+            else:
+                blocks[chunk_ns] = block
+
+        if missing:
+            #one store read covering every missing chunk, split back into per chunk blocks
+            generation = self._memory.generation(symbol, dataType)
+            loadStart = pd.Timestamp(missing[0], tz='UTC')
+            loadEnd = self._chunk_end(pd.Timestamp(missing[-1], tz='UTC').tz_convert('US/Eastern'), dataType)
+            loaded = self._read_store(symbol, dataType, loadStart, loadEnd - pd.Timedelta(1, unit='ns'))
+            labels, starts = np.unique(get_chunk_labels(loaded.index, dataType).asi8, return_index=True)
+            stops = np.append(starts[1:], len(loaded))
+            loadedBlocks = dict(zip(labels.tolist(), zip(starts, stops)))
+            for chunk_ns in missing:
+                if chunk_ns in loadedBlocks:
+                    start, stop = loadedBlocks[chunk_ns]
+                    block = loaded.iloc[start:stop].copy()
+                else:
+                    block = loaded.iloc[0:0]
+                self._memory.put((symbol, dataType, chunk_ns), block, generation)
+                blocks[chunk_ns] = block
+
+        dataframe = pd.concat([blocks[chunk_ns] for chunk_ns in chunks.asi8])
+        return dataframe.iloc[dataframe.index.searchsorted(startTime):dataframe.index.searchsorted(endTime, side='right')]
+
+    def memoryCacheStats(self):
+        return self._memory.stats()
+
+    def _read_store(self, symbol, dataType, startTime, endTime):
+        dataframe = self._store.readBars(symbol, bar_size_from_data_type(dataType), startTime, endTime)
+        dataframe.index = dataframe.index.tz_convert(self.twsTimezone)
+        return dataframe
+
+    def _chunk_end(self, chunk, dataType):
+        if is_intraday(dataType):
+            return (chunk.tz_localize(None) + pd.Timedelta('1d')).tz_localize('US/Eastern')
+        return chunk + YearBegin()
+
+    def getMissingRanges(self, symbol, dataType, startTime, endTime):
+        #every run of uncached chunks between startTime and endTime, as (start, end) in the TWS timezone
+        missingRanges = []
+        startLabel = get_chunk_label(startTime, dataType).value
+        endLabel = get_chunk_label(endTime, dataType).value
+        for first_ns, last_ns in self._coverage.missing(symbol, dataType, startLabel, endLabel):
+            first = pd.Timestamp(first_ns, tz='US/Eastern')
+            last = pd.Timestamp(last_ns, tz='US/Eastern')
+            missingRanges.append((first.tz_convert(self.twsTimezone), self._chunk_end(last, dataType).tz_convert(self.twsTimezone)))
+        log.debug(f'MISSING RANGES: {missingRanges}')
+        return missingRanges
 
     def getMissingRange(self, symbol, dataType, startTime, endTime):
-        db_name = f'{symbol}_{dataType}_chunks'
-        chunks = self._get_chunks_for_range(startTime, endTime, dataType)
-        end_offset = pd.Timedelta('1d') if is_intraday(dataType) else YearBegin()
+        missingRanges = self.getMissingRanges(symbol, dataType, startTime, endTime)
+        if not missingRanges:
+            return None, None
+        return missingRanges[0][0], missingRanges[-1][1]
 
-        if not sqla.inspect(self._db).has_table(db_name):
-            self._create_table_chunks(symbol, dataType)
-            return chunks[0], chunks[-1] + end_offset
-        print(f"SELECT * FROM {db_name} WHERE datetime(date) BETWEEN '{startTime.strftime('%Y-%m-%d')}' AND '{endTime.strftime('%Y-%m-%d')}'")
-        with self._db.connect() as connection:
-            existing_chunks = pd.read_sql(f"SELECT * FROM {db_name} WHERE datetime(date) BETWEEN '{startTime.strftime('%Y-%m-%d')}' AND '{endTime.strftime('%Y-%m-%d')}'",
-                                            connection.connection,
-                                            index_col='date',
-                                            parse_dates={'date': {'errors': 'ignore',
-                                                            'infer_datetime_format': True,
-                                                            'utc' : False
-                                                            }}
-                                            )
-            existing_chunks.index = existing_chunks.index.tz_localize('US/Eastern')
-            print('EXISTING CHUNKS: ', existing_chunks.index)
-            missing_chunks = chunks.difference(existing_chunks.index)
-            print('MISSING CHUNKS: ', missing_chunks)
-            if missing_chunks.empty:
-                return None, None
-            missing_chunks = missing_chunks.tz_convert(self.twsTimezone)
-            return missing_chunks[0], missing_chunks[-1] + end_offset
-
-    @timer_func
     def _get_chunks_for_range(self, startTime, endTime, dataType):
-        if is_intraday(dataType):
-            calendar = mcal.get_calendar('NYSE')
-            bDay = CustomBusinessDay(calendar=calendar)
-            startTime = startTime.tz_convert('US/Eastern').floor(freq='D')
-            endTime = endTime.tz_convert('US/Eastern').floor(freq='D')
-            chunks = pd.date_range(startTime, endTime, freq=bDay)
-        else:
-            yearOffset = YearBegin()
-            startTime = yearOffset.rollback(startTime.tz_convert('US/Eastern'))
-            endTime = yearOffset.rollback(endTime.tz_convert('US/Eastern'))
-            chunks = pd.date_range(startTime, endTime, freq=yearOffset)
-        return chunks
-
-    def _create_table(self, symbol, dataType):
-        db_name = f'{symbol}_{dataType}'
-        metadata_obj = sqla.MetaData(info={'timezone':self.twsTimezone})
-        table = sqla.Table(db_name, metadata_obj,
-                    sqla.Column('date', sqla.DateTime, index=True, unique=True),
-                    sqla.Column('open', sqla.Float),
-                    sqla.Column('high', sqla.Float),
-                    sqla.Column('low', sqla.Float),
-                    sqla.Column('close', sqla.Float),
-                    sqla.Column('volume', sqla.Float)
-                    )
-        table.create(self._db)
-    
-    def _create_table_chunks(self, symbol, dataType):
-        db_name = f'{symbol}_{dataType}_chunks'
-        metadata_obj = sqla.MetaData()
-        table = sqla.Table(db_name, metadata_obj,
-                    sqla.Column('date', sqla.DateTime, index=True, unique=True),
-                    sqla.Column('data_source', sqla.String)
-                    )
-        table.create(self._db)
-
-    def _sql_insert_on_duplicate(self, table, conn, keys, data_iter):
-        insert_statement = insert(table.table).values(list(data_iter))
-        on_conflict_statement = insert_statement.on_conflict_do_update(
-            index_elements=['date'],
-            set_=dict(
-                    open=insert_statement.excluded.open,
-                    high=insert_statement.excluded.high,
-                    low=insert_statement.excluded.low,
-                    close=insert_statement.excluded.close,
-                    volume=insert_statement.excluded.volume
-                )
-            )
-        conn.execute(on_conflict_statement)
-
-    def _sql_insert_on_duplicate_chunk(self, table, conn, keys, data_iter):
-        insert_statement = insert(table.table).values(list(data_iter))
-        on_conflict_statement = insert_statement.on_conflict_do_update(
-            index_elements=['date'],
-            set_=dict(
-                    data_source=insert_statement.excluded.data_source
-                )
-            )
-        conn.execute(on_conflict_statement)
-
-    @timer_func
-    def _save_sql(self, symbol, dataType, data, connection):
-        data = data.copy()
-        db_name = f'{symbol}_{dataType}'
-        if not sqla.inspect(self._db).has_table(db_name):
-            self._create_table(symbol, dataType)
-        data.index = data.index.tz_convert('UTC')
-        data.to_sql(db_name, connection,
-                    index_label='date',
-                    if_exists='append',
-                    method=self._sql_insert_on_duplicate)
+        calendar = chunk_calendar(is_intraday(dataType))
+        startLabel = get_chunk_label(startTime, dataType).value
+        endLabel = get_chunk_label(endTime, dataType).value
+        chunks = calendar[np.searchsorted(calendar, startLabel):np.searchsorted(calendar, endLabel, side='right')]
+        return pd.to_datetime(chunks, utc=True).tz_convert('US/Eastern')
@@ -0,0 +1,202 @@
+import pandas as pd
+import numpy as np
+import sqlalchemy as sqla
+
+import zlib
+
+from .cache import SQLiteBarStore, DEFAULT_SQLITE_FILE, BAR_COLUMNS, get_chunk_labels, get_empty_utc_bar_dataframe
+
+#optional dependency (pip install zstandard), blocks are written with zlib without it and zstd blocks can't be read
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import logging
+log = logging.getLogger('Market Data')
+
+PRICE_COLUMNS = ["open", "high", "low", "close"]
+#prices are stored as integer ticks of 10^-price_scale, the smallest scale that represents every price in the block exactly
+PRICE_SCALES = range(2, 7)
+INT32_MAX = np.iinfo(np.int32).max
+
+UPSERT_BLOCK = ('INSERT INTO bar_blocks (symbol_id, bar_size, chunk_ns, rows, price_scale, price_base, volume_int, codec, data) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (symbol_id, bar_size, chunk_ns) DO UPDATE SET rows = excluded.rows, price_scale = excluded.price_scale, '
+                'price_base = excluded.price_base, volume_int = excluded.volume_int, codec = excluded.codec, data = excluded.data')
+
+def compress(data):
+    if zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=9).compress(data)
+    return 'zlib', zlib.compress(data, 6)
+
+def decompress(codec, data):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('Cache block is zstd compressed but the zstandard module is not installed')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+def price_ticks(prices):
+    #(scale, int64 ticks) for the first scale that is exact, (None, None) if the prices need to stay floats
+    if not np.isfinite(prices).all():
+        return None, None
+    for scale in PRICE_SCALES:
+        scaled = prices * 10**scale
+        ticks = np.rint(scaled)
+        if np.abs(scaled - ticks).max(initial=0) < 1e-6:
+            return scale, ticks.astype(np.int64)
+    return None, None
+
+def encode_block(dataframe):
+    #epoch deltas, close as int32 tick deltas from a per-block base, open/high/low as int32 offsets from their close
+    epoch_ns = dataframe.index.asi8
+    prices = dataframe[PRICE_COLUMNS].to_numpy(dtype=float)
+    volume = dataframe['volume'].to_numpy(dtype=float)
+    parts = [np.diff(epoch_ns, prepend=0).astype(np.int64)]
+
+    scale, ticks = price_ticks(prices)
+    base = None
+    if scale is not None:
+        close = ticks[:, 3]
+        base = int(close[0])
+        closeDeltas = np.diff(close, prepend=base)
+        offsets = ticks[:, :3] - close[:, None]
+        if max(np.abs(closeDeltas).max(initial=0), np.abs(offsets).max(initial=0)) > INT32_MAX:
+            scale = base = None
+        else:
+            parts += [closeDeltas.astype(np.int32), offsets.T.astype(np.int32)]
+    if scale is None:
+        parts.append(prices.T.copy())
+
+    volumeInt = bool(np.isfinite(volume).all() and (volume == np.round(volume)).all())
+    parts.append(volume.astype(np.int64) if volumeInt else volume)
+    codec, data = compress(b''.join(np.ascontiguousarray(part).tobytes() for part in parts))
+    return len(epoch_ns), scale, base, volumeInt, codec, data
+
+def decode_block(rows, scale, base, volumeInt, codec, data):
+    raw = decompress(codec, data)
+    position = 0
+    def take(dtype, count):
+        nonlocal position
+        array = np.frombuffer(raw, dtype=dtype, count=count, offset=position)
+        position += array.nbytes
+        return array
+
+    epoch_ns = np.cumsum(take(np.int64, rows))
+    if scale is None:
+        prices = take(np.float64, 4 * rows).reshape(4, rows)
+    else:
+        close = base + np.cumsum(take(np.int32, rows), dtype=np.int64)
+        offsets = take(np.int32, 3 * rows).reshape(3, rows)
+        prices = np.vstack([offsets + close, close[None, :]]) / 10**scale
+    volume = take(np.int64 if volumeInt else np.float64, rows).astype(float)
+
+    columns = dict(zip(PRICE_COLUMNS, prices))
+    columns['volume'] = volume
+    return pd.DataFrame(columns, index=pd.to_datetime(epoch_ns, unit='ns', utc=True))
+
+class CompressedSQLiteBarStore(SQLiteBarStore):
+    #bars stored as one compressed block per symbol/bar size/chunk, rows left in the plain bars table are still read
+    name = 'sqlite_compressed'
+    def __init__(self, sqlite_file, poolSize=8):
+        SQLiteBarStore.__init__(self, sqlite_file, poolSize)
+        self._blocksTable = sqla.Table('bar_blocks', self._metadata,
+                    sqla.Column('symbol_id', sqla.Integer, primary_key=True, autoincrement=False),
+                    sqla.Column('bar_size', sqla.String, primary_key=True),
+                    sqla.Column('chunk_ns', sqla.BigInteger, primary_key=True, autoincrement=False),
+                    sqla.Column('rows', sqla.Integer),
+                    sqla.Column('price_scale', sqla.Integer),
+                    sqla.Column('price_base', sqla.BigInteger),
+                    sqla.Column('volume_int', sqla.Boolean),
+                    sqla.Column('codec', sqla.String),
+                    sqla.Column('data', sqla.LargeBinary),
+                    sqlite_with_rowid=False
+                    )
+        self._blocksTable.create(self._db, checkfirst=True)
+        if zstandard is None:
+            log.info('zstandard is not installed, new cache blocks are compressed with zlib')
+
+    def readBars(self, symbol, barSize, startTime, endTime):
+        with self._db.connect() as connection:
+            symbolId = self._get_symbol_id(symbol, connection, create=False)
+            if symbolId is None:
+                return get_empty_utc_bar_dataframe()
+            cursor = connection.connection.cursor()
+            blocks = self._read_blocks(cursor, symbolId, barSize, startTime, endTime)
+            cursor.close()
+        rows = SQLiteBarStore.readBars(self, symbol, barSize, startTime, endTime)
+        if not blocks:
+            return rows
+        dataframe = pd.concat(blocks)
+        if not rows.empty:
+            dataframe = dataframe.combine_first(rows)
+        dataframe = dataframe.iloc[dataframe.index.searchsorted(startTime):dataframe.index.searchsorted(endTime, side='right')]
+        dataframe.index.name = 'date'
+        return dataframe
+
+    def _read_blocks(self, cursor, symbolId, barSize, startTime, endTime):
+        chunkRange = get_chunk_labels(pd.DatetimeIndex([startTime, endTime]), 'bars_'+barSize).asi8
+        rows = cursor.execute('SELECT rows, price_scale, price_base, volume_int, codec, data FROM bar_blocks '
+                                'WHERE symbol_id = ? AND bar_size = ? AND chunk_ns BETWEEN ? AND ? ORDER BY chunk_ns',
+                                (symbolId, barSize, int(chunkRange[0]), int(chunkRange[-1]))).fetchall()
+        return [decode_block(*row) for row in rows]
+
+    def _save_bars(self, symbolId, barSize, data, cursor, keepExisting=False):
+        #blocks are rewritten whole, so new bars are merged over whatever the block already holds
+        data = data[BAR_COLUMNS].astype(float)
+        data.index = data.index.tz_convert('UTC')
+        data = data[~data.index.duplicated(keep='last')].sort_index()
+        if data.empty:
+            return
+        labels = get_chunk_labels(data.index, 'bars_'+barSize)
+        existing = self._read_blocks(cursor, symbolId, barSize, data.index[0], data.index[-1])
+        if existing:
+            existing = pd.concat(existing)
+            existingLabels = get_chunk_labels(existing.index, 'bars_'+barSize)
+        values = []
+        for label, chunk in data.groupby(labels):
+            if len(existing):
+                existingChunk = existing[existingLabels == label]
+                chunk = existingChunk.combine_first(chunk) if keepExisting else chunk.combine_first(existingChunk)
+            values.append((symbolId, barSize, label.value) + encode_block(chunk))
+        cursor.executemany(UPSERT_BLOCK, values)
+
+    def compact(self, uncompress=False):
+        #moves plain rows into compressed blocks, or blocks back into rows if compression is being switched off
+        with self._db.connect() as connection:
+            keys = connection.execute(sqla.text('SELECT DISTINCT symbol_id, bar_size FROM {}'.format('bar_blocks' if uncompress else 'bars'))).fetchall()
+        for symbolId, barSize in keys:
+            with self._db.begin() as connection:
+                cursor = connection.connection.cursor()
+                if uncompress:
+                    rows = cursor.execute('SELECT rows, price_scale, price_base, volume_int, codec, data FROM bar_blocks '
+                                            'WHERE symbol_id = ? AND bar_size = ?', (symbolId, barSize)).fetchall()
+                    if rows:
+                        SQLiteBarStore._save_bars(self, symbolId, barSize, pd.concat([decode_block(*row) for row in rows]), cursor)
+                    cursor.execute('DELETE FROM bar_blocks WHERE symbol_id = ? AND bar_size = ?', (symbolId, barSize))
+                else:
+                    rows = cursor.execute('SELECT epoch_ns, open, high, low, close, volume FROM bars '
+                                            'WHERE symbol_id = ? AND bar_size = ? ORDER BY epoch_ns', (symbolId, barSize)).fetchall()
+                    if rows:
+                        data = pd.DataFrame.from_records(rows, columns=['epoch_ns']+BAR_COLUMNS)
+                        data.index = pd.to_datetime(data.pop('epoch_ns'), unit='ns', utc=True)
+                        #plain rows are older than any block written since compression was switched on
+                        self._save_bars(symbolId, barSize, data, cursor, keepExisting=True)
+                    cursor.execute('DELETE FROM bars WHERE symbol_id = ? AND bar_size = ?', (symbolId, barSize))
+                cursor.close()
+            log.info(f'Compacted symbol {symbolId} {barSize}: {len(rows)} {"blocks" if uncompress else "rows"}')
+        with self._db.connect() as connection:
+            connection.execute(sqla.text('PRAGMA wal_checkpoint(TRUNCATE)'))
+            connection.execute(sqla.text('VACUUM'))
+
+def main():
+    #rewrites the cache file in place, run with: python -m stonks.market_data.compressed_cache [--uncompress]
+    import os
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    store = CompressedSQLiteBarStore(os.path.expandvars(DEFAULT_SQLITE_FILE))
+    store.compact(uncompress='--uncompress' in sys.argv[1:])
+
+if __name__ == "__main__":
+    main()
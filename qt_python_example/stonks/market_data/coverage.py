@@ -0,0 +1,92 @@
+import numpy as np
+
+import threading
+
+import logging
+log = logging.getLogger('Market Data')
+
+class ChunkCoverage(object):
+    #cached chunks of one symbol/bar size, kept as merged [start, stop) runs of positions in a sorted chunk calendar
+    def __init__(self, calendar, chunk_ns=()):
+        self.calendar = calendar
+        self._runs = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        self.add(chunk_ns)
+
+    def add(self, chunk_ns):
+        chunk_ns = np.asarray(chunk_ns, dtype=np.int64)
+        positions = np.searchsorted(self.calendar, chunk_ns)
+        valid = positions < len(self.calendar)
+        positions = positions[valid]
+        #chunks that aren't sessions in the calendar can never be asked for, leave them out
+        positions = np.unique(positions[self.calendar[positions] == chunk_ns[valid]])
+        if positions.size == 0:
+            return
+        breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+        starts = positions[np.r_[0, breaks]]
+        stops = positions[np.r_[breaks - 1, -1]] + 1
+
+        currentStarts, currentStops = self._runs
+        starts = np.concatenate([currentStarts, starts])
+        stops = np.concatenate([currentStops, stops])
+        order = np.argsort(starts, kind='stable')
+        starts, stops = starts[order], np.maximum.accumulate(stops[order])
+        #a run starts wherever there's a gap after everything before it
+        newRun = np.r_[True, starts[1:] > stops[:-1]]
+        runStarts = np.flatnonzero(newRun)
+        self._runs = (starts[runStarts], stops[np.r_[runStarts[1:] - 1, -1]])
+
+    def missing(self, first, stop):
+        #[start, stop) position ranges within [first, stop) not covered by any run
+        starts, stops = self._runs
+        i = np.searchsorted(stops, first, side='right')
+        j = np.searchsorted(starts, stop, side='left')
+        gaps = []
+        cursor = first
+        for runStart, runStop in zip(starts[i:j].tolist(), stops[i:j].tolist()):
+            if runStart > cursor:
+                gaps.append((cursor, runStart))
+            cursor = max(cursor, runStop)
+        if cursor < stop:
+            gaps.append((cursor, stop))
+        return gaps
+
+    def runs(self):
+        return len(self._runs[0])
+
+class ChunkCoverageIndex(object):
+    #ChunkCoverage per (symbol, dataType), loaded from the store the first time it's asked for
+    def __init__(self, calendarFactory, loader):
+        self._calendarFactory = calendarFactory
+        self._loader = loader
+        self._coverage = {}
+        self._lock = threading.Lock()
+
+    def get(self, symbol, dataType):
+        key = (symbol, dataType)
+        coverage = self._coverage.get(key)
+        if coverage is None:
+            with self._lock:
+                coverage = self._coverage.get(key)
+                if coverage is None:
+                    calendar = self._calendarFactory(dataType)
+                    coverage = ChunkCoverage(calendar, self._loader(symbol, dataType, calendar))
+                    log.debug(f'Loaded chunk coverage for {symbol} {dataType}: {coverage.runs()} runs')
+                    self._coverage[key] = coverage
+        return coverage
+
+    def add(self, symbol, dataType, chunk_ns):
+        coverage = self.get(symbol, dataType)
+        with self._lock:
+            coverage.add(chunk_ns)
+
+    def missing(self, symbol, dataType, startChunk_ns, endChunk_ns):
+        #(first missing chunk, last missing chunk) epoch ns pairs for every hole between the two chunks, inclusive
+        coverage = self.get(symbol, dataType)
+        calendar = coverage.calendar
+        first = np.searchsorted(calendar, startChunk_ns, side='left')
+        stop = np.searchsorted(calendar, endChunk_ns, side='right')
+        return [(calendar[a], calendar[b-1]) for a, b in coverage.missing(first, stop)]
+
+    def clear(self):
+        with self._lock:
+            self._coverage.clear()
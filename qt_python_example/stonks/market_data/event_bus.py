@@ -0,0 +1,98 @@
+from collections import deque
+from time import monotonic
+
+from ..config import Config
+
+from PySide2.QtCore import QObject, QTimer, Signal
+
+import logging
+log = logging.getLogger('Market Data')
+
+class EventBus(QObject):
+    #IBKR reader thread posts raw messages into per-request queues, the GUI thread drains them once per frame.
+    #Consecutive messages with the same coalesce key are delivered as one, the last one or merge(previous, payload).
+    metricsUpdated = Signal(dict)
+    def __init__(self, parent=None):
+        QObject.__init__(self, parent)
+        self.config = Config()
+        self.queueSize = self.config.get_property("event_bus_queue_size", 10000)
+        self._handlers = {}
+        self._queues = {}
+
+        self.posted = 0
+        self.delivered = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.maxLatency = 0.0
+        self.avgLatency = 0.0
+        self._lastMetrics = monotonic()
+
+        self._timer = QTimer(self)
+        self._timer.setInterval(int(1000 / self.config.get_property("event_bus_hz", 60)))
+        self._timer.timeout.connect(self.drain)
+        self._timer.start()
+
+    def register(self, kind, handler, coalesceKey=None, merge=None):
+        #coalesceKey(payload) -> key, None keeps only the latest message per request and frame
+        self._handlers[kind] = (handler, coalesceKey or (lambda payload: None), merge)
+
+    def post(self, kind, reqId, payload):
+        #reader thread, deque appends are atomic so no lock is needed
+        queue = self._queues.get((kind, reqId))
+        if queue is None:
+            queue = self._queues.setdefault((kind, reqId), deque(maxlen=self.queueSize))
+        if len(queue) == self.queueSize:
+            self.dropped += 1
+        queue.append((monotonic(), payload))
+        self.posted += 1
+
+    def discard(self, reqId):
+        for key in list(self._queues):
+            if key[1] == reqId:
+                self._queues.pop(key, None)
+
+    def drain(self):
+        now = monotonic()
+        for (kind, reqId), queue in list(self._queues.items()):
+            count = len(queue)
+            if not count:
+                continue
+            handler, coalesceKey, merge = self._handlers[kind]
+            messages = [queue.popleft() for _ in range(count)]
+            latency = now - messages[0][0]
+            self.maxLatency = max(self.maxLatency, latency)
+            self.avgLatency = self.avgLatency * 0.95 + latency * 0.05
+
+            deliveries = []
+            lastKey = object()
+            for postTime, payload in messages:
+                key = coalesceKey(payload)
+                if deliveries and key == lastKey:
+                    deliveries[-1] = merge(deliveries[-1], payload) if merge else payload
+                    self.coalesced += 1
+                else:
+                    deliveries.append(payload)
+                lastKey = key
+            for payload in deliveries:
+                try:
+                    handler(*payload)
+                except Exception:
+                    log.exception(f'Event bus handler for {kind} failed')
+            self.delivered += len(deliveries)
+
+        if now - self._lastMetrics >= 1.0:
+            self._lastMetrics = now
+            self.metricsUpdated.emit(self.stats())
+            self.maxLatency = 0.0
+
+    def stats(self):
+        return {'posted': self.posted,
+                'delivered': self.delivered,
+                'coalesced': self.coalesced,
+                'dropped': self.dropped,
+                'queues': len(self._queues),
+                'max_latency_ms': self.maxLatency * 1000,
+                'avg_latency_ms': self.avgLatency * 1000}
+
+    def stop(self):
+        self._timer.stop()
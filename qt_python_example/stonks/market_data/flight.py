@@ -0,0 +1,101 @@
+import threading
+from time import monotonic
+
+import logging
+log = logging.getLogger('Market Data')
+
+class Waiter(object):
+    def __init__(self, startTime, endTime, callback, error_callback, owner):
+        self.startTime = startTime
+        self.endTime = endTime
+        self.callback = callback
+        self.error_callback = error_callback
+        self.owner = owner
+
+class HistoricalFlight(object):
+    #one load of a symbol/bar size/chunk range that every concurrent caller for the same chunks waits on
+    def __init__(self, key, priority):
+        self.key = key
+        self.priority = priority
+        self.requestCount = 0
+        self.waiters = []
+        self.landed = False
+        #monotonic time after which a flight without progress is failed, and what fails it
+        self.deadline = None
+        self.onExpired = None
+
+    def add(self, startTime, endTime, callback, error_callback, priority, owner):
+        self.waiters.append(Waiter(startTime, endTime, callback, error_callback, owner))
+        #requests the plan hasn't sent yet go out at the most urgent waiter's priority
+        self.priority = min(self.priority, priority)
+
+    def removeOwner(self, owner):
+        self.waiters = [waiter for waiter in self.waiters if waiter.owner is not owner]
+
+    def span(self):
+        return min(waiter.startTime for waiter in self.waiters), max(waiter.endTime for waiter in self.waiters)
+
+class FlightBoard(object):
+    def __init__(self, timeout=900):
+        self.timeout = timeout
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sweep, name='HistoricalFlights', daemon=True)
+        self._thread.start()
+
+    def join(self, key, startTime, endTime, callback, error_callback, priority, owner):
+        #(flight, True if the caller has to do the load itself)
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = HistoricalFlight(key, priority)
+                flight.deadline = monotonic() + self.timeout
+            flight.add(startTime, endTime, callback, error_callback, priority, owner)
+        return flight, leader
+
+    def land(self, flight):
+        #no one can join once the result is being read, later callers start a new flight that hits the cache
+        #the first call gets the waiters, later ones get none
+        with self._lock:
+            if flight.landed:
+                return []
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            flight.landed = True
+            return list(flight.waiters)
+
+    def progress(self, flight):
+        flight.deadline = monotonic() + self.timeout
+
+    def cancelOwner(self, owner):
+        #flights nobody is waiting for anymore, they're dropped from the board
+        abandoned = []
+        with self._lock:
+            for key, flight in list(self._flights.items()):
+                flight.removeOwner(owner)
+                if not flight.waiters:
+                    del self._flights[key]
+                    flight.landed = True
+                    abandoned.append(flight)
+        return abandoned
+
+    def _sweep(self):
+        #fails flights that made no progress before their deadline, so a lost response can't block the key for good
+        while not self._stop.wait(1.0):
+            now = monotonic()
+            with self._lock:
+                expired = [flight for flight in self._flights.values() if flight.deadline is not None and flight.deadline <= now]
+            for flight in expired:
+                log.warning(f'Historical load {flight.key} made no progress for {self.timeout}s')
+                if flight.onExpired is not None:
+                    flight.onExpired()
+                else:
+                    self.land(flight)
+
+    def stop(self):
+        self._stop.set()
+
+    def __len__(self):
+        return len(self._flights)
@@ -8,10 +8,15 @@ from ibapi.contract import Contract
 from ibapi.order import *
 
 from decimal import *
-import time, datetime, math
+from collections import deque
+from array import array
+import time, datetime, math, threading
 import pandas as pd
+import numpy as np
 
 from ..config import Config
+from .event_bus import EventBus
+from .ticks import TapeStore
 from ..utils import trading_offset_factory, get_market_hours, singleton
 
 from PySide2.QtGui import *
@@ -27,6 +32,27 @@ BAR_SIZE_REMAP = {'1s':'1 secs','5s':'5 secs','10s':'10 secs','15s':'15 secs','3
                 '1D':'1 day','1W':'1 week','1M':'1 month'}
 TIME_FORMAT = "%Y%m%d %H:%M:%S"
 
+def parse_bar_dates(dates, tz):
+    #bar.date is "yyyyMMdd" for daily bars and "yyyyMMdd HH:mm:ss" for intraday ones, TWS 9.81 puts two spaces
+    #before the time, newer versions may add a timezone after it
+    if not dates:
+        return pd.DatetimeIndex([], tz=tz)
+    parts = dates[0].split()
+    dateParts = 2 if len(parts) > 1 and ':' in parts[1] else 1
+    barTz = parts[dateParts] if len(parts) > dateParts else tz
+    if len(parts) > dateParts or dates[0] != ' '.join(parts):
+        dates = [' '.join(date.split()[:dateParts]) for date in dates]
+    index = pd.to_datetime(dates, format=TIME_FORMAT if dateParts > 1 else '%Y%m%d')
+    return index.tz_localize(barTz).tz_convert(tz)
+
+def bars_from_buffer(dates, values, tz):
+    if not dates:
+        return get_empty_bar_dataframe()
+    columns = np.frombuffer(values, dtype=float).reshape(-1, 5)
+    bars = pd.DataFrame(columns.copy(), columns=["open", "high", "low", "close", "volume"], index=parse_bar_dates(dates, tz))
+    #a bar repeated in the response replaces the earlier one, like the per-bar .loc assignment used to
+    return bars[~bars.index.duplicated(keep='last')]
+
 def getIbkrDuration(startTime, endTime, barSize):
     if barSize.endswith('s') and int(barSize.replace('s', '')) < 15:
         roundFreq = '6H'
@@ -53,14 +79,93 @@ def getIbkrDuration(startTime, endTime, barSize):
     else:
         return '{} S'.format(int(delta.total_seconds()))
 
+class RequestRegistry(object):
+    #active requests by reqId, plus an index by (symbol, reqType) and then (barSize, live) so lookups don't scan
+    #every subscription
+    #mutations come from the GUI and worker threads, the reader thread only does lock-free dict reads
+    #ids released by finished requests are reused oldest first, and only after REUSE_DELAY more have been
+    #released, so late messages for a cancelled request don't land on a new one
+    REUSE_DELAY = 64
+    def __init__(self):
+        self._requests = {}
+        self._index = {}
+        self._nextId = 0
+        self._released = deque()
+        self._lock = threading.Lock()
+
+    def allocateId(self):
+        with self._lock:
+            if len(self._released) > self.REUSE_DELAY:
+                return self._released.popleft()
+            tickerId = self._nextId
+            self._nextId += 1
+            return tickerId
+
+    def append(self, request):
+        with self._lock:
+            self._requests[request.tickerId] = request
+            buckets = self._index.setdefault((request.symbol, request.reqType), {})
+            buckets.setdefault(self._bucket_key(request), {})[request.tickerId] = request
+
+    def remove(self, request):
+        with self._lock:
+            if self._requests.get(request.tickerId) is not request:
+                return
+            del self._requests[request.tickerId]
+            key = (request.symbol, request.reqType)
+            buckets = self._index[key]
+            bucketKey = self._bucket_key(request)
+            del buckets[bucketKey][request.tickerId]
+            if not buckets[bucketKey]:
+                del buckets[bucketKey]
+            if not buckets:
+                del self._index[key]
+            self._released.append(request.tickerId)
+
+    def get(self, reqId):
+        return self._requests.get(reqId)
+
+    def _bucket_key(self, request):
+        return (getattr(request, 'barSize', None), request.live_request)
+
+    def find(self, symbol=None, reqType=None, barSize=None, live=None):
+        if symbol is not None and reqType is not None:
+            buckets = self._index.get((symbol, reqType), {})
+            if barSize and live is not None:
+                return list(buckets.get((barSize, live), {}).values())
+            #a handful of (barSize, live) buckets per symbol and type
+            return [request for (bucketBarSize, bucketLive), bucket in list(buckets.items())
+                        if (not barSize or bucketBarSize == barSize) and (live is None or bucketLive == live)
+                        for request in list(bucket.values())]
+        return [request for request in list(self._requests.values())
+                    if (symbol is None or request.symbol == symbol)
+                    and (reqType is None or request.reqType == reqType)
+                    and (not barSize or getattr(request, 'barSize', None) == barSize)
+                    and (live is None or request.live_request == live)]
+
+    def __iter__(self):
+        return iter(list(self._requests.values()))
+
+    def __len__(self):
+        return len(self._requests)
+
+def merge_ticks(previous, tick):
+    #last trade of the frame with the size of every trade in it
+    symbol, time, price, size, callback = tick
+    return (symbol, time, price, previous[3] + size, callback)
+
 class IBApi(EWrapper, EClient):
     def __init__(self):
         EClient.__init__(self, self)
         self.signals = IBSignals()
+        self.eventBus = None
+        #SessionRecorder capturing the raw messages for offline replay, when recording
+        self.recorder = None
+        self.tape = TapeStore()
         self.config = Config()
         #self.cache = MarketDataCache()
 
-        self.activeRequests = []
+        self.activeRequests = RequestRegistry()
 
         self.historicalBarsBuffer = {}
         self.historicalBarSizes = {}
@@ -71,23 +176,16 @@ class IBApi(EWrapper, EClient):
         self.twsTimezone = self.config.get_property("timezone_tws", "US/Pacific")
 
     def getRequest(self, reqId):
-        for request in self.activeRequests:
-            if request.tickerId == reqId:
-                return request
-        return None
+        return self.activeRequests.get(reqId)
 
     def getNewTickerId(self):
-        tickerId = 0
-        while tickerId in [r.tickerId for r in self.activeRequests]:
-            tickerId += 1
-        return tickerId
+        return self.activeRequests.allocateId()
 
     def historicalData(self, reqId, bar):
         #print('historicalData: {} {}'.format(reqId, bar))
-        timestamp = pd.Timestamp(bar.date, tz=self.twsTimezone)
         request = self.getRequest(reqId)
         if request:
-            request.addBarToBuffer(bar, timestamp)
+            request.addBarToBuffer(bar)
         else:
             log.warning('NO REQUEST', reqId)
 
@@ -96,6 +194,8 @@ class IBApi(EWrapper, EClient):
         startTimeStamp = pd.Timestamp(startDate, tz=self.twsTimezone)
         endTimeStamp = pd.Timestamp(endDate, tz=self.twsTimezone)
         request = self.getRequest(reqId)
+        if self.recorder is not None:
+            self.recorder.recordHistory(request.symbol, request.barSize, request.getBarsFromBuffer())
 
         #self.cache.addData(request.symbol, 'bars_{}'.format(request.barSize), bars)
         #print('historicalDataEnd about to emit', reqId, request.symbol, request.getBarsFromBuffer(), startTimeStamp, endTimeStamp, request.barSize, (request.callback))
@@ -105,11 +205,12 @@ class IBApi(EWrapper, EClient):
             self.activeRequests.remove(request)
 
     def historicalDataUpdate(self, reqId, bar):
-        timestamp = pd.Timestamp(bar.date, tz=self.twsTimezone)
-        bar_df = get_empty_bar_dataframe()
-        bar_df.loc[timestamp] = [bar.open, bar.high, bar.low, bar.close, bar.volume]
+        #the raw bar goes on the event bus, it is only turned into a dataframe once per frame on the GUI thread
         request = self.getRequest(reqId)
-        self.signals.onHistoricalBarUpdate.emit(request.symbol, bar_df, request.barSize, (request.live_callback))
+        if request:
+            if self.recorder is not None:
+                self.recorder.recordBarUpdate(request.symbol, request.barSize, bar)
+            self.eventBus.post('bar_update', reqId, (request.symbol, bar, request.barSize, request.live_callback))
 
     def updateMktDepth(self, reqId, position, operation, side, price, size):
         super().updateMktDepth(reqId, position, operation, side, price, size)
@@ -121,6 +222,8 @@ class IBApi(EWrapper, EClient):
         request = self.getRequest(reqId)
         if not request:
             return
+        if self.recorder is not None:
+            self.recorder.recordDepth(request.symbol, position, operation, side, price, size)
         if operation == 0: #insert
             request.marketDepthData.insert(position, price, side, size)
         if operation == 1: #update
@@ -128,11 +231,9 @@ class IBApi(EWrapper, EClient):
         if operation == 2: #remove
             request.marketDepthData.delete(position, price, side, size)
         currentTime = time.time()
-        if not request.lastMarketDepthUpdate:
-            self.signals.onMarketDepthUpdate.emit(request.symbol, request.marketDepthData, (request.callback))
-            request.lastMarketDepthUpdate = currentTime
-        elif currentTime - request.lastMarketDepthUpdate >= self.frequency:
-            self.signals.onMarketDepthUpdate.emit(request.symbol, request.marketDepthData, (request.callback))
+        #the book stays private to this thread, the GUI only ever gets immutable snapshots of it
+        if not request.lastMarketDepthUpdate or currentTime - request.lastMarketDepthUpdate >= self.frequency:
+            self.eventBus.post('depth', reqId, (request.symbol, request.marketDepthData.snapshot(), request.callback))
             request.lastMarketDepthUpdate = currentTime
 
     def tickByTickAllLast(self, reqId, tickType, time, price, size, tickAttribLast, exchange, special):
@@ -140,14 +241,18 @@ class IBApi(EWrapper, EClient):
         #print("tick update {} {} {} {}".format(reqId, time, price, size))
         request = self.getRequest(reqId)
         if request:
-            self.signals.onTickLastUpdate.emit(request.symbol, time, price, size, (request.callback))
+            if self.recorder is not None:
+                self.recorder.recordTick(request.symbol, time, price, size, exchange)
+            #every trade is kept on the tape, the GUI only sees one coalesced update per frame
+            self.tape.append(request.symbol, time * 10**9, price, float(size), exchange)
+            self.eventBus.post('tick', reqId, (request.symbol, time, price, size, request.callback))
 
     def error(self, reqId, errorCode, errorMsg, advancedOrderRejectJson=None):
-        super().error(id, errorCode, errorMsg)
-        if errorCode == 162:
-            request = self.getRequest(reqId)
-            if request:
-                self.signals.onHistoricalBarError.emit(reqId, request.symbol, request.barSize, errorCode, errorMsg)
+        super().error(reqId, errorCode, errorMsg)
+        request = self.getRequest(reqId)
+        #2100-2199 are warnings and farm status notices, any other error on a historical request ends it
+        if request and request.reqType == IBRequest.HISTORICAL_BARS and not 2100 <= errorCode < 2200:
+            self.signals.onHistoricalBarError.emit(reqId, request.symbol, request.barSize, errorCode, errorMsg)
         log.error('IBKR API Error: {} {} {} {}'.format(reqId, errorCode, errorMsg, advancedOrderRejectJson))
 
     def scannerParameters(self, xml):
@@ -166,7 +271,7 @@ class IBSignals(QObject):
     onHistoricalBarUpdate = Signal(str, pd.DataFrame, str, tuple)
     onHistoricalBarEnd = Signal(str, pd.DataFrame, pd.Timestamp, pd.Timestamp, str, tuple)
     onHistoricalBarError = Signal(int, str, str, int, str)
-    onMarketDepthUpdate = Signal(str, MarketDepth, tuple)
+    onMarketDepthUpdate = Signal(str, MarketDepthSnapshot, tuple)
     onTickLastUpdate = Signal(str, float, float, float, tuple)
 
 class IBThread(QThread):
@@ -197,10 +302,14 @@ class IBRequest(object):
         self.live_request = True
 
         if self.reqType == IBRequest.HISTORICAL_BARS:
-            self._historicalBarsBuffer = get_empty_bar_dataframe()
+            #raw bar fields, the dataframe is only built once the response is complete
+            self._barDates = []
+            self._barValues = array('d')
+            self._historicalBarsBuffer = None
             self._historicalBarsCache = get_empty_bar_dataframe()
             self.barSize = '1m'
             self.live_request = False
+            self.error_callback = None
 
         if self.reqType == IBRequest.REALTIME_LEVEL2:
             self.marketDepthData = MarketDepth(contract.symbol)
@@ -230,10 +339,14 @@ class IBRequest(object):
                 self.api.cancelMktDepth(self.tickerId, True)
             elif self.reqType == IBRequest.REALTIME_BARS:
                 self.api.cancelRealTimeBars(self.tickerId)
+            if self.api.eventBus is not None:
+                self.api.eventBus.discard(self.tickerId)
             self.api.activeRequests.remove(self)
 
-    def addBarToBuffer(self, bar, timestamp):
-        self._historicalBarsBuffer.loc[timestamp] = [bar.open, bar.high, bar.low, bar.close, bar.volume]
+    def addBarToBuffer(self, bar):
+        self._barDates.append(bar.date)
+        self._barValues.extend((bar.open, bar.high, bar.low, bar.close, float(bar.volume)))
+        self._historicalBarsBuffer = None
 
     def addToCache(self, dataframe):
         if dataframe is None:
@@ -241,18 +354,23 @@ class IBRequest(object):
         self._historicalBarsCache = dataframe.combine_first(self._historicalBarsCache)
 
     def getBarsFromBuffer(self):
+        if self._historicalBarsBuffer is None:
+            self._historicalBarsBuffer = bars_from_buffer(self._barDates, self._barValues, self.api.twsTimezone)
         return self._historicalBarsBuffer
 
     def getBarsFromCache(self):
         return self._historicalBarsCache
 
     def getBars(self):
-        return self._historicalBarsBuffer.combine_first(self._historicalBarsCache)
+        return self.getBarsFromBuffer().combine_first(self._historicalBarsCache)
 
 class IBApiWrapper(BaseAPIWrapper):
     name = "IBKR"
+    paced = True
+    #the EClient/EWrapper the requests go to and the messages come from
+    clientClass = IBApi
     def __init__(self):
-        self.ibapi = IBApi()
+        self.ibapi = self.clientClass()
         self.onHistoricalBar = self.ibapi.signals.onHistoricalBar
         self.onHistoricalBarUpdate = self.ibapi.signals.onHistoricalBarUpdate
         self.onHistoricalBarEnd = self.ibapi.signals.onHistoricalBarEnd
@@ -264,9 +382,17 @@ class IBApiWrapper(BaseAPIWrapper):
         
         self.ibapi.signals.onHistoricalBarEnd.connect(self.historicalBarsCallback)
         self.ibapi.signals.onHistoricalBarUpdate.connect(self.historicalBarsUpdateCallback)
+        self.ibapi.signals.onHistoricalBarError.connect(self.historicalBarsErrorCallback)
         self.ibapi.signals.onMarketDepthUpdate.connect(self.marketDepthCallback)
         self.ibapi.signals.onTickLastUpdate.connect(self.tickDataCallback)
 
+        #live ticks, bar updates and book snapshots are coalesced to one delivery per request and frame
+        self.eventBus = EventBus()
+        self.eventBus.register('tick', self.tickDataCallback, merge=merge_ticks)
+        self.eventBus.register('bar_update', self.rawBarUpdateCallback, coalesceKey=lambda payload: payload[1].date)
+        self.eventBus.register('depth', self.marketDepthCallback)
+        self.ibapi.eventBus = self.eventBus
+
         self.listeningThread = IBThread(self.ibapi)
 
     def connect(self, host, port, clientId=0):
@@ -302,18 +428,20 @@ class IBApiWrapper(BaseAPIWrapper):
 
         if durationStr == '0 D' or durationStr == '0 S':
             bars = get_empty_bar_dataframe()
-            self.onHistoricalBarEnd.emit(-1, symbol, bars, startTime, endTime, barSize, (callback))
+            self.onHistoricalBarEnd.emit(symbol, bars, startTime, endTime, barSize, (callback))
             return
 
         tickerId = self.getNewTickerId()
         newRequest = IBRequest(tickerId, contract, IBRequest.HISTORICAL_BARS, api=self.ibapi)
         newRequest.barSize = barSize
         newRequest.callback = callback
+        newRequest.error_callback = error_callback
         newRequest.live_request = live
         newRequest.live_callback = live_callback
         log.debug('-----\n---endTimeStr: {}\n---durationStr: {}\n'.format(endTimeStr, durationStr))
         self.ibapi.reqHistoricalData(tickerId, contract, endTimeStr, durationStr, barSizeMapped, "TRADES", 0, 1, live, [])
         self.activeRequests.append(newRequest)
+        return newRequest
 
     def requestMarketDepth(self, symbol, callback):
         contract = Contract()
@@ -346,12 +474,29 @@ class IBApiWrapper(BaseAPIWrapper):
         self.ibapi.requestSymbols[tickerId] = symbol.upper()
         self.ibapi.reqTickByTickData(tickerId, contract, "AllLast", 0, True)
         self.activeRequests.append(newRequest)
+        return newRequest
 
     @Slot(str, pd.DataFrame, pd.Timestamp, pd.Timestamp, str, tuple)
     def historicalBarsCallback(self, symbol, bars, startTime, endTime, barSize, callback):
         if callback is not None:
             callback(symbol, barSize, bars, startTime, endTime)
 
+    @Slot(int, str, str, int, str)
+    def historicalBarsErrorCallback(self, reqId, symbol, barSize, errorCode, errorMsg):
+        request = self.ibapi.getRequest(reqId)
+        if request is None:
+            return
+        if not request.live_request:
+            self.activeRequests.remove(request)
+        if request.error_callback is not None:
+            request.error_callback(symbol, barSize, errorCode, errorMsg)
+
+    def rawBarUpdateCallback(self, symbol, bar, barSize, callback):
+        timestamp = pd.Timestamp(bar.date, tz=self.ibapi.twsTimezone)
+        bar_df = get_empty_bar_dataframe()
+        bar_df.loc[timestamp] = [bar.open, bar.high, bar.low, bar.close, bar.volume]
+        self.historicalBarsUpdateCallback(symbol, bar_df, barSize, callback)
+
     @Slot(str, pd.DataFrame, str, tuple)
     def historicalBarsUpdateCallback(self, symbol, bar, barSize, callback):
         if callback is not None:
@@ -366,40 +511,20 @@ class IBApiWrapper(BaseAPIWrapper):
             callback(symbol, time, price, size)
 
     def hasRequest(self, symbol, requestType, barSize=None, live=False):
-        for request in self.activeRequests[:]:
-            if not request.reqType == requestType:
-                continue
-            if not request.symbol == symbol:
-                continue
-            if barSize and not request.barSize == barSize:
-                continue
-            if live != request.live_request:
-                continue
-            return True
-        return False
+        return bool(self.activeRequests.find(symbol, requestType, barSize, live))
     
     def getRequests(self, symbol, requestType, barSize=None, live=False):
-        requests = []
-        for request in self.activeRequests[:]:
-            if not request.reqType == requestType:
-                continue
-            if not request.symbol == symbol:
-                continue
-            if barSize and not request.barSize == barSize:
-                continue
-            if live != request.live_request:
-                continue
-            requests.append(request)
-        return requests
+        return self.activeRequests.find(symbol, requestType, barSize, live)
 
     def cancelRequests(self, symbol=None, requestType=None):
-        for request in self.activeRequests[:]:
-            if requestType and not request.reqType == requestType:
-                continue
-            if symbol and not request.symbol == symbol:
-                continue
+        for request in self.activeRequests.find(symbol or None, requestType or None):
             request.cancel()
 
+    def setRecorder(self, recorder):
+        #raw messages are handed to recorder on the reader thread from now on, None stops recording
+        self.ibapi.recorder = recorder
+
     def disconnect(self):
+        self.eventBus.stop()
         self.listeningThread.quit()
         self.ibapi.disconnect()
@@ -0,0 +1,81 @@
+from collections import OrderedDict
+import threading
+
+import logging
+log = logging.getLogger('Market Data')
+
+class BarMemoryCache(object):
+    #LRU of ready-made bar DataFrames keyed by (symbol, dataType, chunk_ns), bounded by their size in bytes
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.currentBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        #per (symbol, dataType), bumped when it's invalidated so blocks read before a write are not cached after it.
+        #clear() bumps the epoch, which covers every key
+        self._generations = {}
+        self._epoch = 0
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is None:
+                self.misses += 1
+                return None
+            self._blocks.move_to_end(key)
+            self.hits += 1
+            return block[0]
+
+    def generation(self, symbol, dataType):
+        with self._lock:
+            return self._generation(symbol, dataType)
+
+    def _generation(self, symbol, dataType):
+        return (self._epoch, self._generations.get((symbol, dataType), 0))
+
+    def put(self, key, dataframe, generation=None):
+        size = int(dataframe.memory_usage(index=True).sum())
+        if size > self.maxBytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation(key[0], key[1]):
+                return
+            if key in self._blocks:
+                self.currentBytes -= self._blocks.pop(key)[1]
+            self._blocks[key] = (dataframe, size)
+            self.currentBytes += size
+            while self.currentBytes > self.maxBytes:
+                _, (_, evictedSize) = self._blocks.popitem(last=False)
+                self.currentBytes -= evictedSize
+                self.evictions += 1
+
+    def invalidate(self, symbol, dataType, chunk_ns=None):
+        with self._lock:
+            self._generations[(symbol, dataType)] = self._generations.get((symbol, dataType), 0) + 1
+            if chunk_ns is None:
+                keys = [key for key in self._blocks if key[0] == symbol and key[1] == dataType]
+            else:
+                keys = [(symbol, dataType, ns) for ns in chunk_ns if (symbol, dataType, ns) in self._blocks]
+            for key in keys:
+                self.currentBytes -= self._blocks.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._generations.clear()
+            self._blocks.clear()
+            self.currentBytes = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {'blocks': len(self._blocks),
+                    'bytes': self.currentBytes,
+                    'max_bytes': self.maxBytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_rate': self.hits / total if total else 0.0}
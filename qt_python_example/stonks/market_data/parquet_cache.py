@@ -0,0 +1,118 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pandas as pd
+
+import os
+import json
+import threading
+
+from .cache import BaseBarStore, BAR_COLUMNS, get_chunk_labels, get_empty_utc_bar_dataframe
+
+import logging
+log = logging.getLogger('Market Data')
+
+BAR_SCHEMA = pa.schema([('date', pa.timestamp('ns', tz='UTC'))] + [(column, pa.float64()) for column in BAR_COLUMNS])
+CHUNK_FILE = '_chunks.json'
+
+#one Parquet file per symbol/bar size/chunk, e.g. bars/SPY/1m/2023-01-05.parquet
+class ParquetBarStore(BaseBarStore):
+    name = 'parquet'
+    ROW_GROUP_SIZE = 1024
+    def __init__(self, folder):
+        self._folder = folder
+        self._chunkSources = {}
+        self._lock = threading.Lock()
+
+    def writeBars(self, symbol, barSize, dataframe):
+        dataframe = dataframe[BAR_COLUMNS].astype(float)
+        dataframe.index = dataframe.index.tz_convert('UTC')
+        labels = get_chunk_labels(dataframe.index, 'bars_'+barSize)
+        with self._lock:
+            for label, chunk in dataframe.groupby(labels):
+                path = self._partition_path(symbol, barSize, label)
+                if os.path.isfile(path):
+                    existing = self._read_files([path])
+                    chunk = chunk.combine_first(existing)
+                self._write_file(path, chunk)
+
+    def readBars(self, symbol, barSize, startTime, endTime):
+        folder = self._partition_folder(symbol, barSize)
+        if not os.path.isdir(folder):
+            return get_empty_utc_bar_dataframe()
+        labels = get_chunk_labels(pd.DatetimeIndex([startTime, endTime]), 'bars_'+barSize)
+        firstFile = self._partition_name(labels[0])
+        lastFile = self._partition_name(labels[-1])
+        paths = [os.path.join(folder, name) for name in sorted(os.listdir(folder))
+                    if name.endswith('.parquet') and firstFile <= name <= lastFile]
+        if not paths:
+            return get_empty_utc_bar_dataframe()
+        return self._read_files(paths, startTime.tz_convert('UTC'), endTime.tz_convert('UTC'))
+
+    def writeChunks(self, symbol, barSize, chunkDates, data_source):
+        with self._lock:
+            chunkSources = self._get_chunk_sources(symbol, barSize)
+            for date in chunkDates:
+                chunkSources[date.strftime('%Y-%m-%d')] = data_source
+            path = os.path.join(self._partition_folder(symbol, barSize), CHUNK_FILE)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path+'.tmp', 'w') as f:
+                json.dump(chunkSources, f)
+            os.replace(path+'.tmp', path)
+
+    def readChunks(self, symbol, barSize, startTime, endTime):
+        startDate = startTime.strftime('%Y-%m-%d')
+        endDate = endTime.strftime('%Y-%m-%d')
+        #copied under the writers' lock, writeChunks adds to the same dict
+        with self._lock:
+            dates = list(self._get_chunk_sources(symbol, barSize))
+        dates = [date for date in dates if startDate <= date <= endDate]
+        return pd.DatetimeIndex(dates).tz_localize('US/Eastern')
+
+    def _partition_folder(self, symbol, barSize):
+        return os.path.join(self._folder, symbol, barSize)
+
+    def _partition_name(self, chunkDate):
+        return chunkDate.strftime('%Y-%m-%d') + '.parquet'
+
+    def _partition_path(self, symbol, barSize, chunkDate):
+        return os.path.join(self._partition_folder(symbol, barSize), self._partition_name(chunkDate))
+
+    def _get_chunk_sources(self, symbol, barSize):
+        key = (symbol, barSize)
+        if not key in self._chunkSources:
+            path = os.path.join(self._partition_folder(symbol, barSize), CHUNK_FILE)
+            chunkSources = {}
+            if os.path.isfile(path):
+                with open(path, 'r') as f:
+                    chunkSources = json.load(f)
+            self._chunkSources[key] = chunkSources
+        return self._chunkSources[key]
+
+    def _read_files(self, paths, startTime=None, endTime=None):
+        tables = []
+        for i, path in enumerate(paths):
+            parquetFile = pq.ParquetFile(path, memory_map=True)
+            if startTime is not None and (i == 0 or i == len(paths)-1):
+                #only the first and last partition can straddle the range, skip their row groups outside of it
+                rowGroups = [rg for rg in range(parquetFile.metadata.num_row_groups)
+                                if self._row_group_overlaps(parquetFile.metadata.row_group(rg), startTime, endTime)]
+                tables.append(parquetFile.read_row_groups(rowGroups, columns=BAR_SCHEMA.names))
+            else:
+                tables.append(parquetFile.read(columns=BAR_SCHEMA.names))
+        dataframe = pa.concat_tables(tables).to_pandas().set_index('date')
+        if startTime is not None:
+            dataframe = dataframe.iloc[dataframe.index.searchsorted(startTime):dataframe.index.searchsorted(endTime, side='right')]
+        return dataframe
+
+    def _row_group_overlaps(self, rowGroup, startTime, endTime):
+        statistics = rowGroup.column(0).statistics
+        if statistics is None or not statistics.has_min_max:
+            return True
+        return statistics.min <= endTime and statistics.max >= startTime
+
+    def _write_file(self, path, dataframe):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        dataframe.index.name = 'date'
+        table = pa.Table.from_pandas(dataframe.reset_index(), schema=BAR_SCHEMA, preserve_index=False)
+        pq.write_table(table, path+'.tmp', row_group_size=self.ROW_GROUP_SIZE)
+        os.replace(path+'.tmp', path)
@@ -0,0 +1,107 @@
+import pandas as pd
+
+import math
+import threading
+
+from .cache import chunk_calendar
+from .types import is_intraday
+from ..utils import get_market_hours
+
+import logging
+log = logging.getLogger('Market Data')
+
+#longest span a single historical request may cover per bar size, from IBKR's valid duration/bar size table.
+#Second bars follow getIbkrDuration, which rounds their duration up to 6 or 12 hours.
+MAX_REQUEST_SPAN = {'1s': '6H', '5s': '6H', '10s': '6H', '15s': '12H', '30s': '12H',
+                    '1m': '1D', '2m': '2D', '3m': '7D', '5m': '7D', '10m': '7D', '15m': '7D', '20m': '7D',
+                    '30m': '30D', '1h': '30D', '2h': '30D', '3h': '30D', '4h': '30D', '8h': '30D',
+                    '1D': '366D', '1W': '1825D', '1M': '1825D'}
+
+def session_spans(missingRanges):
+    #extended hours of every NYSE session overlapping the ranges, clipped to them, so weekends and holidays are never requested
+    market_hours = get_market_hours()
+    openOffset = pd.Timedelta(market_hours[0] + ':00')
+    closeOffset = pd.Timedelta(market_hours[-1] + ':00')
+    calendar = chunk_calendar(True)
+    spans = []
+    for start, end in missingRanges:
+        sessions = calendar[calendar.searchsorted((start - closeOffset).value, side='right'):calendar.searchsorted((end - openOffset).value)]
+        for session in pd.to_datetime(sessions, utc=True).tz_convert('US/Eastern'):
+            spans.append((max(session + openOffset, start).tz_convert(start.tz), min(session + closeOffset, end).tz_convert(start.tz)))
+    return spans
+
+def plan_requests(missingRanges, barSize):
+    #turns missing (start, end) ranges into the fewest requests that each fit in one provider request
+    maxSpan = pd.Timedelta(MAX_REQUEST_SPAN.get(barSize, '1D'))
+    if is_intraday('bars_'+barSize):
+        missingRanges = session_spans(missingRanges)
+    merged = []
+    for start, end in sorted(missingRanges):
+        #re-downloading a small cached gap is cheaper than spending another request on pacing
+        if merged and end - merged[-1][0] <= maxSpan:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+
+    requests = []
+    for start, end in merged:
+        pieces = max(1, math.ceil((end - start) / maxSpan))
+        step = (end - start) / pieces
+        for i in range(pieces):
+            requests.append((start + step * i, end if i == pieces - 1 else start + step * (i + 1)))
+    return requests
+
+class FetchPlan(object):
+    #runs planned requests with at most maxConcurrent in flight, onComplete(failed) fires once all of them are done
+    def __init__(self, requests, requestFunc, onComplete, onError=None, maxConcurrent=6):
+        self.requests = list(requests)
+        self._pending = list(reversed(self.requests))
+        self._requestFunc = requestFunc
+        self._onComplete = onComplete
+        self._onError = onError
+        self._maxConcurrent = max(1, maxConcurrent)
+        self._active = 0
+        self._done = 0
+        self.failed = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        if not self.requests:
+            self._onComplete(self.failed)
+            return
+        self._dispatch()
+
+    def cancel(self):
+        #requests not sent yet are dropped, onComplete won't fire
+        with self._lock:
+            self._pending = []
+
+    def requestFinished(self):
+        self._finish()
+
+    def requestFailed(self, symbol, barSize, errorCode, errorMsg):
+        log.error(f'Historical request for {symbol} {barSize} failed ({errorCode}): {errorMsg}')
+        self.failed.append((errorCode, errorMsg))
+        if self._onError:
+            self._onError(symbol, barSize, errorCode, errorMsg)
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._active -= 1
+            self._done += 1
+            complete = self._done == len(self.requests)
+        if complete:
+            self._onComplete(self.failed)
+        else:
+            self._dispatch()
+
+    def _dispatch(self):
+        toStart = []
+        with self._lock:
+            while self._pending and self._active < self._maxConcurrent:
+                toStart.append(self._pending.pop())
+                self._active += 1
+        for startTime, endTime in toStart:
+            log.debug(f'Fetching {startTime} - {endTime}')
+            self._requestFunc(self, startTime, endTime)
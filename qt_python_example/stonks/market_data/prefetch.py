@@ -0,0 +1,145 @@
+import pandas as pd
+
+import os
+import json
+import threading
+from time import monotonic
+
+from ..config import Config
+from .cache import nyse_business_day
+from .scheduler import PRIORITY_PREFETCH
+
+from PySide2.QtCore import QObject, QRunnable, QThread, QThreadPool, Signal
+
+import logging
+log = logging.getLogger('Market Data')
+
+class PrefetchRunnable(QRunnable):
+    def __init__(self, prefetcher):
+        QRunnable.__init__(self)
+        self._prefetcher = prefetcher
+
+    def run(self):
+        QThread.currentThread().setPriority(QThread.LowestPriority)
+        self._prefetcher.run()
+
+class WatchlistPrefetcher(QObject):
+    #fills the cache for every watchlist symbol and prefetch bar size, one item at a time on its own low priority thread
+    PROGRESS_FILE = "%LOCALAPPDATA%\\StonX\\prefetch.json"
+    itemFinished = Signal(str, str, bool)
+    progressChanged = Signal(int, int)
+    finished = Signal()
+    def __init__(self, marketData):
+        QObject.__init__(self)
+        self.marketData = marketData
+        self.config = Config()
+        self.twsTimezone = self.config.get_property("timezone_tws", "US/Pacific")
+        self.requestTimeout = self.config.get_property("prefetch_request_timeout", 120)
+        #leaves most of IBKR's 60 requests per 10 minutes to the charts
+        self.requestInterval = 600 / self.config.get_property("prefetch_requests_per_10min", 30)
+
+        self._pool = QThreadPool(self)
+        self._pool.setMaxThreadCount(1)
+        self._stop = threading.Event()
+        self._progressPath = os.path.expandvars(self.PROGRESS_FILE)
+        self._done = set()
+        self._session = None
+        self.total = 0
+        self.completed = 0
+        self.failed = 0
+        self.cacheHits = 0
+        self.requests = 0
+
+    def start(self):
+        self._stop.clear()
+        self._pool.start(PrefetchRunnable(self))
+
+    def stop(self):
+        self._stop.set()
+        self.marketData.cancelHistoricalRequests(self)
+        self._pool.waitForDone(1000)
+
+    def progress(self):
+        return {'total': self.total,
+                'completed': self.completed,
+                'failed': self.failed,
+                'cache_hits': self.cacheHits,
+                'requests': self.requests}
+
+    def run(self):
+        watchlist = [symbol.upper() for symbol in self.config.get_property("watchlist", [])]
+        barSizes = self.config.get_property("prefetch_bar_sizes", ['1m'])
+        lookbackDays = self.config.get_property("prefetch_lookback_days", 5)
+
+        now = pd.Timestamp.now(tz=self.twsTimezone)
+        self._load_progress(now.tz_convert('US/Eastern').strftime('%Y-%m-%d'))
+        items = [(symbol, barSize) for symbol in watchlist for barSize in barSizes]
+        self.total = len(items)
+        self.completed = len([item for item in items if self._item_key(*item) in self._done])
+        self.progressChanged.emit(self.completed, self.total)
+
+        startTime = now.floor(freq='D') - nyse_business_day() * lookbackDays
+        for symbol, barSize in items:
+            if self._stop.is_set():
+                return
+            if self._item_key(symbol, barSize) in self._done:
+                continue
+            self._prefetch(symbol, barSize, startTime, now)
+        log.info(f'Prefetch finished: {self.progress()}')
+        self.finished.emit()
+
+    def _prefetch(self, symbol, barSize, startTime, endTime):
+        done = threading.Event()
+        errors = []
+        def error_callback(symbol, barSize, errorCode, errorMsg):
+            errors.append(errorCode)
+
+        itemStart = monotonic()
+        requestCount = self.marketData.loadHistoricalBars(symbol, barSize, startTime, endTime,
+                                                            callback=lambda *args: done.set(), error_callback=error_callback,
+                                                            priority=PRIORITY_PREFETCH, owner=self)
+        if requestCount:
+            self.requests += requestCount
+            deadline = monotonic() + self.requestTimeout * requestCount
+            while not done.wait(0.5) and not self._stop.is_set() and monotonic() < deadline:
+                pass
+            ok = done.is_set() and not errors
+        else:
+            self.cacheHits += 1
+            ok = True
+
+        if ok:
+            self.completed += 1
+            self._done.add(self._item_key(symbol, barSize))
+            self._save_progress()
+        else:
+            self.failed += 1
+            log.warning(f'Prefetch of {symbol} {barSize} failed: {errors or "timed out"}')
+        self.itemFinished.emit(symbol, barSize, ok)
+        self.progressChanged.emit(self.completed, self.total)
+
+        #pacing, every provider request this item made costs requestInterval seconds
+        self._stop.wait(max(0, requestCount * self.requestInterval - (monotonic() - itemStart)))
+
+    def _item_key(self, symbol, barSize):
+        return f'{symbol}|{barSize}'
+
+    def _load_progress(self, session):
+        #progress only carries over within the same session, the next one moves the lookback window
+        self._session = session
+        self._done = set()
+        if not os.path.isfile(self._progressPath):
+            return
+        try:
+            with open(self._progressPath, 'r') as f:
+                progress = json.load(f)
+        except (OSError, json.decoder.JSONDecodeError):
+            log.warning('Invalid prefetch progress file')
+            return
+        if progress.get('session') == session:
+            self._done = set(progress.get('done', []))
+
+    def _save_progress(self):
+        with open(self._progressPath+'.tmp', 'w') as f:
+            json.dump({'session': self._session, 'done': sorted(self._done)}, f)
+        os.replace(self._progressPath+'.tmp', self._progressPath)
@@ -0,0 +1,497 @@
+#Offline market data: SessionRecorder writes the raw IBKR messages of a live session to disk and ReplayAPIWrapper plays
+#them back through the same IBApi callbacks, event bus and signals as a TWS connection, so charts, books and indicators
+#can be run and load tested without TWS. Select it with market_data_provider = "Replay".
+#
+#   <session folder>/<SYMBOL>/ticks            trades
+#   <session folder>/<SYMBOL>/depth            L2 book operations
+#   <session folder>/<SYMBOL>/<bar size>.bars     live bar updates
+#   <session folder>/<SYMBOL>/<bar size>.history  historical bars
+import numpy as np
+import pandas as pd
+
+import os
+import glob
+import heapq
+import threading
+from collections import deque
+from time import monotonic, time_ns
+
+from ibapi.common import BarData
+
+from .cache import BAR_RECORD_DTYPE
+from .ibkr import IBApi, IBApiWrapper, BAR_SIZE_REMAP, TIME_FORMAT
+from .ticks import SPILL_BATCH
+from .types import is_intraday
+
+import logging
+log = logging.getLogger('Market Data')
+
+#every live message starts with the time it was received, in ns since the epoch, which is what replay is paced by
+RECORDED_TICK_DTYPE = np.dtype([('received', 'i8'), ('time', 'i8'), ('price', 'f8'), ('size', 'f8'), ('exchange', 'S8')])
+RECORDED_DEPTH_DTYPE = np.dtype([('received', 'i8'), ('position', 'i4'), ('operation', 'i1'), ('side', 'i1'),
+                                    ('price', 'f8'), ('size', 'f8')])
+RECORDED_BAR_DTYPE = np.dtype([('received', 'i8'), ('date', 'S32'), ('open', 'f8'), ('high', 'f8'), ('low', 'f8'),
+                                ('close', 'f8'), ('volume', 'f8')])
+RECORDING_DTYPES = {'ticks': RECORDED_TICK_DTYPE, 'depth': RECORDED_DEPTH_DTYPE, 'bars': RECORDED_BAR_DTYPE,
+                    'history': BAR_RECORD_DTYPE}
+DEFAULT_RECORD_FOLDER = "%LOCALAPPDATA%\\StonX\\sessions"
+
+BAR_SIZE_SETTINGS = {setting: barSize for barSize, setting in BAR_SIZE_REMAP.items()}
+DURATION_UNITS = {'S': pd.Timedelta(seconds=1), 'D': pd.Timedelta(days=1), 'W': pd.Timedelta(weeks=1),
+                    'M': pd.Timedelta(days=30), 'Y': pd.Timedelta(days=365)}
+
+def recording_path(folder, symbol, kind, barSize=None):
+    #'1M' is spelled out so it can't clash with '1m' on case insensitive file systems
+    name = kind if barSize is None else f'{barSize.replace("M", "mo")}.{kind}'
+    return os.path.join(folder, symbol.upper(), name)
+
+def read_recording(path, kind):
+    #zero-copy memory map of a recording, empty array for a missing or empty file
+    dtype = RECORDING_DTYPES[kind]
+    if not os.path.isfile(path) or os.path.getsize(path) < dtype.itemsize:
+        return np.zeros(0, dtype=dtype)
+    #a crash can leave a partial record at the end
+    count = os.path.getsize(path) // dtype.itemsize
+    return np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+
+def write_recording(path, records):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab') as f:
+        f.write(memoryview(np.ascontiguousarray(records)))
+
+def latest_session(folder):
+    sessions = sorted(path for path in glob.glob(os.path.join(folder, '*')) if os.path.isdir(path))
+    return sessions[-1] if sessions else None
+
+def session_start(folder):
+    #ns of the first live message recorded in the session, None for a session without any
+    first = []
+    for kind in ('ticks', 'depth', 'bars'):
+        pattern = recording_path(folder, '*', kind) if kind != 'bars' else recording_path(folder, '*', kind, '*')
+        for path in glob.glob(pattern):
+            records = read_recording(path, kind)
+            if len(records):
+                first.append(int(records['received'][0]))
+    return min(first) if first else None
+
+def parse_duration(durationStr):
+    count, unit = durationStr.split()
+    return int(count) * DURATION_UNITS[unit]
+
+class SessionRecorder(object):
+    #called by the IBKR reader thread, live messages are written in batches per file, historical responses right away
+    def __init__(self, folder):
+        self.folder = folder
+        self.recorded = 0
+        self._pending = {}
+        self._closed = False
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        log.info(f'Recording market data to {folder}')
+
+    def recordTick(self, symbol, time, price, size, exchange):
+        self._record(recording_path(self.folder, symbol, 'ticks'), 'ticks',
+                        (time_ns(), int(time) * 10**9, price, float(size), exchange.encode('ascii', 'replace')[:8]))
+
+    def recordDepth(self, symbol, position, operation, side, price, size):
+        self._record(recording_path(self.folder, symbol, 'depth'), 'depth',
+                        (time_ns(), position, operation, side, price, float(size)))
+
+    def recordBarUpdate(self, symbol, barSize, bar):
+        self._record(recording_path(self.folder, symbol, 'bars', barSize), 'bars',
+                        (time_ns(), bar.date.encode('ascii'), bar.open, bar.high, bar.low, bar.close, float(bar.volume)))
+
+    def recordHistory(self, symbol, barSize, bars):
+        if bars.empty:
+            return
+        records = np.zeros(len(bars), dtype=BAR_RECORD_DTYPE)
+        records['epoch_ns'] = bars.index.tz_convert('UTC').asi8
+        for column in ('open', 'high', 'low', 'close', 'volume'):
+            records[column] = bars[column].to_numpy(dtype=float)
+        with self._lock:
+            if not self._closed:
+                write_recording(recording_path(self.folder, symbol, 'history', barSize), records)
+
+    def _record(self, path, kind, record):
+        with self._lock:
+            if self._closed:
+                return
+            pending = self._pending.get(path)
+            if pending is None:
+                pending = self._pending[path] = (kind, [])
+            pending[1].append(record)
+            self.recorded += 1
+            if len(pending[1]) >= SPILL_BATCH:
+                self._write(path)
+
+    def _write(self, path):
+        kind, records = self._pending[path]
+        if records:
+            write_recording(path, np.array(records, dtype=RECORDING_DTYPES[kind]))
+            records.clear()
+
+    def flush(self):
+        with self._lock:
+            for path in self._pending:
+                self._write(path)
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._closed = True
+        log.info(f'Recorded {self.recorded} market data messages to {self.folder}')
+
+class ReplayClock(object):
+    #replay time in ns: speed 1 is real time, N is N times faster and 0 is as fast as possible, where time jumps
+    #straight to the next message
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self.origin_ns = 0
+        self._current_ns = 0
+        self._started = monotonic()
+
+    def start(self, origin_ns):
+        self.origin_ns = self._current_ns = origin_ns
+        self._started = monotonic()
+
+    def now(self):
+        if self.speed <= 0:
+            return self._current_ns
+        return self.origin_ns + int((monotonic() - self._started) * self.speed * 10**9)
+
+    def wait(self, time_ns):
+        #seconds until time_ns is due, negative when it's late
+        if self.speed <= 0:
+            return 0.0
+        return (time_ns - self.origin_ns) / (self.speed * 10**9) - (monotonic() - self._started)
+
+    def advance(self, time_ns):
+        if time_ns > self._current_ns:
+            self._current_ns = time_ns
+
+    def setSpeed(self, speed):
+        #carries on from the current replay time
+        now = self.now()
+        self.speed = speed
+        self.start(now)
+
+class ReplayStream(object):
+    #cursor over one request's recording, rows are turned into python objects a batch at a time
+    def __init__(self, reqId, kind, records, position=0):
+        self.reqId = reqId
+        self.kind = kind
+        self.records = records
+        self.position = position
+        self.cancelled = False
+        self._rows = []
+        self._row = 0
+        self._load()
+
+    def _load(self):
+        self._rows = self.records[self.position:self.position + SPILL_BATCH].tolist()
+        self._row = 0
+
+    @property
+    def exhausted(self):
+        return not self._rows
+
+    @property
+    def time(self):
+        return self._rows[self._row][0]
+
+    def next(self):
+        row = self._rows[self._row]
+        self._row += 1
+        self.position += 1
+        if self._row == len(self._rows):
+            self._load()
+        return row
+
+class ReplayClient(IBApi):
+    #takes the place of the TWS connection: requests are answered from a recorded session, and its messages are
+    #handed to the IBApi callbacks on the listening thread in received order, paced by the replay clock
+    def __init__(self):
+        IBApi.__init__(self)
+        folder = self.config.get_property("replay_folder", None)
+        if folder is None:
+            folder = latest_session(os.path.expandvars(self.config.get_property("record_folder", DEFAULT_RECORD_FOLDER)))
+        self.folder = os.path.expandvars(folder) if folder else None
+        self.clock = ReplayClock(self.config.get_property("replay_speed", 1.0))
+        self.replayStart = self.config.get_property("replay_start", None)
+
+        self._commands = deque()
+        self._wake = threading.Event()
+        self._streams = []
+        self._byReqId = {}
+        self._sequence = 0
+        self._running = False
+        #set once every subscribed recording has been played to its end
+        self.finished = threading.Event()
+
+        self.dispatched = {'ticks': 0, 'depth': 0, 'bars': 0, 'history': 0}
+        self.maxLag = 0.0
+        self._startedAt = monotonic()
+
+    def connect(self, host=None, port=None, clientId=0):
+        if self.folder is None or not os.path.isdir(self.folder):
+            log.error(f'No recorded session to replay in {self.folder}')
+        origin_ns = None
+        if self.replayStart is not None:
+            origin = pd.Timestamp(self.replayStart)
+            origin_ns = (origin if origin.tz is not None else origin.tz_localize(self.twsTimezone)).value
+        elif self.folder is not None:
+            origin_ns = session_start(self.folder)
+        self.clock.start(origin_ns if origin_ns is not None else time_ns())
+        self._startedAt = monotonic()
+        self._running = True
+        log.info(f'Replaying {self.folder} from {pd.Timestamp(self.clock.origin_ns, tz="UTC").tz_convert(self.twsTimezone)} '
+                    f'at {self.clock.speed or "max"}x')
+
+    def isConnected(self):
+        return self._running
+
+    def disconnect(self):
+        self._running = False
+        self._wake.set()
+
+    def run(self):
+        while self._running:
+            self._wake.clear()
+            if self._commands:
+                self._run_commands()
+            streams = self._streams
+            if not streams:
+                self._wake.wait(0.01 if self._commands else 0.1)
+                continue
+            time, _, stream = streams[0]
+            if stream.cancelled:
+                heapq.heappop(streams)
+                continue
+            wait = self.clock.wait(time)
+            if wait > 0:
+                self._wake.wait(min(wait, 0.1))
+                continue
+            if wait < -self.maxLag:
+                self.maxLag = -wait
+            self._dispatch(stream, stream.next())
+            self.clock.advance(time)
+            if stream.exhausted:
+                heapq.heappop(streams)
+                self._byReqId.pop(stream.reqId, None)
+                if not streams:
+                    log.info('Replay reached the end of the recorded session')
+                    self.finished.set()
+            else:
+                self._sequence += 1
+                heapq.heapreplace(streams, (stream.time, self._sequence, stream))
+
+    def _dispatch(self, stream, row):
+        kind = stream.kind
+        if kind == 'depth':
+            _, position, operation, side, price, size = row
+            self.updateMktDepthL2(stream.reqId, position, '', operation, side, price, size, True)
+        elif kind == 'ticks':
+            _, time, price, size, exchange = row
+            self.tickByTickAllLast(stream.reqId, 1, time // 10**9, price, size, None, exchange.decode('ascii'), '')
+        else:
+            bar = BarData()
+            _, date, bar.open, bar.high, bar.low, bar.close, bar.volume = row
+            bar.date = date.decode('ascii')
+            self.historicalDataUpdate(stream.reqId, bar)
+        self.dispatched[kind] += 1
+
+    def _add_stream(self, reqId, kind, records, position):
+        stream = ReplayStream(reqId, kind, records, position)
+        if stream.exhausted:
+            return
+        self._byReqId[reqId] = stream
+        self._sequence += 1
+        heapq.heappush(self._streams, (stream.time, self._sequence, stream))
+        self.finished.clear()
+
+    def _command(self, *command):
+        self._commands.append(command + (monotonic(),))
+        self._wake.set()
+
+    def _run_commands(self):
+        retry = []
+        while self._commands:
+            command = self._commands.popleft()
+            name, reqId = command[0], command[1]
+            if name != 'cancel' and self.getRequest(reqId) is None:
+                #the wrapper registers a request right after sending it, one that never shows up was cancelled
+                if monotonic() - command[-1] < 1:
+                    retry.append(command)
+                continue
+            try:
+                getattr(self, '_start_' + name)(*command[1:-1])
+            except Exception:
+                log.exception(f'Replay of {command[:-1]} failed')
+        self._commands.extend(retry)
+
+    def _start_cancel(self, reqId):
+        stream = self._byReqId.pop(reqId, None)
+        if stream is not None:
+            stream.cancelled = True
+
+    def _start_ticks(self, reqId, symbol):
+        #trades from the current replay time on
+        records = read_recording(recording_path(self.folder, symbol, 'ticks'), 'ticks')
+        self._add_stream(reqId, 'ticks', records, records['received'].searchsorted(self.clock.now()))
+
+    def _start_depth(self, reqId, symbol):
+        #from the start of the recording, the operations before the current replay time rebuild the book right away
+        self._add_stream(reqId, 'depth', read_recording(recording_path(self.folder, symbol, 'depth'), 'depth'), 0)
+
+    def _start_history(self, reqId, symbol, barSize, endDateTime, durationStr, keepUpToDate):
+        if endDateTime:
+            endTime = pd.to_datetime(endDateTime[:17], format=TIME_FORMAT).tz_localize(self.twsTimezone)
+        else:
+            endTime = pd.Timestamp(self.clock.now(), tz='UTC').tz_convert(self.twsTimezone)
+        startTime = endTime - parse_duration(durationStr)
+
+        history = read_recording(recording_path(self.folder, symbol, 'history', barSize), 'history')
+        if len(history):
+            #responses can overlap, the last recorded version of a bar wins
+            _, last = np.unique(history['epoch_ns'][::-1], return_index=True)
+            history = history[len(history) - 1 - last]
+            history = history[history['epoch_ns'].searchsorted(startTime.value):history['epoch_ns'].searchsorted(endTime.value)]
+            dates = pd.to_datetime(history['epoch_ns'], unit='ns', utc=True).tz_convert(self.twsTimezone)
+            dates = dates.strftime(TIME_FORMAT if is_intraday('bars_'+barSize) else '%Y%m%d')
+            for date, (_, open_, high, low, close, volume) in zip(dates, history.tolist()):
+                bar = BarData()
+                bar.date, bar.open, bar.high, bar.low, bar.close, bar.volume = date, open_, high, low, close, volume
+                self.historicalData(reqId, bar)
+        self.dispatched['history'] += len(history)
+        self.historicalDataEnd(reqId, startTime.strftime(TIME_FORMAT), endTime.strftime(TIME_FORMAT))
+
+        if keepUpToDate:
+            records = read_recording(recording_path(self.folder, symbol, 'bars', barSize), 'bars')
+            self._add_stream(reqId, 'bars', records, records['received'].searchsorted(self.clock.now()))
+
+    def reqHistoricalData(self, reqId, contract, endDateTime, durationStr, barSizeSetting, whatToShow, useRTH,
+                            formatDate, keepUpToDate, chartOptions):
+        self._command('history', reqId, contract.symbol, BAR_SIZE_SETTINGS[barSizeSetting], endDateTime, durationStr, keepUpToDate)
+
+    def reqTickByTickData(self, reqId, contract, tickType, numberOfTicks, ignoreSize):
+        self._command('ticks', reqId, contract.symbol)
+
+    def reqMktDepth(self, reqId, contract, numRows, isSmartDepth, mktDepthOptions):
+        self._command('depth', reqId, contract.symbol)
+
+    def cancelHistoricalData(self, reqId):
+        self._command('cancel', reqId)
+
+    def cancelTickByTickData(self, reqId):
+        self._command('cancel', reqId)
+
+    def cancelMktDepth(self, reqId, isSmartDepth):
+        self._command('cancel', reqId)
+
+    def cancelRealTimeBars(self, reqId):
+        self._command('cancel', reqId)
+
+    def stats(self):
+        elapsed = monotonic() - self._startedAt
+        live = self.dispatched['ticks'] + self.dispatched['depth'] + self.dispatched['bars']
+        return dict(self.dispatched,
+                    streams=len(self._byReqId),
+                    messages_per_s=live / elapsed if elapsed > 0 else 0.0,
+                    max_lag_ms=self.maxLag * 1000,
+                    replay_time=pd.Timestamp(self.clock.now(), tz='UTC').tz_convert(self.twsTimezone))
+
+class ReplayAPIWrapper(IBApiWrapper):
+    #IBApiWrapper on a recorded session, same requests, signals and callbacks. No pacing limits apply.
+    name = "Replay"
+    paced = False
+    clientClass = ReplayClient
+    def __init__(self, folder=None, speed=None):
+        IBApiWrapper.__init__(self)
+        if folder is not None:
+            self.ibapi.folder = folder
+        if speed is not None:
+            self.ibapi.clock.speed = speed
+
+    def connect(self, host=None, port=None, clientId=0):
+        #host and port are only there to match IBApiWrapper
+        self.ibapi.connect(host, port, clientId)
+        self.listeningThread.start()
+
+    def setSpeed(self, speed):
+        self.ibapi.clock.setSpeed(speed)
+
+    def stats(self):
+        return dict(self.ibapi.stats(), event_bus=self.eventBus.stats())
+
+def generate_session(folder, symbols, seconds=60, rate=10000, start=None, barSize='1m', historyBars=2000, timezone='US/Pacific', seed=0):
+    #writes a synthetic session of rate live messages per second over all symbols, about 60% book updates, 40% trades
+    #and a bar update per symbol and second, plus historyBars bars of history before start. Returns the message count.
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp.now(tz='UTC').floor('min') if start is None else pd.Timestamp(start)
+    start_ns = start.value
+    offset = pd.Timedelta(barSize.replace('m', 'min') if barSize.endswith('m') else barSize)
+    dateFormat = TIME_FORMAT if is_intraday('bars_'+barSize) else '%Y%m%d'
+    perSymbol = int(rate * seconds / len(symbols))
+    total = 0
+    for i, symbol in enumerate(symbols):
+        basePrice = 100.0 + 10 * i
+        times = np.sort(rng.integers(start_ns, start_ns + seconds * 10**9, perSymbol))
+        isTrade = rng.random(perSymbol) < 0.4
+
+        tradeTimes = times[isTrade]
+        ticks = np.zeros(len(tradeTimes), dtype=RECORDED_TICK_DTYPE)
+        ticks['received'] = tradeTimes
+        ticks['time'] = tradeTimes // 10**9 * 10**9
+        ticks['price'] = (basePrice + np.cumsum(rng.choice([-0.01, 0.0, 0.01], len(tradeTimes)))).round(2)
+        ticks['size'] = rng.integers(1, 500, len(tradeTimes))
+        ticks['exchange'] = b'NASDAQ'
+        write_recording(recording_path(folder, symbol, 'ticks'), ticks)
+
+        #ten levels a side inserted at the start, then size changes around the last trade
+        levels = np.arange(10)
+        updateTimes = times[~isTrade]
+        depth = np.zeros(20 + len(updateTimes), dtype=RECORDED_DEPTH_DTYPE)
+        depth['received'][:20] = start_ns
+        depth['position'][:20] = np.tile(levels, 2)
+        depth['side'][:20] = np.repeat([0, 1], 10)
+        depth['price'][:20] = np.r_[basePrice + 0.01 * (levels + 1), basePrice - 0.01 * (levels + 1)].round(2)
+        depth['size'][:20] = rng.integers(100, 5000, 20)
+        updates = depth[20:]
+        updates['received'] = updateTimes
+        updates['operation'] = 1
+        updates['position'] = rng.integers(0, 10, len(updateTimes))
+        updates['side'] = rng.integers(0, 2, len(updateTimes))
+        lastTrade = ticks['price'][np.clip(ticks['received'].searchsorted(updateTimes) - 1, 0, None)] if len(ticks) else basePrice
+        updates['price'] = (lastTrade + np.where(updates['side'] == 0, 0.01, -0.01) * (updates['position'] + 1)).round(2)
+        updates['size'] = rng.integers(100, 5000, len(updateTimes))
+        write_recording(recording_path(folder, symbol, 'depth'), depth)
+
+        #the bar being built, as of the last trade of every second
+        trades = pd.DataFrame({'price': ticks['price'], 'size': ticks['size']}, index=pd.to_datetime(ticks['received'], utc=True))
+        barStart = trades.index.floor(offset)
+        grouped = trades.groupby(barStart)
+        running = pd.DataFrame({'open': grouped['price'].transform('first'), 'high': grouped['price'].cummax(),
+                                'low': grouped['price'].cummin(), 'close': trades['price'], 'volume': grouped['size'].cumsum(),
+                                'barStart': barStart}, index=trades.index)
+        running = running[~running.index.floor('s').duplicated(keep='last')]
+        bars = np.zeros(len(running), dtype=RECORDED_BAR_DTYPE)
+        bars['received'] = running.index.asi8
+        bars['date'] = pd.DatetimeIndex(running['barStart']).tz_convert(timezone).strftime(dateFormat).str.encode('ascii')
+        for column in ('open', 'high', 'low', 'close', 'volume'):
+            bars[column] = running[column].to_numpy(dtype=float)
+        write_recording(recording_path(folder, symbol, 'bars', barSize), bars)
+
+        history = np.zeros(historyBars, dtype=BAR_RECORD_DTYPE)
+        history['epoch_ns'] = start_ns - offset.value * np.arange(historyBars, 0, -1)
+        closes = np.cumsum(rng.normal(0, 0.05, historyBars))
+        #ends where the live session starts
+        closes += basePrice - closes[-1]
+        history['open'] = np.r_[closes[0], closes[:-1]]
+        history['close'] = closes
+        history['high'] = np.maximum(history['open'], closes) + rng.random(historyBars) * 0.05
+        history['low'] = np.minimum(history['open'], closes) - rng.random(historyBars) * 0.05
+        history['volume'] = rng.integers(1000, 100000, historyBars)
+        write_recording(recording_path(folder, symbol, 'history', barSize), history)
+
+        total += len(ticks) + len(depth) + len(bars)
+    return total
@@ -0,0 +1,36 @@
+import pandas as pd
+import numpy as np
+
+from .types import BAR_SIZES, is_intraday, get_empty_bar_dataframe
+
+DERIVED_DATA_SOURCE = 'derived'
+DAY_NS = 24 * 60 * 60 * 10**9
+
+def bar_size_timedelta(barSize):
+    return pd.Timedelta(barSize.replace('m', 'T'))
+
+def can_resample(barSize, baseBarSize):
+    #intraday bar sizes that are a whole multiple of the base bar size can be built from it
+    if barSize == baseBarSize or not barSize in BAR_SIZES or not is_intraday('bars_'+barSize):
+        return False
+    return bar_size_timedelta(barSize) % bar_size_timedelta(baseBarSize) == pd.Timedelta(0)
+
+def resample_bars(bars, barSize, sessionOpen):
+    #OHLCV aggregation of sorted base bars into barSize bins counted from sessionOpen (time since midnight) every day
+    if bars.empty:
+        return get_empty_bar_dataframe()
+    freq = bar_size_timedelta(barSize).value
+    openOffset = sessionOpen.value
+    #wall clock ns, so bins line up with the session open on both sides of a DST change
+    wall = bars.index.tz_localize(None).asi8
+    days = wall // DAY_NS * DAY_NS
+    bins = days + openOffset + (wall - days - openOffset) // freq * freq
+    labels, starts = np.unique(bins, return_index=True)
+    stops = np.append(starts[1:], len(bins)) - 1
+
+    return pd.DataFrame({'open': bars['open'].values[starts],
+                            'high': np.maximum.reduceat(bars['high'].values, starts),
+                            'low': np.minimum.reduceat(bars['low'].values, starts),
+                            'close': bars['close'].values[stops],
+                            'volume': np.add.reduceat(bars['volume'].values, starts)},
+                        index=pd.DatetimeIndex(labels).tz_localize(bars.index.tz))
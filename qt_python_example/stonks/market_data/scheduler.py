@@ -0,0 +1,314 @@
+import math
+import threading
+from collections import deque
+from time import monotonic
+
+from ..config import Config
+
+import logging
+log = logging.getLogger('Market Data')
+
+#lower value goes first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_INDICATOR = 1
+PRIORITY_SCANNER = 2
+PRIORITY_PREFETCH = 3
+#share of the global window a priority class has to leave untouched, so background work can't use up the charts' budget
+PRIORITY_RESERVE = {PRIORITY_INTERACTIVE: 0, PRIORITY_INDICATOR: 0, PRIORITY_SCANNER: 1/6, PRIORITY_PREFETCH: 1/3}
+
+class SlidingWindow(object):
+    #at most capacity sends within any period seconds, kept as the send times still inside the window
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.period = period
+        self._sent = deque()
+
+    def _expire(self, now):
+        sent = self._sent
+        while sent and now - sent[0] >= self.period:
+            sent.popleft()
+
+    def count(self, now):
+        self._expire(now)
+        return len(self._sent)
+
+    def waitTime(self, now, reserve=0):
+        #seconds until a send still leaves reserve of the capacity unused
+        self._expire(now)
+        allowed = max(1, self.capacity - math.ceil(reserve))
+        sent = self._sent
+        if len(sent) < allowed:
+            return 0
+        #the send that has to drop out of the window first
+        return sent[len(sent) - allowed] + self.period - now
+
+    def take(self, now):
+        self._sent.append(now)
+
+class Ticket(object):
+    #one caller's interest in a scheduled request
+    def __init__(self, scheduler, entry, callback, error_callback, owner):
+        self._scheduler = scheduler
+        self.entry = entry
+        self.callback = callback
+        self.error_callback = error_callback
+        self.owner = owner
+        self.cancelled = False
+
+    def cancel(self):
+        self._scheduler.cancel(self)
+
+class ScheduledRequest(object):
+    QUEUED = 0
+    IN_FLIGHT = 1
+    DONE = 2
+    def __init__(self, key, priority, sequence):
+        self.key = key
+        self.priority = priority
+        self.sequence = sequence
+        self.tickets = []
+        self.state = ScheduledRequest.QUEUED
+        self.providerRequest = None
+        self.queuedAt = monotonic()
+        self.notBefore = 0
+        self.sentAt = None
+
+class HistoricalRequestScheduler(object):
+    #sits between MarketData and the IBKR wrapper and sends historical requests only as fast as IBKR's pacing rules allow:
+    #60 requests per 10 minutes, fewer than 6 per contract in 2 seconds, no identical request within 15 seconds,
+    #and a cap on requests in flight. Identical queued or in flight requests are shared.
+    IDENTICAL_INTERVAL = 15
+    PACING_BACKOFF = 30
+    def __init__(self, api):
+        self.api = api
+        self.config = Config()
+        self.maxInFlight = self.config.get_property("ibkr_max_inflight_historical", 50)
+        #requests IBKR never answers are failed after this many seconds, so they can't hold a slot forever
+        self.timeout = self.config.get_property("ibkr_historical_timeout", 120)
+        #(deadline, entry) in send order
+        self._deadlines = deque()
+        self._globalWindow = SlidingWindow(self.config.get_property("ibkr_pacing_requests_per_10min", 60), 600)
+        self._contractWindows = {}
+        #nothing is sent before this after a pacing violation
+        self._pausedUntil = 0
+        self._lastSent = {}
+        self._entries = {}
+        self._queue = []
+        self._owners = {}
+        self._inFlight = 0
+        self._sequence = 0
+        self._stop = False
+        self._condition = threading.Condition()
+
+        self.sent = 0
+        self.shared = 0
+        self.cancelled = 0
+        self.pacingViolations = 0
+        self.timeouts = 0
+        self.maxQueueTime = 0.0
+
+        self._thread = threading.Thread(target=self._run, name='HistoricalRequestScheduler', daemon=True)
+        self._thread.start()
+
+    def submit(self, symbol, barSize, startTime, endTime, callback, error_callback=None, priority=PRIORITY_INTERACTIVE, owner=None):
+        key = (symbol, barSize, startTime, endTime)
+        with self._condition:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._sequence += 1
+                entry = ScheduledRequest(key, priority, self._sequence)
+                self._entries[key] = entry
+                self._queue.append(entry)
+            else:
+                self.shared += 1
+                entry.priority = min(entry.priority, priority)
+            ticket = Ticket(self, entry, callback, error_callback, owner)
+            entry.tickets.append(ticket)
+            if owner is not None:
+                self._owners.setdefault(id(owner), set()).add(ticket)
+            self._condition.notify()
+        return ticket
+
+    def cancel(self, ticket):
+        providerRequest = None
+        with self._condition:
+            if ticket.cancelled:
+                return
+            ticket.cancelled = True
+            self._forget_owner(ticket)
+            entry = ticket.entry
+            if ticket in entry.tickets:
+                entry.tickets.remove(ticket)
+            if entry.tickets or entry.state == ScheduledRequest.DONE:
+                return
+            #nobody wants the result anymore
+            self.cancelled += 1
+            self._entries.pop(entry.key, None)
+            if entry.state == ScheduledRequest.QUEUED:
+                self._queue.remove(entry)
+            else:
+                providerRequest = entry.providerRequest
+                self._inFlight -= 1
+            entry.state = ScheduledRequest.DONE
+            self._condition.notify()
+        if providerRequest is not None:
+            log.debug(f'Cancelling historical request {entry.key}')
+            providerRequest.cancel()
+
+    def cancelOwner(self, owner):
+        with self._condition:
+            tickets = list(self._owners.get(id(owner), ()))
+        for ticket in tickets:
+            self.cancel(ticket)
+
+    def stats(self):
+        with self._condition:
+            return {'queued': len(self._queue),
+                    'in_flight': self._inFlight,
+                    'sent': self.sent,
+                    'shared': self.shared,
+                    'cancelled': self.cancelled,
+                    'pacing_violations': self.pacingViolations,
+                    'timeouts': self.timeouts,
+                    'sent_last_10min': self._globalWindow.count(monotonic()),
+                    'max_queue_time': self.maxQueueTime}
+
+    def stop(self):
+        with self._condition:
+            self._stop = True
+            self._condition.notify()
+
+    def _forget_owner(self, ticket):
+        if ticket.owner is None:
+            return
+        tickets = self._owners.get(id(ticket.owner))
+        if tickets is not None:
+            tickets.discard(ticket)
+            if not tickets:
+                del self._owners[id(ticket.owner)]
+
+    def _contract_window(self, symbol):
+        window = self._contractWindows.get(symbol)
+        if window is None:
+            #six or more requests for a contract within 2 seconds is a violation
+            window = self._contractWindows[symbol] = SlidingWindow(5, 2)
+        return window
+
+    def _next(self, now):
+        #(entry ready to send, None) or (None, seconds to wait before anything can be sent)
+        if self._inFlight >= self.maxInFlight:
+            return None, None
+        if self.api.paced and now < self._pausedUntil:
+            return None, self._pausedUntil - now
+        wait = None
+        for entry in sorted(self._queue, key=lambda entry: (entry.priority, entry.sequence)):
+            if not self.api.paced:
+                #providers without pacing rules only get the in flight cap and priority order
+                return entry, None
+            symbol = entry.key[0]
+            entryWait = max(entry.notBefore - now,
+                            self._lastSent.get(entry.key, -self.IDENTICAL_INTERVAL) + self.IDENTICAL_INTERVAL - now,
+                            self._globalWindow.waitTime(now, PRIORITY_RESERVE.get(entry.priority, 0) * self._globalWindow.capacity),
+                            self._contract_window(symbol).waitTime(now))
+            if entryWait <= 0:
+                return entry, None
+            wait = entryWait if wait is None else min(wait, entryWait)
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stop:
+                    return
+                now = monotonic()
+                expired = self._expired(now)
+                entry = None
+                if not expired:
+                    entry, wait = self._next(now)
+                    if entry is None:
+                        if self._deadlines:
+                            deadlineWait = self._deadlines[0][0] - now
+                            wait = deadlineWait if wait is None else min(wait, deadlineWait)
+                        self._condition.wait(wait)
+                        continue
+                    self._queue.remove(entry)
+                    entry.state = ScheduledRequest.IN_FLIGHT
+                    entry.sentAt = now
+                    self._deadlines.append((now + self.timeout, entry))
+                    self._inFlight += 1
+                    self._globalWindow.take(now)
+                    self._contract_window(entry.key[0]).take(now)
+                    self._lastSent[entry.key] = now
+                    if len(self._lastSent) > 1024:
+                        self._lastSent = {key: sent for key, sent in self._lastSent.items() if now - sent < self.IDENTICAL_INTERVAL}
+                    self.sent += 1
+                    self.maxQueueTime = max(self.maxQueueTime, now - entry.queuedAt)
+            for expiredEntry in expired:
+                #frees the slot and fails every caller waiting on it
+                log.warning(f'Historical request {expiredEntry.key} timed out after {self.timeout}s')
+                if expiredEntry.providerRequest is not None:
+                    expiredEntry.providerRequest.cancel()
+                self._failed_callback(expiredEntry)(expiredEntry.key[0], expiredEntry.key[1], -1, f'No response within {self.timeout}s')
+            if entry is None:
+                continue
+            symbol, barSize, startTime, endTime = entry.key
+            try:
+                entry.providerRequest = self.api.requestHistoricalBars(symbol, barSize, startTime, endTime, False,
+                                                                        self._finished_callback(entry),
+                                                                        error_callback=self._failed_callback(entry))
+            except Exception as e:
+                log.exception(f'Historical request {entry.key} failed to send')
+                self._failed_callback(entry)(symbol, barSize, -1, str(e))
+
+    def _expired(self, now):
+        #in flight entries past their deadline, deadlines of requests that finished or were resent are dropped
+        expired = []
+        deadlines = self._deadlines
+        while deadlines and deadlines[0][0] <= now:
+            _, entry = deadlines.popleft()
+            if entry.state == ScheduledRequest.IN_FLIGHT and entry.sentAt + self.timeout <= now:
+                expired.append(entry)
+                self.timeouts += 1
+        return expired
+
+    def _complete(self, entry):
+        with self._condition:
+            if entry.state != ScheduledRequest.IN_FLIGHT:
+                return []
+            entry.state = ScheduledRequest.DONE
+            self._inFlight -= 1
+            self._entries.pop(entry.key, None)
+            tickets = [ticket for ticket in entry.tickets if not ticket.cancelled]
+            for ticket in tickets:
+                self._forget_owner(ticket)
+            self._condition.notify()
+        return tickets
+
+    def _finished_callback(self, entry):
+        def callback(symbol, barSize, bars, startTime, endTime):
+            #every caller gets the same dataframe
+            for ticket in self._complete(entry):
+                if ticket.callback is not None:
+                    ticket.callback(symbol, barSize, bars, startTime, endTime)
+        return callback
+
+    def _failed_callback(self, entry):
+        def error_callback(symbol, barSize, errorCode, errorMsg):
+            if 'pacing violation' in str(errorMsg).lower():
+                #IBKR stalls everything after a violation, so back off and send this one again later
+                with self._condition:
+                    if entry.state == ScheduledRequest.IN_FLIGHT:
+                        self.pacingViolations += 1
+                        log.warning(f'Pacing violation on {entry.key}, backing off {self.PACING_BACKOFF}s')
+                        now = monotonic()
+                        self._pausedUntil = now + self.PACING_BACKOFF
+                        entry.state = ScheduledRequest.QUEUED
+                        entry.notBefore = now + self.PACING_BACKOFF
+                        self._inFlight -= 1
+                        self._queue.append(entry)
+                        self._condition.notify()
+                        return
+            for ticket in self._complete(entry):
+                if ticket.error_callback is not None:
+                    ticket.error_callback(symbol, barSize, errorCode, errorMsg)
+        return error_callback
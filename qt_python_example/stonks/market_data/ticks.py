@@ -0,0 +1,183 @@
+import numpy as np
+import pandas as pd
+
+import os
+import glob
+import threading
+
+from ..config import Config
+from ..utils import singleton
+
+import logging
+log = logging.getLogger('Market Data')
+
+TICK_DTYPE = np.dtype([('time', 'i8'), ('price', 'f8'), ('size', 'f8'), ('exchange', 'S8')])
+DEFAULT_TICK_FOLDER = "%LOCALAPPDATA%\\StonX\\ticks"
+#ticks are written to the spill file in batches of this many, straight out of the ring
+SPILL_BATCH = 4096
+
+class TickRingBuffer(object):
+    #preallocated ring of the latest ticks of one symbol, written by a single thread (the IBKR reader)
+    #every record is stored twice, at i and i + capacity, so any window of up to capacity ticks is one contiguous view
+    def __init__(self, symbol, capacity, spillFolder=None, timezone='US/Eastern'):
+        self.symbol = symbol
+        self.capacity = capacity
+        self.count = 0
+        self._data = np.zeros(capacity * 2, dtype=TICK_DTYPE)
+
+        self.spillFolder = spillFolder
+        self.timezone = timezone
+        self._spilled = 0
+        self._spillFile = None
+        self._dayEnd_ns = None
+        self._lock = threading.Lock()
+
+    def append(self, time_ns, price, size, exchange=''):
+        if self.spillFolder is not None and (self._dayEnd_ns is None or time_ns >= self._dayEnd_ns):
+            self._roll_day(time_ns)
+        position = self.count % self.capacity
+        record = (time_ns, price, size, exchange.encode('ascii', 'replace')[:8])
+        self._data[position] = record
+        self._data[position + self.capacity] = record
+        #published only after the record is complete
+        self.count += 1
+        if self.spillFolder is not None and self.count - self._spilled >= SPILL_BATCH:
+            self.flush()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def latest(self, count=None):
+        #read-only view of the last count ticks, oldest first
+        #views stay valid until the ring laps them, i.e. for the next capacity - count ticks
+        total = self.count
+        count = len(self) if count is None else min(count, len(self), total)
+        start = (total - count) % self.capacity
+        view = self._data[start:start + count]
+        view.flags.writeable = False
+        return view
+
+    def since(self, sequence):
+        #(ticks appended after sequence, new sequence) for incremental readers like time and sales
+        total = self.count
+        if sequence < total - self.capacity:
+            log.warning(f'{self.symbol} tick reader fell behind, {total - self.capacity - sequence} ticks lost')
+        return self.latest(total - sequence), total
+
+    def flush(self):
+        with self._lock:
+            pending = self.count - self._spilled
+            if self._spillFile is None or pending <= 0:
+                return
+            start = self._spilled % self.capacity
+            self._spillFile.write(memoryview(self._data[start:start + pending]))
+            self._spillFile.flush()
+            self._spilled += pending
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._spillFile is not None:
+                self._spillFile.close()
+                self._spillFile = None
+
+    def _roll_day(self, time_ns):
+        #one spill file per trading day, named by the exchange date
+        self.close()
+        day = pd.Timestamp(time_ns, tz='UTC').tz_convert(self.timezone).normalize()
+        self._dayEnd_ns = (day + pd.Timedelta(days=1)).value
+        path = tick_file_path(self.spillFolder, self.symbol, day.strftime('%Y-%m-%d'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._spillFile = open(path, 'ab')
+        self._spilled = self.count
+
+def tick_file_path(folder, symbol, day):
+    return os.path.join(folder, symbol.upper(), f'{day}.ticks')
+
+def read_tick_file(path):
+    #zero-copy memory map of a spilled day, empty array for a missing or empty file
+    if not os.path.isfile(path) or os.path.getsize(path) < TICK_DTYPE.itemsize:
+        return np.zeros(0, dtype=TICK_DTYPE)
+    #a crash can leave a partial record at the end
+    count = os.path.getsize(path) // TICK_DTYPE.itemsize
+    return np.memmap(path, dtype=TICK_DTYPE, mode='r', shape=(count,))
+
+def ticks_dataframe(ticks, tz='US/Eastern'):
+    dataframe = pd.DataFrame({'price': ticks['price'], 'size': ticks['size'],
+                                'exchange': ticks['exchange'].astype(str)},
+                                index=pd.to_datetime(ticks['time'], unit='ns', utc=True).tz_convert(tz))
+    dataframe.index.name = 'time'
+    return dataframe
+
+@singleton
+class TapeStore(object):
+    def __init__(self):
+        self.config = Config()
+        memoryBudget = self.config.get_property("tick_buffer_mb", 8) * 1024 * 1024
+        self.capacity = max(SPILL_BATCH, memoryBudget // (TICK_DTYPE.itemsize * 2))
+        self.spillFolder = None
+        if self.config.get_property("tick_spill", False):
+            self.spillFolder = os.path.expandvars(self.config.get_property("tick_spill_folder", DEFAULT_TICK_FOLDER))
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    def buffer(self, symbol):
+        symbol = symbol.upper()
+        ringBuffer = self._buffers.get(symbol)
+        if ringBuffer is None:
+            with self._lock:
+                ringBuffer = self._buffers.get(symbol)
+                if ringBuffer is None:
+                    ringBuffer = TickRingBuffer(symbol, self.capacity, self.spillFolder)
+                    self._buffers[symbol] = ringBuffer
+        return ringBuffer
+
+    def append(self, symbol, time_ns, price, size, exchange=''):
+        self.buffer(symbol).append(time_ns, price, size, exchange)
+
+    def latest(self, symbol, count=None):
+        return self.buffer(symbol).latest(count)
+
+    def since(self, symbol, sequence):
+        return self.buffer(symbol).since(sequence)
+
+    def days(self, symbol):
+        if self.spillFolder is None:
+            return []
+        paths = glob.glob(tick_file_path(self.spillFolder, symbol, '*'))
+        return sorted(os.path.basename(path)[:-len('.ticks')] for path in paths)
+
+    def readTicks(self, symbol, startTime, endTime):
+        #spilled ticks in [startTime, endTime], one memory mapped array per day
+        if self.spillFolder is None:
+            return []
+        ringBuffer = self._buffers.get(symbol.upper())
+        if ringBuffer is not None:
+            ringBuffer.flush()
+        start_ns, end_ns = pd.Timestamp(startTime).value, pd.Timestamp(endTime).value
+        firstDay = pd.Timestamp(startTime).tz_convert('US/Eastern').strftime('%Y-%m-%d')
+        lastDay = pd.Timestamp(endTime).tz_convert('US/Eastern').strftime('%Y-%m-%d')
+        result = []
+        for day in self.days(symbol):
+            if day < firstDay or day > lastDay:
+                continue
+            ticks = read_tick_file(tick_file_path(self.spillFolder, symbol, day))
+            times = ticks['time']
+            ticks = ticks[times.searchsorted(start_ns):times.searchsorted(end_ns, side='right')]
+            if len(ticks):
+                result.append(ticks)
+        return result
+
+    def replay(self, symbol, startTime, endTime, callback):
+        #feeds recorded ticks to callback(symbol, time, price, size) in order, as fast as possible, for backtests
+        count = 0
+        for ticks in self.readTicks(symbol, startTime, endTime):
+            times = ticks['time'] // 10**9
+            for time, price, size in zip(times.tolist(), ticks['price'].tolist(), ticks['size'].tolist()):
+                callback(symbol, time, price, size)
+            count += len(ticks)
+        return count
+
+    def close(self):
+        for ringBuffer in list(self._buffers.values()):
+            ringBuffer.close()
@@ -1,6 +1,7 @@
 import pandas as pd
 import numpy as np
 from decimal import Decimal, getcontext
+import time
 
 #Set Decimal Precision
 getcontext().prec = 6
@@ -33,37 +34,217 @@ class CandleBar(object):
     def dataframe(self):
         return pd.DataFrame(np.array([[self.open, self.high, self.low, self.close, self.volume]]), columns=["open", "high", "low", "close", "volume"], index=[self.time])
 
-class MarketDepth(object):
-    def __init__(self, ticker_name):
+#order book prices are kept as integer ticks of 10^-PRICE_DECIMALS
+PRICE_DECIMALS = 6
+TICK_SCALE = 10**PRICE_DECIMALS
+
+def price_to_ticks(price):
+    return int(round(float(price) * TICK_SCALE))
+
+def ticks_to_price(ticks):
+    #exact Decimal of an integer tick count, without going through the 6 digit Decimal context
+    units, fraction = divmod(int(ticks), TICK_SCALE)
+    if not fraction:
+        return Decimal(units)
+    return Decimal(f'{units}.{fraction:0{PRICE_DECIMALS}d}'.rstrip('0'))
+
+def bucket_ticks(ticks, step):
+    #nearest multiple of step, ties to the even multiple, for ints or int arrays
+    quotient = ticks // step
+    remainder = ticks - quotient * step
+    roundUp = (2 * remainder > step) | ((2 * remainder == step) & (quotient % 2 == 1))
+    return (quotient + roundUp) * step
+
+def ladder_step(minStep):
+    #step in ticks, at least one, a step finer than the tick scale would round to zero
+    return max(1, price_to_ticks(minStep)) if minStep else 1
+
+class PriceLadder(object):
+    #book sizes summed per side into price buckets of step ticks, updated one level change at a time
+    def __init__(self, step, book):
+        self.step = step
+        self.sizes = [{}, {}]
+        self._dataframe = None
+        for side in (BookView.ASK, BookView.BID):
+            prices, sizes = book.side(side)
+            buckets, inverse = np.unique(bucket_ticks(prices, step), return_inverse=True)
+            self.sizes[side] = dict(zip(buckets.tolist(), np.bincount(inverse, weights=sizes, minlength=len(buckets)).tolist()))
+
+    def add(self, side, ticks, size):
+        bucket = bucket_ticks(ticks, self.step)
+        sizes = self.sizes[side]
+        total = sizes.get(bucket, 0.0) + size
+        if abs(total) < 1e-9:
+            sizes.pop(bucket, None)
+        else:
+            sizes[bucket] = total
+        self._dataframe = None
+
+    def copy(self):
+        ladder = PriceLadder.__new__(PriceLadder)
+        ladder.step = self.step
+        ladder.sizes = [self.sizes[0].copy(), self.sizes[1].copy()]
+        ladder._dataframe = self._dataframe
+        return ladder
+
+    def dataframe(self):
+        #only rebuilt after the ladder changed, repaints at the same step reuse it
+        if self._dataframe is None:
+            askSizes, bidSizes = self.sizes
+            prices = sorted(askSizes.keys() | bidSizes.keys())
+            index = pd.Index([ticks_to_price(ticks) for ticks in prices], name='price', dtype=object)
+            self._dataframe = pd.DataFrame({'size_bid': [bidSizes.get(ticks, 0.0) for ticks in prices],
+                                            'size_ask': [askSizes.get(ticks, 0.0) for ticks in prices]}, index=index)
+        return self._dataframe
+
+class BookView(object):
+    #what MarketDepth and its snapshots share, subclasses provide side()
+    ASK = 0
+    BID = 1
+    def side(self, side):
+        raise NotImplementedError
+
+    def __len__(self):
+        return len(self.side(self.ASK)[0]) + len(self.side(self.BID)[0])
+
+    @property
+    def dataframe(self):
+        frames = []
+        for side in (self.ASK, self.BID):
+            prices, sizes = self.side(side)
+            frames.append(pd.DataFrame({'price': prices / TICK_SCALE, 'size': sizes,
+                                        'side': side, 'position': np.arange(len(prices))}))
+        return pd.concat(frames).set_index(["side", "position"])
+
+class MarketDepth(BookView):
+    #one array of tick prices and sizes per side (0 = ask, 1 = bid), indexed by book position like IBKR's depth messages
+    def __init__(self, ticker_name, capacity=100):
         self.ticker_name = ticker_name
-        self.dataframe = pd.DataFrame(columns=["price", "size", "side", "position"])
-        self.dataframe = self.dataframe.set_index(["side", "position"])
+        self._prices = [np.zeros(capacity, dtype=np.int64), np.zeros(capacity, dtype=np.int64)]
+        self._sizes = [np.zeros(capacity, dtype=np.float64), np.zeros(capacity, dtype=np.float64)]
+        self._levels = [0, 0]
+        #PriceLadder per step in ticks, created the first time bookData is asked for that step
+        self._ladders = {}
+        #steps snapshot readers asked for or let go of, picked up by the thread that owns the book on the next snapshot
+        self._requestedSteps = set()
+        self._releasedSteps = set()
 
     def insert(self, position, price, side, size):
-        self.dataframe.loc[(side, position), :] = [round(Decimal(price),6), size]
+        #rows at and below position move down one level
+        levels = self._levels[side]
+        position = min(position, levels)
+        self._reserve(side, levels + 1)
+        prices, sizes = self._prices[side], self._sizes[side]
+        prices[position+1:levels+1] = prices[position:levels]
+        sizes[position+1:levels+1] = sizes[position:levels]
+        ticks, size = price_to_ticks(price), float(size)
+        prices[position] = ticks
+        sizes[position] = size
+        self._levels[side] = levels + 1
+        self._ladder_change(side, None, None, ticks, size)
 
     def update(self, position, price, side, size):
-        self.dataframe.loc[(side, position), :] = [round(Decimal(price),6), size]
+        if position >= self._levels[side]:
+            self.insert(position, price, side, size)
+            return
+        prices, sizes = self._prices[side], self._sizes[side]
+        ticks, size = price_to_ticks(price), float(size)
+        if self._ladders:
+            self._ladder_change(side, int(prices[position]), float(sizes[position]), ticks, size)
+        prices[position] = ticks
+        sizes[position] = size
 
     def delete(self, position, price, side, size):
-        self.dataframe = self.dataframe.drop(index=(side, position))
+        #rows below position move up one level
+        levels = self._levels[side]
+        if position >= levels:
+            return
+        prices, sizes = self._prices[side], self._sizes[side]
+        if self._ladders:
+            self._ladder_change(side, int(prices[position]), float(sizes[position]), None, None)
+        prices[position:levels-1] = prices[position+1:levels]
+        sizes[position:levels-1] = sizes[position+1:levels]
+        self._levels[side] = levels - 1
+
+    def _ladder_change(self, side, oldTicks, oldSize, newTicks, newSize):
+        #levels that only shifted position keep their price and size, so just the touched level reaches the ladders
+        for ladder in self._ladders.values():
+            if oldTicks is not None:
+                ladder.add(side, oldTicks, -oldSize)
+            if newTicks is not None:
+                ladder.add(side, newTicks, newSize)
+
+    def _reserve(self, side, levels):
+        capacity = len(self._prices[side])
+        if levels <= capacity:
+            return
+        capacity = max(levels, capacity * 2)
+        self._prices[side] = np.resize(self._prices[side], capacity)
+        self._sizes[side] = np.resize(self._sizes[side], capacity)
+
+    def side(self, side):
+        #(tick prices, sizes) of the populated levels, views into the book
+        levels = self._levels[side]
+        return self._prices[side][:levels], self._sizes[side][:levels]
 
     def bookData(self, minStep=None):
-        try:
-            bidData = self.dataframe.loc[1,:].set_index('price').filter(['size'])
-            askData = self.dataframe.loc[0,:].set_index('price').filter(['size'])
-        except KeyError:
-            print('WARNING: KeyError while generating book depth data')
-            return pd.DataFrame(columns=["size_bid", "size_ask"])
-        except IndexError:
-            print('WARNING: IndexError while generating book depth data')
-            return pd.DataFrame(columns=["size_bid", "size_ask"])
-        data = bidData.join(askData, lsuffix="_bid", rsuffix="_ask", how="outer")
-        if minStep:
-            minStep = Decimal(minStep)
-            data['price_consolidated'] = data.apply(lambda row: (round(Decimal(row.name) / minStep)*minStep) if not pd.isna(row.name) and Decimal(row.name) % minStep != 0 else row.name, axis=1)
-            data = data.groupby(data.price_consolidated).sum()
-            data.index.name = 'price'
-        else:
-            data = data.groupby(data.index).sum()
-        return data
+        step = ladder_step(minStep)
+        ladder = self._ladders.get(step)
+        if ladder is None:
+            ladder = PriceLadder(step, self)
+            self._ladders[step] = ladder
+        return ladder.dataframe()
+
+    def requestLadder(self, step):
+        self._releasedSteps.discard(step)
+        self._requestedSteps.add(step)
+
+    def releaseLadder(self, minStep=None):
+        #the ladder stops being kept up to date, asking for the step again rebuilds it
+        step = ladder_step(minStep)
+        self._requestedSteps.discard(step)
+        self._releasedSteps.add(step)
+
+    def snapshot(self):
+        #called by the thread that mutates the book, the result is never touched by it again
+        for step in list(self._releasedSteps):
+            self._releasedSteps.discard(step)
+            if not step in self._requestedSteps:
+                self._ladders.pop(step, None)
+        for step in list(self._requestedSteps):
+            if not step in self._ladders:
+                self._ladders[step] = PriceLadder(step, self)
+        sides = []
+        for side in (self.ASK, self.BID):
+            prices, sizes = self.side(side)
+            sides.append((prices.copy(), sizes.copy()))
+        ladders = {step: ladder.copy() for step, ladder in self._ladders.items()}
+        return MarketDepthSnapshot(self, sides, ladders)
+
+class MarketDepthSnapshot(BookView):
+    #immutable copy of a MarketDepth at one moment, safe to read from any thread without locking
+    def __init__(self, book, sides, ladders):
+        self.ticker_name = book.ticker_name
+        self.time = time.time()
+        self._book = book
+        for prices, sizes in sides:
+            prices.flags.writeable = False
+            sizes.flags.writeable = False
+        self._sides = sides
+        self._ladders = ladders
+
+    def side(self, side):
+        return self._sides[side]
+
+    def bookData(self, minStep=None):
+        step = ladder_step(minStep)
+        ladder = self._ladders.get(step)
+        if ladder is None:
+            #built from this snapshot's levels, the book keeps it up to date for the snapshots after this one
+            ladder = PriceLadder(step, self)
+            self._ladders[step] = ladder
+            self._book.requestLadder(step)
+        return ladder.dataframe()
+
+    def releaseLadder(self, minStep=None):
+        self._book.releaseLadder(minStep)
@@ -1,7 +1,10 @@
 import yfinance as yf
 import pandas as pd
+import numpy as np
 
 from .base import *
+from .types import is_intraday
+from .cache import MarketDataCache, BAR_COLUMNS
 
 from PySide2.QtGui import *
 from PySide2.QtCore import *
@@ -10,25 +13,141 @@ from PySide2.QtWidgets import *
 from ..config import Config
 from ..utils import trading_offset_factory, get_market_hours, singleton
 
+import logging
+log = logging.getLogger('Market Data')
+
+#Yahoo intervals for the bar sizes it has, everything else has to come from IBKR
+YAHOO_INTERVALS = {'1m': '1m', '2m': '2m', '5m': '5m', '15m': '15m', '30m': '30m', '1h': '60m',
+                    '1D': '1d', '1W': '1wk', '1M': '1mo'}
+YAHOO_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume']
+
 class YahooSignals(QObject):
     onHistoricalBarEnd = Signal(str, pd.DataFrame, pd.Timestamp, pd.Timestamp, str, tuple)
+    onHistoricalBarError = Signal(str, str, int, str, tuple)
 
 class YahooAPIWrapper(BaseAPIWrapper):
     name = "Yahoo Finance"
     def __init__(self):
-        pass
+        self.config = Config()
+        #same timezone MarketDataCache returns bars in
+        self.twsTimezone = self.config.get_property("timezone_tws", "US/Pacific")
+        #Yahoo only keeps weeks of intraday history, so by default intraday bar sizes stay with IBKR
+        self.barSizes = self.config.get_property("yahoo_bar_sizes", ['1D', '1W', '1M'])
+
+        self.signals = YahooSignals()
+        self.onHistoricalBarEnd = self.signals.onHistoricalBarEnd
+        self.onHistoricalBarError = self.signals.onHistoricalBarError
+        self.onHistoricalBarEnd.connect(self.historicalBarsCallback)
+        self.onHistoricalBarError.connect(self.historicalBarsErrorCallback)
 
     @to_thread
-    def requestHistoricalBars(self, symbols, barSize='1m', startTime=None, endTime=None, callback=None, error_callback=None):
-        symbols_str = ' '.join(symbols)
-        bars = yf.download(symbols_str,
+    def requestHistoricalBars(self, symbols, barSize='1D', startTime=None, endTime=None, callback=None, error_callback=None):
+        #one download for every symbol, cached and then delivered per symbol like IBKR's bars
+        if isinstance(symbols, str):
+            symbols = symbols.split()
+        symbols = [symbol.upper() for symbol in symbols]
+        errorMsg = f'{self.name} returned no bars'
+        try:
+            frames = self.downloadHistoricalBars(symbols, barSize, startTime, endTime)
+        except Exception as e:
+            log.exception(f'{self.name} download of {len(symbols)} symbols failed')
+            frames = {}
+            errorMsg = str(e)
+        self.cacheHistoricalBars(frames, barSize)
+
+        for symbol in symbols:
+            if not symbol in frames:
+                self.onHistoricalBarError.emit(symbol, barSize, -1, errorMsg, (error_callback))
+                continue
+            bars = frames[symbol]
+            if startTime is not None and endTime is not None:
+                bars = bars.iloc[bars.index.searchsorted(startTime):bars.index.searchsorted(endTime, side='right')]
+            self.onHistoricalBarEnd.emit(symbol, bars, startTime, endTime, barSize, (callback))
+
+    def supportsBarSize(self, barSize):
+        return barSize in YAHOO_INTERVALS and barSize in self.barSizes
+
+    def downloadHistoricalBars(self, symbols, barSize, startTime, endTime):
+        #blocking download of a batch of symbols, {symbol: ohlcv dataframe} for the ones Yahoo returned bars for
+        symbols = list(symbols)
+        bars = yf.download(symbols,
                             start=startTime,
-                            end=endTime,
-                            interval=barSize,
-                            prepost=True)
+                            end=None if endTime is None else endTime + pd.Timedelta(days=1),
+                            interval=YAHOO_INTERVALS[barSize],
+                            prepost=True,
+                            group_by='ticker',
+                            auto_adjust=False,
+                            progress=False,
+                            threads=True)
+        return self.splitDownload(bars, symbols, barSize)
 
-        self.onHistoricalBarEnd.emit(symbols_str, bars, startTime, endTime, barSize, (callback))
+    def splitDownload(self, bars, symbols, barSize):
+        #the (symbol, field) column grid is stacked into one long frame, so timezones are converted once for the whole
+        #download and every symbol's bars are a contiguous slice of it instead of a column selection and copy each
+        if bars is None or bars.empty:
+            return {}
+        if not isinstance(bars.columns, pd.MultiIndex):
+            bars = pd.concat({symbols[0]: bars}, axis=1)
+        #stack drops the rows of symbols that have no bar at that time
+        stacked = bars.stack(level=0)
+        missingColumns = [column for column in YAHOO_COLUMNS if not column in stacked.columns]
+        if missingColumns:
+            log.warning(f'{self.name} download without {missingColumns} columns')
+            return {}
+        stacked = stacked[YAHOO_COLUMNS].dropna(subset=['Close'])
+        if stacked.empty:
+            return {}
+        stacked = stacked.swaplevel().sort_index()
 
+        tickers = stacked.index.get_level_values(0).to_numpy()
+        dates = self.normalizeDates(pd.DatetimeIndex(stacked.index.get_level_values(1)), barSize)
+        dates.name = 'date'
+        values = stacked.to_numpy(dtype=float)
+        starts = np.flatnonzero(np.r_[True, tickers[1:] != tickers[:-1]])
+        stops = np.append(starts[1:], len(tickers))
+
+        wanted = set(symbols)
+        result = {}
+        for start, stop in zip(starts, stops):
+            symbol = tickers[start]
+            if symbol in wanted:
+                result[symbol] = pd.DataFrame(values[start:stop], index=dates[start:stop], columns=BAR_COLUMNS)
+        return result
+
+    def normalizeDates(self, index, barSize):
+        #bar times as MarketDataCache returns them, in the TWS timezone
+        if not is_intraday('bars_'+barSize):
+            #daily and longer bars are dated at midnight TWS time, like the ones IBKR returns
+            if index.tz is not None:
+                index = index.tz_localize(None)
+            return index.normalize().tz_localize(self.twsTimezone)
+        if index.tz is None:
+            index = index.tz_localize('US/Eastern')
+        return index.tz_convert(self.twsTimezone)
+
+    def cacheHistoricalBars(self, frames, barSize):
+        #one bulk write for the whole download, limited to each symbol's uncached ranges so the bars and data_source
+        #of chunks another provider already filled are left alone
+        cache = MarketDataCache()
+        dataType = 'bars_'+barSize
+        dataItems = []
+        for symbol, bars in frames.items():
+            if bars.empty:
+                continue
+            for rangeStart, rangeEnd in cache.getMissingRanges(symbol, dataType, bars.index[0], bars.index[-1]):
+                rangeBars = bars.iloc[bars.index.searchsorted(rangeStart):bars.index.searchsorted(rangeEnd)]
+                #one item per range, chunks between two ranges aren't marked as coming from Yahoo
+                dataItems.append((symbol, dataType, rangeBars))
+        if dataItems:
+            cache.addBulkData(dataItems, self.name, backfill=True, wait=True)
+        return dataItems
+
+    @Slot(str, pd.DataFrame, pd.Timestamp, pd.Timestamp, str, tuple)
     def historicalBarsCallback(self, symbol, bars, startTime, endTime, barSize, callback):
         if callback is not None:
-            callback(symbol, bars, startTime, endTime, barSize)
+            callback(symbol, barSize, bars, startTime, endTime)
+
+    @Slot(str, str, int, str, tuple)
+    def historicalBarsErrorCallback(self, symbol, barSize, errorCode, errorMsg, error_callback):
+        if error_callback is not None:
+            error_callback(symbol, barSize, errorCode, errorMsg)
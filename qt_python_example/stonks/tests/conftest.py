@@ -0,0 +1,9 @@
+import pytest
+
+@pytest.fixture(autouse=True, scope='session')
+def config_folder(tmp_path_factory):
+    #Config creates its "%LOCALAPPDATA%\StonX" folder relative to the working directory outside Windows
+    folder = tmp_path_factory.mktemp('config')
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.chdir(folder)
+        yield folder
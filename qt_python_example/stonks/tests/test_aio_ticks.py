@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+from stonks.market_data.aio import AsyncMarketData, MarketDataError
+from stonks.market_data.ticks import TickRingBuffer
+
+class FakeTape(object):
+    def __init__(self, capacity):
+        self.ring = TickRingBuffer('SPY', capacity)
+
+    def buffer(self, symbol):
+        return self.ring
+
+    def since(self, symbol, sequence):
+        return self.ring.since(sequence)
+
+class FakeMarketData(object):
+    def __init__(self, capacity):
+        self.tape = FakeTape(capacity)
+        self.callback = None
+
+    def subscribeToTickData(self, symbol, callback):
+        self.callback = callback
+
+    def trade(self, count):
+        for i in range(count):
+            self.tape.ring.append(self.tape.ring.count, 100.0, 1.0)
+        self.callback('SPY', None, 100.0, 1.0)
+
+async def collect(marketData, batches, wanted):
+    stream = AsyncMarketData(marketData).ticks('SPY')
+    received = []
+    async def consume():
+        async for tick in stream:
+            received.append(int(tick['time']))
+            if len(received) == wanted:
+                return
+    task = asyncio.ensure_future(consume())
+    await asyncio.sleep(0)
+    for count in batches:
+        marketData.trade(count)
+        await asyncio.sleep(0.01)
+    await asyncio.wait_for(task, 1)
+    return received
+
+def test_every_trade_is_streamed():
+    marketData = FakeMarketData(capacity=16)
+    received = asyncio.run(collect(marketData, [10, 10, 10], 30))
+    assert received == list(range(30))
+
+def test_falling_behind_the_tape_raises():
+    marketData = FakeMarketData(capacity=16)
+    with pytest.raises(MarketDataError):
+        asyncio.run(collect(marketData, [40], 40))
@@ -0,0 +1,51 @@
+import threading
+
+import pytest
+
+from stonks.market_data.cache import CacheWriter
+
+class BlockingStore(object):
+    #holds the first write until released, so the ones submitted meanwhile are batched together
+    def __init__(self):
+        self.release = threading.Event()
+        self.writes = []
+
+    def writeBulk(self, bars, chunks, backfill=False):
+        self.release.wait(5)
+        self.writes.append((bars, chunks))
+
+def test_failing_notification_does_not_stop_the_writer():
+    store = BlockingStore()
+    notified = []
+    def onWritten(written):
+        notified.append(written)
+        if written == ('bad',):
+            raise RuntimeError('listener failed')
+    writer = CacheWriter(store, onWritten)
+
+    first = writer.submit([('A', '1m', None)], [], written=('first',))
+    batched = [writer.submit([(symbol, '1m', None)], [], written=(written,))
+                for symbol, written in (('B', 'good'), ('C', 'bad'), ('D', 'last'))]
+    store.release.set()
+
+    for future in [first] + batched:
+        assert future.result(timeout=5) is None
+    assert writer.batches <= 2
+    assert notified == [('first',), ('good',), ('bad',), ('last',)]
+
+    #the thread survived and still takes writes
+    assert writer.submit([('E', '1m', None)], []).result(timeout=5) is None
+    writer.stop()
+
+def test_failed_write_fails_only_its_own_future():
+    class FailingStore(object):
+        def writeBulk(self, bars, chunks, backfill=False):
+            if any(symbol == 'BAD' for symbol, barSize, dataframe in bars):
+                raise ValueError('bad frame')
+    writer = CacheWriter(FailingStore())
+    futures = [writer.submit([(symbol, '1m', None)], []) for symbol in ('A', 'BAD', 'C')]
+    assert futures[0].result(timeout=5) is None
+    with pytest.raises(ValueError):
+        futures[1].result(timeout=5)
+    assert futures[2].result(timeout=5) is None
+    writer.stop()
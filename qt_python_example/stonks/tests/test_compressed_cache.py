@@ -0,0 +1,42 @@
+import pandas as pd
+import sqlalchemy as sqla
+
+from stonks.market_data.compressed_cache import CompressedSQLiteBarStore
+
+def write_legacy_cache(path, symbol, dataType, bars, chunkDates):
+    #per-symbol tables as the original MarketDataCache wrote them
+    db = sqla.create_engine(f'sqlite:///{path}')
+    metadata = sqla.MetaData()
+    sqla.Table(f'{symbol}_{dataType}', metadata,
+                sqla.Column('date', sqla.DateTime, index=True, unique=True),
+                sqla.Column('open', sqla.Float),
+                sqla.Column('high', sqla.Float),
+                sqla.Column('low', sqla.Float),
+                sqla.Column('close', sqla.Float),
+                sqla.Column('volume', sqla.Float))
+    sqla.Table(f'{symbol}_{dataType}_chunks', metadata,
+                sqla.Column('date', sqla.DateTime, index=True, unique=True),
+                sqla.Column('data_source', sqla.String))
+    metadata.create_all(db)
+    with db.begin() as connection:
+        data = bars.copy()
+        data.index = data.index.tz_convert('UTC').tz_localize(None)
+        data.to_sql(f'{symbol}_{dataType}', connection, index_label='date', if_exists='append')
+        chunks = pd.DataFrame({'data_source': 'IBKR'}, index=chunkDates.tz_localize(None))
+        chunks.to_sql(f'{symbol}_{dataType}_chunks', connection, index_label='date', if_exists='append')
+    db.dispose()
+
+def test_compressed_store_opens_legacy_cache(tmp_path):
+    path = tmp_path / 'cache.sqlite'
+    index = pd.date_range('2022-01-03 09:30', periods=390, freq='T', tz='US/Eastern')
+    bars = pd.DataFrame({'open': 100.0, 'high': 100.5, 'low': 99.5, 'close': 100.25, 'volume': 1000.0}, index=index)
+    chunkDates = pd.DatetimeIndex([pd.Timestamp('2022-01-03', tz='US/Eastern')])
+    write_legacy_cache(path, 'SPY', 'bars_1m', bars, chunkDates)
+
+    store = CompressedSQLiteBarStore(str(path), poolSize=2)
+
+    read = store.readBars('SPY', '1m', index[0], index[-1])
+    assert read.index.equals(index.tz_convert('UTC'))
+    assert (read['close'] == 100.25).all()
+    assert store.readChunks('SPY', '1m', index[0], index[-1]).equals(chunkDates)
+    assert not any(name.startswith('SPY_') for name in sqla.inspect(store._db).get_table_names())
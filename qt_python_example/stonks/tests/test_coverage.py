@@ -0,0 +1,33 @@
+import numpy as np
+
+from stonks.market_data.coverage import ChunkCoverage, ChunkCoverageIndex
+
+CALENDAR = np.arange(0, 200, 10, dtype=np.int64)
+
+def test_added_chunks_merge_into_runs():
+    coverage = ChunkCoverage(CALENDAR, [10, 20, 30, 60, 70])
+    assert coverage.runs() == 2
+    coverage.add([40, 50])
+    assert coverage.runs() == 1
+    assert coverage.missing(0, len(CALENDAR)) == [(0, 1), (8, len(CALENDAR))]
+
+def test_chunks_outside_the_calendar_are_ignored():
+    coverage = ChunkCoverage(CALENDAR, [15, 1000, 20])
+    assert coverage.runs() == 1
+    assert coverage.missing(1, 4) == [(1, 2), (3, 4)]
+
+def test_missing_reports_every_hole_in_the_window():
+    coverage = ChunkCoverage(CALENDAR, [20, 30, 80, 120, 130])
+    assert coverage.missing(0, 15) == [(0, 2), (4, 8), (9, 12), (14, 15)]
+    assert coverage.missing(2, 4) == []
+
+def test_index_loads_once_and_answers_in_chunk_ns():
+    loads = []
+    def loader(symbol, dataType, calendar):
+        loads.append((symbol, dataType))
+        return [30, 40]
+    index = ChunkCoverageIndex(lambda dataType: CALENDAR, loader)
+    assert index.missing('SPY', 'bars_1m', 20, 60) == [(20, 20), (50, 60)]
+    index.add('SPY', 'bars_1m', [50, 60])
+    assert index.missing('SPY', 'bars_1m', 20, 60) == [(20, 20)]
+    assert loads == [('SPY', 'bars_1m')]
@@ -0,0 +1,61 @@
+from PySide2.QtCore import QCoreApplication
+
+from stonks.market_data.event_bus import EventBus
+from stonks.market_data.ibkr import merge_ticks
+
+def event_bus():
+    QCoreApplication.instance() or QCoreApplication([])
+    bus = EventBus()
+    bus.stop()
+    return bus
+
+def test_messages_with_the_same_key_are_delivered_once():
+    bus = event_bus()
+    delivered = []
+    bus.register('depth', lambda *payload: delivered.append(payload))
+    for size in range(5):
+        bus.post('depth', 1, ('SPY', size))
+    bus.post('depth', 2, ('QQQ', 9))
+    bus.drain()
+    assert sorted(delivered) == [('QQQ', 9), ('SPY', 4)]
+    assert bus.stats()['coalesced'] == 4
+    bus.drain()
+    assert len(delivered) == 2
+
+def test_changing_key_keeps_the_order_of_runs():
+    bus = event_bus()
+    delivered = []
+    bus.register('bar', lambda *payload: delivered.append(payload), coalesceKey=lambda payload: payload[0])
+    for payload in (('09:30', 1), ('09:30', 2), ('09:31', 3), ('09:31', 4), ('09:30', 5)):
+        bus.post('bar', 1, payload)
+    bus.drain()
+    assert delivered == [('09:30', 2), ('09:31', 4), ('09:30', 5)]
+
+def test_merged_ticks_keep_the_last_price_and_the_total_size():
+    bus = event_bus()
+    delivered = []
+    bus.register('tick', lambda *payload: delivered.append(payload), merge=merge_ticks)
+    for time, price, size in ((1, 100.0, 10), (2, 100.5, 20), (3, 100.25, 5)):
+        bus.post('tick', 1, ('SPY', time, price, size, None))
+    bus.drain()
+    assert delivered == [('SPY', 3, 100.25, 35, None)]
+
+def test_full_queue_drops_the_oldest_messages():
+    bus = event_bus()
+    bus.queueSize = 3
+    delivered = []
+    bus.register('bar', lambda *payload: delivered.append(payload), coalesceKey=lambda payload: payload[0])
+    for i in range(5):
+        bus.post('bar', 1, (i,))
+    bus.drain()
+    assert delivered == [(2,), (3,), (4,)]
+    assert bus.stats()['dropped'] == 2
+
+def test_discarded_requests_are_not_delivered():
+    bus = event_bus()
+    delivered = []
+    bus.register('depth', lambda *payload: delivered.append(payload))
+    bus.post('depth', 7, ('SPY', 1))
+    bus.discard(7)
+    bus.drain()
+    assert delivered == []
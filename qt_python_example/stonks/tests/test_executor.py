@@ -0,0 +1,73 @@
+import concurrent.futures
+import threading
+
+import pytest
+
+from stonks.market_data.base import CancellationToken, MarketDataExecutor, to_thread
+from stonks.market_data.scheduler import PRIORITY_INTERACTIVE, PRIORITY_PREFETCH
+
+@pytest.fixture
+def blocked_executor():
+    #every worker busy until the test releases them, so new tasks stay queued
+    executor = MarketDataExecutor()
+    release = threading.Event()
+    started = threading.Semaphore(0)
+    def block():
+        started.release()
+        release.wait(5)
+    blockers = [executor.submit(block) for _ in range(executor.maxThreadCount())]
+    for _ in blockers:
+        assert started.acquire(timeout=2)
+    yield executor, release
+    release.set()
+    executor.waitForDone(5000)
+
+def test_cancelled_token_drops_queued_tasks(blocked_executor):
+    executor, release = blocked_executor
+    ran = []
+    token = CancellationToken()
+    futures = [executor.submit(ran.append, i, token=token) for i in range(3)]
+    token.cancel()
+    release.set()
+    executor.waitForDone(5000)
+    assert ran == []
+    assert all(future.cancelled() for future in futures)
+    assert token._callbacks == []
+
+def test_higher_priority_runs_first(blocked_executor):
+    executor, release = blocked_executor
+    ran = []
+    lock = threading.Lock()
+    def record(name):
+        with lock:
+            ran.append(name)
+    futures = [executor.submit(record, 'prefetch', priority=PRIORITY_PREFETCH),
+                executor.submit(record, 'interactive', priority=PRIORITY_INTERACTIVE)]
+    release.set()
+    concurrent.futures.wait(futures, timeout=5)
+    assert ran.index('interactive') < ran.index('prefetch')
+
+def test_finished_tasks_leave_no_callback_on_the_token():
+    token = CancellationToken()
+    future = MarketDataExecutor().submit(lambda: 42, token=token)
+    assert future.result(timeout=5) == 42
+    MarketDataExecutor().waitForDone(5000)
+    assert token._callbacks == []
+
+def test_to_thread_returns_a_future_and_reads_keywords():
+    class Source(object):
+        @to_thread
+        def load(self, value, priority=PRIORITY_INTERACTIVE, token=None):
+            return value * 2
+    assert Source().load(21, priority=PRIORITY_PREFETCH).result(timeout=5) == 42
+    token = CancellationToken()
+    token.cancel()
+    with pytest.raises(concurrent.futures.CancelledError):
+        Source().load(1, token=token).result(timeout=5)
+
+def test_cancelled_token_runs_late_callbacks_right_away():
+    token = CancellationToken()
+    token.cancel()
+    called = []
+    token.addCallback(lambda: called.append(True))
+    assert called == [True]
@@ -0,0 +1,53 @@
+import time
+
+from stonks.market_data.flight import FlightBoard
+
+def join(board, key, owner=None, priority=0, startTime=1, endTime=2):
+    return board.join(key, startTime, endTime, None, None, priority, owner)
+
+def test_first_caller_leads_and_later_ones_follow():
+    board = FlightBoard()
+    flight, leader = join(board, 'SPY', priority=2)
+    same, follower = join(board, 'SPY', priority=0, startTime=0, endTime=3)
+    other, otherLeader = join(board, 'QQQ')
+    assert leader and not follower and otherLeader
+    assert same is flight and other is not flight
+    assert flight.priority == 0
+    assert flight.span() == (0, 3)
+    board.stop()
+
+def test_landing_hands_out_the_waiters_once():
+    board = FlightBoard()
+    flight, _ = join(board, 'SPY')
+    join(board, 'SPY')
+    assert len(board.land(flight)) == 2
+    assert board.land(flight) == []
+    #the next caller starts a new flight
+    nextFlight, leader = join(board, 'SPY')
+    assert leader and nextFlight is not flight
+    board.stop()
+
+def test_cancelling_an_owner_abandons_flights_only_it_waits_for():
+    board = FlightBoard()
+    owner, otherOwner = object(), object()
+    alone, _ = join(board, 'SPY', owner)
+    shared, _ = join(board, 'QQQ', owner)
+    join(board, 'QQQ', otherOwner)
+    assert board.cancelOwner(owner) == [alone]
+    assert alone.landed and not shared.landed
+    assert len(shared.waiters) == 1
+    assert len(board) == 1
+    board.stop()
+
+def test_flights_without_progress_expire():
+    board = FlightBoard(timeout=0.5)
+    expired = []
+    flight, _ = join(board, 'SPY')
+    flight.onExpired = lambda: expired.append(board.land(flight))
+    active, _ = join(board, 'QQQ')
+    for _ in range(3):
+        time.sleep(0.4)
+        board.progress(active)
+    assert len(expired) == 1 and len(expired[0]) == 1
+    assert not active.landed
+    board.stop()
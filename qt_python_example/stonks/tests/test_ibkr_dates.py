@@ -0,0 +1,22 @@
+import pandas as pd
+import pytest
+
+from stonks.market_data.ibkr import parse_bar_dates
+
+@pytest.mark.parametrize('dates', [
+    ['20240102 09:30:00', '20240102 09:31:00'],
+    ['20240102  09:30:00', '20240102  09:31:00'],
+    ['20240102 09:30:00 US/Eastern', '20240102 09:31:00 US/Eastern'],
+    ['20240102  09:30:00 US/Eastern', '20240102  09:31:00 US/Eastern'],
+])
+def test_intraday_bar_dates(dates):
+    index = parse_bar_dates(dates, 'US/Eastern')
+    assert list(index) == [pd.Timestamp('2024-01-02 09:30', tz='US/Eastern'), pd.Timestamp('2024-01-02 09:31', tz='US/Eastern')]
+
+def test_bar_dates_in_another_timezone():
+    index = parse_bar_dates(['20240102 06:30:00 US/Pacific'], 'US/Eastern')
+    assert index[0] == pd.Timestamp('2024-01-02 09:30', tz='US/Eastern')
+
+def test_daily_bar_dates():
+    index = parse_bar_dates(['20240102', '20240103'], 'US/Eastern')
+    assert list(index) == [pd.Timestamp('2024-01-02', tz='US/Eastern'), pd.Timestamp('2024-01-03', tz='US/Eastern')]
@@ -0,0 +1,39 @@
+import pytest
+
+from stonks.market_data.types import MarketDepth, price_to_ticks
+
+ASK, BID = MarketDepth.ASK, MarketDepth.BID
+
+def prices(book, side):
+    return [ticks / 10**6 for ticks in book.side(side)[0].tolist()]
+
+def test_insert_update_and_delete_shift_levels():
+    book = MarketDepth('SPY', capacity=2)
+    book.insert(0, 100.02, ASK, 5)
+    book.insert(0, 100.01, ASK, 3)
+    book.insert(1, 100.015, ASK, 1)
+    assert prices(book, ASK) == [100.01, 100.015, 100.02]
+    book.update(1, 100.015, ASK, 7)
+    assert book.side(ASK)[1].tolist() == [3.0, 7.0, 5.0]
+    book.delete(0, 100.01, ASK, 3)
+    assert prices(book, ASK) == [100.015, 100.02]
+    #an update past the last level appends it
+    book.update(5, 100.03, ASK, 2)
+    assert prices(book, ASK) == [100.015, 100.02, 100.03]
+    assert len(book) == 3
+
+def test_snapshot_is_a_read_only_copy():
+    book = MarketDepth('SPY')
+    book.insert(0, 99.99, BID, 4)
+    snapshot = book.snapshot()
+    book.update(0, 99.98, BID, 6)
+    assert snapshot.side(BID)[0].tolist() == [price_to_ticks(99.99)]
+    with pytest.raises(ValueError):
+        snapshot.side(BID)[1][0] = 1.0
+
+def test_dataframe_lists_both_sides():
+    book = MarketDepth('SPY')
+    book.insert(0, 100.01, ASK, 5)
+    book.insert(0, 100.00, BID, 3)
+    assert len(book.dataframe) == 2
+    assert len(MarketDepth('SPY').dataframe) == 0
@@ -0,0 +1,46 @@
+import pandas as pd
+
+from stonks.market_data.memory_cache import BarMemoryCache
+
+def block(rows=10):
+    index = pd.date_range('2024-01-02 09:30', periods=rows, freq='T', tz='UTC')
+    return pd.DataFrame({'open': 1.0, 'high': 1.0, 'low': 1.0, 'close': 1.0, 'volume': 1.0}, index=index)
+
+def test_invalidate_drops_only_the_written_chunks():
+    cache = BarMemoryCache(10**6)
+    for chunk_ns in (1, 2):
+        cache.put(('SPY', 'bars_1m', chunk_ns), block())
+    cache.put(('QQQ', 'bars_1m', 1), block())
+    cache.invalidate('SPY', 'bars_1m', [1])
+    assert cache.get(('SPY', 'bars_1m', 1)) is None
+    assert cache.get(('SPY', 'bars_1m', 2)) is not None
+    assert cache.get(('QQQ', 'bars_1m', 1)) is not None
+
+def test_stale_put_is_rejected_only_for_the_invalidated_symbol():
+    cache = BarMemoryCache(10**6)
+    spy = cache.generation('SPY', 'bars_1m')
+    qqq = cache.generation('QQQ', 'bars_1m')
+    #a write to SPY lands while both reads are in progress
+    cache.invalidate('SPY', 'bars_1m', [1])
+    cache.put(('SPY', 'bars_1m', 1), block(), spy)
+    cache.put(('QQQ', 'bars_1m', 1), block(), qqq)
+    assert cache.get(('SPY', 'bars_1m', 1)) is None
+    assert cache.get(('QQQ', 'bars_1m', 1)) is not None
+
+def test_clear_rejects_every_put_read_before_it():
+    cache = BarMemoryCache(10**6)
+    generation = cache.generation('SPY', 'bars_1m')
+    cache.clear()
+    cache.put(('SPY', 'bars_1m', 1), block(), generation)
+    assert cache.get(('SPY', 'bars_1m', 1)) is None
+
+def test_least_recently_used_blocks_are_evicted():
+    size = int(block().memory_usage(index=True).sum())
+    cache = BarMemoryCache(size * 2)
+    cache.put(('SPY', 'bars_1m', 1), block())
+    cache.put(('SPY', 'bars_1m', 2), block())
+    cache.get(('SPY', 'bars_1m', 1))
+    cache.put(('SPY', 'bars_1m', 3), block())
+    assert cache.get(('SPY', 'bars_1m', 2)) is None
+    assert cache.get(('SPY', 'bars_1m', 1)) is not None
+    assert cache.stats()['evictions'] == 1
@@ -0,0 +1,48 @@
+import pandas as pd
+
+from stonks.market_data.planner import FetchPlan, plan_requests
+
+def eastern(timestamp):
+    return pd.Timestamp(timestamp, tz='US/Eastern')
+
+def test_intraday_ranges_become_one_request_per_session():
+    #Friday to Tuesday, the weekend is never requested
+    requests = plan_requests([(eastern('2024-01-05'), eastern('2024-01-10'))], '1m')
+    assert [start.strftime('%Y-%m-%d') for start, end in requests] == ['2024-01-05', '2024-01-08', '2024-01-09']
+    for start, end in requests:
+        assert end - start == pd.Timedelta(hours=16)
+
+def test_nearby_gaps_are_merged_into_one_request():
+    gaps = [(eastern('2024-01-08 04:00'), eastern('2024-01-08 06:00')), (eastern('2024-01-08 12:00'), eastern('2024-01-08 14:00'))]
+    requests = plan_requests(gaps, '5m')
+    assert len(requests) == 1
+
+def test_long_ranges_are_split_into_equal_pieces():
+    requests = plan_requests([(eastern('2020-01-01'), eastern('2024-01-01'))], '1D')
+    assert len(requests) == 4
+    assert requests[0][0] == eastern('2020-01-01') and requests[-1][1] == eastern('2024-01-01')
+    assert all(previous[1] == following[0] for previous, following in zip(requests, requests[1:]))
+
+def test_fetch_plan_limits_requests_in_flight():
+    started = []
+    completed = []
+    plan = FetchPlan([(i, i + 1) for i in range(5)], lambda plan, start, end: started.append(start), completed.append, maxConcurrent=2)
+    plan.start()
+    assert started == [0, 1]
+    plan.requestFinished()
+    assert started == [0, 1, 2]
+    plan.requestFailed('SPY', '1m', 162, 'no data')
+    plan.requestFinished()
+    plan.requestFinished()
+    assert not completed
+    plan.requestFinished()
+    assert started == [0, 1, 2, 3, 4]
+    assert completed == [[(162, 'no data')]]
+
+def test_cancelled_plan_sends_nothing_more():
+    started = []
+    plan = FetchPlan([(i, i + 1) for i in range(3)], lambda plan, start, end: started.append(start), lambda failed: None, maxConcurrent=1)
+    plan.start()
+    plan.cancel()
+    plan.requestFinished()
+    assert started == [0]
@@ -0,0 +1,52 @@
+from decimal import Decimal
+
+import numpy as np
+
+from stonks.market_data.types import MarketDepth, bucket_ticks, ladder_step
+
+ASK, BID = MarketDepth.ASK, MarketDepth.BID
+
+def test_buckets_round_to_the_nearest_multiple_ties_to_even():
+    ticks = np.array([0, 4, 5, 6, 15, 16, 25])
+    assert bucket_ticks(ticks, 10).tolist() == [0, 0, 0, 10, 20, 20, 20]
+    assert bucket_ticks(14, 10) == 10
+
+def test_steps_finer_than_a_tick_are_clamped():
+    assert ladder_step(None) == 1
+    assert ladder_step(1e-9) == 1
+    assert ladder_step(0.05) == 50000
+
+def book():
+    depth = MarketDepth('SPY')
+    depth.insert(0, 100.01, ASK, 5)
+    depth.insert(1, 100.04, ASK, 2)
+    depth.insert(0, 99.99, BID, 3)
+    depth.insert(1, 99.96, BID, 1)
+    return depth
+
+def test_ladder_sums_levels_per_bucket_and_follows_changes():
+    depth = book()
+    data = depth.bookData(0.05)
+    assert data.loc[Decimal('100'), 'size_ask'] == 5
+    assert data.loc[Decimal('100.05'), 'size_ask'] == 2
+    assert data.loc[Decimal('100'), 'size_bid'] == 3
+    assert data.loc[Decimal('99.95'), 'size_bid'] == 1
+    depth.update(0, 100.01, ASK, 9)
+    depth.delete(1, 99.96, BID, 1)
+    data = depth.bookData(0.05)
+    assert data.loc[Decimal('100'), 'size_ask'] == 9
+    assert data.loc[Decimal('100'), 'size_bid'] == 3
+    assert not Decimal('99.95') in data.index
+
+def test_snapshot_ladders_are_requested_and_released_on_the_book():
+    depth = book()
+    snapshot = depth.snapshot()
+    assert snapshot.bookData(0.05).loc[Decimal('100'), 'size_bid'] == 3
+    #the book starts maintaining the step at its next snapshot
+    depth.snapshot()
+    assert ladder_step(0.05) in depth._ladders
+    snapshot.releaseLadder(0.05)
+    depth.snapshot()
+    assert ladder_step(0.05) not in depth._ladders
+    #asking again rebuilds it from the levels
+    assert depth.snapshot().bookData(0.05).loc[Decimal('100'), 'size_ask'] == 5
@@ -0,0 +1,48 @@
+from stonks.market_data.ibkr import IBRequest, RequestRegistry
+
+class FakeRequest(object):
+    def __init__(self, tickerId, symbol, reqType, barSize=None, live=True):
+        self.tickerId = tickerId
+        self.symbol = symbol
+        self.reqType = reqType
+        self.live_request = live
+        if barSize is not None:
+            self.barSize = barSize
+
+def registry_with_requests():
+    registry = RequestRegistry()
+    requests = [FakeRequest(registry.allocateId(), 'SPY', IBRequest.HISTORICAL_BARS, '1m', False),
+                FakeRequest(registry.allocateId(), 'SPY', IBRequest.HISTORICAL_BARS, '1m', True),
+                FakeRequest(registry.allocateId(), 'SPY', IBRequest.HISTORICAL_BARS, '5m', False),
+                FakeRequest(registry.allocateId(), 'SPY', IBRequest.REALTIME_TICKS),
+                FakeRequest(registry.allocateId(), 'QQQ', IBRequest.HISTORICAL_BARS, '1m', False)]
+    for request in requests:
+        registry.append(request)
+    return registry, requests
+
+def test_find_by_symbol_type_bar_size_and_live():
+    registry, requests = registry_with_requests()
+    assert registry.find('SPY', IBRequest.HISTORICAL_BARS, '1m', False) == [requests[0]]
+    assert registry.find('SPY', IBRequest.HISTORICAL_BARS, '1m', True) == [requests[1]]
+    assert registry.find('SPY', IBRequest.HISTORICAL_BARS, live=False) == [requests[0], requests[2]]
+    assert registry.find('SPY', IBRequest.HISTORICAL_BARS, '1m') == [requests[0], requests[1]]
+    assert registry.find('SPY', IBRequest.REALTIME_TICKS) == [requests[3]]
+    assert registry.find(reqType=IBRequest.HISTORICAL_BARS, barSize='1m', live=False) == [requests[0], requests[4]]
+    assert len(registry.find()) == 5
+
+def test_removed_requests_leave_the_index():
+    registry, requests = registry_with_requests()
+    registry.remove(requests[0])
+    assert registry.find('SPY', IBRequest.HISTORICAL_BARS, '1m', False) == []
+    assert registry.get(requests[0].tickerId) is None
+    registry.remove(requests[3])
+    assert registry.find('SPY', IBRequest.REALTIME_TICKS) == []
+    assert len(registry) == 3
+
+def test_released_ids_are_reused_only_after_a_delay():
+    registry = RequestRegistry()
+    first = FakeRequest(registry.allocateId(), 'SPY', IBRequest.REALTIME_TICKS)
+    registry.append(first)
+    registry.remove(first)
+    ids = [registry.allocateId() for i in range(RequestRegistry.REUSE_DELAY)]
+    assert first.tickerId not in ids
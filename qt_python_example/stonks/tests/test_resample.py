@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+
+from stonks.market_data.resample import can_resample, resample_bars
+
+def minute_bars(start, periods):
+    index = pd.date_range(start, periods=periods, freq='T', tz='US/Eastern')
+    values = np.arange(periods, dtype=float)
+    return pd.DataFrame({'open': values, 'high': values + 1, 'low': values - 1, 'close': values + 0.5, 'volume': 1.0}, index=index)
+
+def test_only_intraday_multiples_of_the_base_can_be_resampled():
+    assert can_resample('5m', '1m')
+    assert can_resample('1h', '1m')
+    assert not can_resample('1m', '1m')
+    assert not can_resample('1D', '1m')
+    assert not can_resample('3m', '2m')
+
+def test_bins_start_at_the_session_open():
+    bars = minute_bars('2024-01-02 09:30', 60)
+    derived = resample_bars(bars, '30m', pd.Timedelta(hours=9, minutes=45))
+    assert list(derived.index.strftime('%H:%M')) == ['09:15', '09:45', '10:15']
+    first = derived.iloc[0]
+    assert (first['open'], first['high'], first['low'], first['close'], first['volume']) == (0.0, 15.0, -1.0, 14.5, 15.0)
+
+def test_bins_follow_the_wall_clock_across_dst():
+    #the Monday after clocks moved forward, bins still start on the half hour of the session open
+    bars = minute_bars('2024-03-11 09:30', 90)
+    derived = resample_bars(bars, '1h', pd.Timedelta(hours=9, minutes=30))
+    assert list(derived.index.strftime('%H:%M')) == ['09:30', '10:30']
+    assert list(derived['volume']) == [60.0, 30.0]
+
+def test_empty_input_gives_empty_bars():
+    assert resample_bars(minute_bars('2024-01-02 09:30', 0), '5m', pd.Timedelta(hours=4)).empty
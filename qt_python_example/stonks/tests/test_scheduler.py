@@ -0,0 +1,116 @@
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from stonks.market_data.scheduler import HistoricalRequestScheduler, PRIORITY_PREFETCH, SlidingWindow
+
+class FakeProviderRequest(object):
+    def __init__(self, args):
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class FakeAPI(object):
+    paced = True
+    def __init__(self):
+        self.requests = []
+        self.sent = threading.Semaphore(0)
+
+    def requestHistoricalBars(self, symbol, barSize, startTime, endTime, live, callback, error_callback=None):
+        request = FakeProviderRequest((symbol, barSize, startTime, endTime, callback, error_callback))
+        self.requests.append(request)
+        self.sent.release()
+        return request
+
+    def waitForSent(self, count, timeout=2):
+        for _ in range(count):
+            assert self.sent.acquire(timeout=timeout)
+
+@pytest.fixture
+def scheduler():
+    api = FakeAPI()
+    scheduler = HistoricalRequestScheduler(api)
+    yield scheduler
+    scheduler.stop()
+
+def day(i):
+    start = pd.Timestamp('2024-01-02', tz='US/Eastern') + pd.Timedelta(days=i)
+    return start, start + pd.Timedelta(days=1)
+
+def test_sliding_window_waits_for_the_oldest_send_to_expire():
+    window = SlidingWindow(3, 10)
+    for now in (0, 1, 2):
+        assert window.waitTime(now) == 0
+        window.take(now)
+    assert window.waitTime(3) == 7
+    #a reserve of one keeps the last slot free
+    assert window.waitTime(3, reserve=1) == 8
+    assert window.count(11.5) == 1
+    assert window.waitTime(10.5) == 0
+
+def test_identical_requests_share_one_send(scheduler):
+    results = []
+    for _ in range(3):
+        scheduler.submit('SPY', '1m', *day(0), lambda *args: results.append(args[2]))
+    scheduler.api.waitForSent(1)
+    time.sleep(0.05)
+    assert len(scheduler.api.requests) == 1
+    scheduler.api.requests[0].args[4]('SPY', '1m', 'bars', *day(0))
+    assert results == ['bars'] * 3
+    assert scheduler.stats()['shared'] == 2
+
+def test_no_more_than_five_requests_per_contract_in_two_seconds(scheduler):
+    for i in range(7):
+        scheduler.submit('SPY', '1m', *day(i), None)
+    scheduler.api.waitForSent(5)
+    time.sleep(0.2)
+    assert len(scheduler.api.requests) == 5
+    scheduler.api.waitForSent(2, timeout=5)
+
+def test_cancelling_the_last_ticket_cancels_the_provider_request(scheduler):
+    owner = object()
+    first = scheduler.submit('SPY', '1m', *day(0), None, owner=owner)
+    second = scheduler.submit('SPY', '1m', *day(0), None)
+    scheduler.api.waitForSent(1)
+    scheduler.cancelOwner(owner)
+    assert not scheduler.api.requests[0].cancelled
+    second.cancel()
+    assert scheduler.api.requests[0].cancelled
+    assert scheduler.stats()['in_flight'] == 0
+
+def test_cancelled_queued_requests_are_never_sent(scheduler):
+    scheduler._pausedUntil = time.monotonic() + 60
+    ticket = scheduler.submit('SPY', '1m', *day(0), None, priority=PRIORITY_PREFETCH)
+    ticket.cancel()
+    scheduler._pausedUntil = 0
+    scheduler.submit('QQQ', '1m', *day(0), None)
+    scheduler.api.waitForSent(1)
+    time.sleep(0.05)
+    assert [request.args[0] for request in scheduler.api.requests] == ['QQQ']
+
+def test_unanswered_requests_fail_after_the_timeout(scheduler):
+    scheduler.timeout = 0.2
+    errors = []
+    scheduler.submit('SPY', '1m', *day(0), None, lambda *args: errors.append(args[2]))
+    scheduler.api.waitForSent(1)
+    time.sleep(0.5)
+    assert errors == [-1]
+    assert scheduler.api.requests[0].cancelled
+    assert scheduler.stats()['timeouts'] == 1
+
+def test_pacing_violation_resends_after_a_backoff(scheduler):
+    scheduler.PACING_BACKOFF = 0.2
+    #the resend is identical to the request that was rejected
+    scheduler.IDENTICAL_INTERVAL = 0.2
+    results = []
+    scheduler.submit('SPY', '1m', *day(0), lambda *args: results.append(args[2]))
+    scheduler.api.waitForSent(1)
+    scheduler.api.requests[0].args[5]('SPY', '1m', 162, 'Historical Market Data Service error message:API historical data query cancelled: pacing violation')
+    scheduler.api.waitForSent(1)
+    scheduler.api.requests[1].args[4]('SPY', '1m', 'bars', *day(0))
+    assert results == ['bars']
+    assert scheduler.stats()['pacing_violations'] == 1
@@ -0,0 +1,20 @@
+import pandas as pd
+import pytest
+
+from stonks.market_data.cache import SQLiteBarStore
+
+def test_rolled_back_symbol_id_is_not_cached(tmp_path):
+    store = SQLiteBarStore(str(tmp_path / 'cache.sqlite'), poolSize=2)
+    index = pd.date_range('2022-01-03 09:30', periods=5, freq='T', tz='US/Eastern')
+    bars = pd.DataFrame({'open': 1.0, 'high': 1.0, 'low': 1.0, 'close': 1.0, 'volume': 1.0}, index=index)
+
+    #the symbol row is inserted before the bars fail to save, so the whole transaction rolls back
+    with pytest.raises(KeyError):
+        store.writeBars('AAPL', '1m', bars.drop(columns='volume'))
+    assert 'AAPL' not in store._symbolIds
+
+    store.writeBars('MSFT', '1m', bars)
+    store.writeBars('AAPL', '1m', bars)
+    assert store.readBars('AAPL', '1m', index[0], index[-1]).index.equals(index.tz_convert('UTC'))
+    assert store.readBars('MSFT', '1m', index[0], index[-1]).index.equals(index.tz_convert('UTC'))
+    assert store._symbolIds['AAPL'] != store._symbolIds['MSFT']
@@ -0,0 +1,54 @@
+import pandas as pd
+
+from stonks.market_data.ticks import TickRingBuffer, read_tick_file, tick_file_path, ticks_dataframe
+
+def times(ticks):
+    return ticks['time'].tolist()
+
+def test_latest_is_in_order_after_the_ring_wraps():
+    ring = TickRingBuffer('SPY', 4)
+    for i in range(10):
+        ring.append(i, 100.0 + i, 1.0, 'ARCA')
+    assert len(ring) == 4
+    assert times(ring.latest()) == [6, 7, 8, 9]
+    assert times(ring.latest(2)) == [8, 9]
+    assert ring.latest()[-1]['exchange'] == b'ARCA'
+
+def test_since_returns_only_new_ticks():
+    ring = TickRingBuffer('SPY', 8)
+    for i in range(3):
+        ring.append(i, 100.0, 1.0)
+    ticks, sequence = ring.since(0)
+    assert times(ticks) == [0, 1, 2] and sequence == 3
+    ring.append(3, 100.0, 1.0)
+    ticks, sequence = ring.since(sequence)
+    assert times(ticks) == [3] and sequence == 4
+    #a reader that fell behind gets what's still in the ring
+    for i in range(4, 20):
+        ring.append(i, 100.0, 1.0)
+    ticks, sequence = ring.since(sequence)
+    assert times(ticks) == list(range(12, 20)) and sequence == 20
+
+def test_ticks_spill_into_one_file_per_exchange_day(tmp_path):
+    ring = TickRingBuffer('SPY', 16, spillFolder=str(tmp_path))
+    day1 = pd.Timestamp('2024-01-02 15:00', tz='US/Eastern').value
+    day2 = pd.Timestamp('2024-01-03 09:30', tz='US/Eastern').value
+    for i in range(3):
+        ring.append(day1 + i, 100.0 + i, 1.0)
+    ring.append(day2, 101.0, 2.0)
+    ring.close()
+    first = read_tick_file(tick_file_path(str(tmp_path), 'SPY', '2024-01-02'))
+    second = read_tick_file(tick_file_path(str(tmp_path), 'SPY', '2024-01-03'))
+    assert times(first) == [day1, day1 + 1, day1 + 2]
+    assert times(second) == [day2]
+    assert ticks_dataframe(second)['price'].tolist() == [101.0]
+
+def test_missing_or_partial_files_read_as_whole_records(tmp_path):
+    assert len(read_tick_file(str(tmp_path / 'missing.ticks'))) == 0
+    ring = TickRingBuffer('SPY', 4, spillFolder=str(tmp_path))
+    ring.append(pd.Timestamp('2024-01-02 10:00', tz='US/Eastern').value, 100.0, 1.0)
+    ring.close()
+    path = tick_file_path(str(tmp_path), 'SPY', '2024-01-02')
+    with open(path, 'ab') as f:
+        f.write(b'\0' * 5)
+    assert len(read_tick_file(path)) == 1
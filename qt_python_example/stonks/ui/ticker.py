@@ -12,6 +12,7 @@ from .visualizers.algo_manager import AlgoManagerWidget
 from .common import MyDock
 
 from ..market_data.ibkr import IBApiWrapper, IBRequest
+from ..market_data.base import CancellationToken
 
 from ..config import Config
 
@@ -81,6 +82,8 @@ class StonkTicker(QWidget):
 
         self.api = api
         self.brokerApi = brokerApi
+        #shared by every history load for the current ticker
+        self.historyToken = CancellationToken()
 
         self.tickerInput = StonkTickerNameInput(self, ticker_name)
         self.tickerInput.tickerEdit.returnPressed.connect(self.updateTicker)
@@ -146,6 +149,11 @@ class StonkTicker(QWidget):
             QGuiApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
             self.bookDepthData = None
             self.api.cancelSubscriptions(self.ticker_name)
+            #history loads still queued or in flight for the previous ticker are dropped, charts waiting on them can ask again
+            self.historyToken.cancel()
+            self.historyToken = CancellationToken()
+            for chart in self.charts:
+                chart.dataFillRequestActive = False
             self.ticker_name = ticker_name
             self.mainChart.setTicker(ticker_name)
 
@@ -159,7 +167,8 @@ class StonkTicker(QWidget):
                     self.api.requestHistoricalBars(ticker_name,
                                                     chart.barSize,
                                                     callback=self.historicalBarEnd,
-                                                    error_callback=self.historicalBarError)
+                                                    error_callback=self.historicalBarError,
+                                                    token=self.historyToken)
                     self.api.subscribeToLiveBars(ticker_name, chart.barSize, self.historicalBarUpdate)
                     barSizesRequested.append(chart.barSize)
             self.api.subscribeToTickData(ticker_name, callback=self.tickLastUpdate)
@@ -215,14 +224,14 @@ class StonkTicker(QWidget):
         self.api.cancelSubscriptions(self.ticker_name, 'historicalBars')
         self.statusBar.showMessage(f'Requesting data for {self.ticker_name} - {newBarSize}...')
         QGuiApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
-        self.api.requestHistoricalBars(self.ticker_name, newBarSize, callback=self.historicalBarEnd)
+        self.api.requestHistoricalBars(self.ticker_name, newBarSize, callback=self.historicalBarEnd, token=self.historyToken)
         self.api.subscribeToLiveBars(self.ticker_name, newBarSize, callback=self.historicalBarUpdate)
 
     #@Slot(str, str, object, object, bool)
     def chartDataRequired(self, symbol, barSize, startTimeStamp, endTimeStamp=None, live=False):
         self.statusBar.showMessage(f'Requesting data for {symbol} - {barSize}...')
         QGuiApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
-        self.api.requestHistoricalBars(symbol, barSize, startTimeStamp, endTimeStamp, callback=self.historicalBarEnd)
+        self.api.requestHistoricalBars(symbol, barSize, startTimeStamp, endTimeStamp, callback=self.historicalBarEnd, token=self.historyToken)
 
     def checkIfBookDepthNeeded(self):
         needed = any([chart.bookDepthEnabled for chart in self.charts])
@@ -70,6 +70,9 @@ class BookDepthItem(pg.ScatterPlotItem):
             if range/maxTicks < stepValue:
                 tickStep = Decimal(stepValue)
         if self.minStep != tickStep:
+            #the book stops maintaining the ladder of the old step
+            if self.minStep is not None and self.marketDepthData is not None:
+                self.marketDepthData.releaseLadder(self.minStep)
             self.minStep = tickStep
             self.generateSpots()
         pg.ScatterPlotItem.paint(self, p, *args)
@@ -79,6 +82,7 @@ class BookDepthGrid(pg.GridItem):
     def __init__(self, *args, **kwargs):
         pg.GridItem.__init__(self, *args, **kwargs)
         self.bookData = None
+        self.tickStep = None
 
     def generatePicture(self):
         self.picture = QPicture()
@@ -89,6 +93,9 @@ class BookDepthGrid(pg.GridItem):
         unit = self.pixelWidth(), self.pixelHeight()
         #print(boundingRect.top(), boundingRect.bottom(), vr, unit)
         tickStep, ticks = self.tickValues(boundingRect.top(), boundingRect.bottom())[0]
+        if self.bookData is not None and self.tickStep is not None and self.tickStep != tickStep:
+            self.bookData.releaseLadder(self.tickStep)
+        self.tickStep = tickStep
 
         #colored rectangles
         oddRow = True
@@ -448,7 +448,8 @@ class Chart(BaseVisualizer):
 
     def marketDepthUpdate(self, marketDepthData):
         self.marketDepthData = marketDepthData
-        if len(self.marketDepthData.dataframe) == 0:
+        #level counts straight from the book arrays, no DataFrame needed to know it's empty
+        if len(self.marketDepthData) == 0:
             return
 
         self.tapeWidget.clear()